@@ -2,15 +2,49 @@
 ASGI config for ai project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+This is the entry point used in production (see Procfile): SSE views switch to
+async generators over AsyncOpenAI when served from here, so open streams
+do not hold worker threads.
+
+The lifespan protocol is handled here (Django does not): on startup the LLM
+clients open their connections, unless ``settings.LLM_HTTP['WARM_UP']`` is off,
+on shutdown the image jobs (``main.jobs``) are given time to finish.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
 """
 
+import asyncio
 import os
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ai.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from main.backends import awarm_up, warm_up  # noqa: E402 (needs the configured settings)
+from main.jobs import image_jobs, rendition_jobs  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope["type"] != "lifespan":
+        return await django_application(scope, receive, send)
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            if settings.LLM_HTTP["WARM_UP"]:
+                # The sync clients are used by the views' threads, the async ones by this event loop
+                await asyncio.gather(awarm_up(), sync_to_async(warm_up, thread_sensitive=False)())
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            # Running image jobs may finish, queued ones are marked as failed
+            await asyncio.gather(
+                sync_to_async(image_jobs.shutdown, thread_sensitive=False)(settings.IMAGE_JOBS["SHUTDOWN_TIMEOUT"]),
+                sync_to_async(rendition_jobs.shutdown, thread_sensitive=False)(
+                    settings.IMAGE_RENDITIONS["JOBS"]["SHUTDOWN_TIMEOUT"]),
+            )
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -21,7 +21,7 @@ from main.views import (
 from rest_framework import routers
 from django.contrib import admin
 from django.urls import path
-from main.views import AiViewSet
+from main.views import AiViewSet, metrics
 
 router = routers.SimpleRouter()
 
@@ -29,5 +29,6 @@ router.register(r'ai', AiViewSet)
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    path('metrics/', metrics),
     path('', include(router.urls)),
 ]
@@ -2,15 +2,23 @@
 WSGI config for ai project.
 
 It exposes the WSGI callable as a module-level variable named ``application``.
+The LLM clients open their connections in the background when the worker starts,
+unless ``settings.LLM_HTTP['WARM_UP']`` is off.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/4.2/howto/deployment/wsgi/
 """
 
 import os
+import threading
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ai.settings')
 
 application = get_wsgi_application()
+
+if settings.LLM_HTTP["WARM_UP"]:
+    from main.backends import warm_up
+    threading.Thread(target=warm_up, daemon=True).start()
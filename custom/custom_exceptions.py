@@ -13,6 +13,12 @@ class BadRequest(APIException):
     default_code = 'bad_request'
 
 
+class ServiceUnavailable(APIException):
+    status_code = 503
+    default_detail = 'Service temporarily unavailable, try again later.'
+    default_code = 'service_unavailable'
+
+
 class Fraud3dsException(Exception):
     pass
 
@@ -0,0 +1,57 @@
+import logging
+import traceback
+from collections import defaultdict
+from contextlib import ExitStack
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+PROJECT_DIR = str(settings.BASE_DIR)
+
+
+def _is_project_frame(frame: traceback.FrameSummary) -> bool:
+    return frame.filename.startswith(PROJECT_DIR) and "site-packages" not in frame.filename and frame.filename != __file__
+
+
+def _caller(stack: List[traceback.FrameSummary]) -> Optional[traceback.FrameSummary]:
+    """The innermost frame of the project's code (not Django, DRF or other packages)."""
+    return next((frame for frame in reversed(stack) if _is_project_frame(frame)), None)
+
+
+def n_plus_one_middleware(get_response):
+    """
+        Development only (added to MIDDLEWARE with DEBUG): logs queries that a request runs
+        `settings.N_PLUS_ONE_THRESHOLD` or more times with the same SQL from the same line of the project's code,
+        with the stack of that line. Queries of streamed responses run after the view returned and are not seen.
+    """
+    def middleware(request):
+        counts: Dict[Tuple[str, Optional[Tuple[str, int]]], int] = defaultdict(int)
+        stacks: Dict[Tuple[str, Optional[Tuple[str, int]]], List[traceback.FrameSummary]] = {}
+
+        def inspect(execute, sql, params, many, context):
+            stack = traceback.extract_stack()[:-1]
+            caller = _caller(stack)
+            key = (sql, caller and (caller.filename, caller.lineno))
+            counts[key] += 1
+            stacks.setdefault(key, stack)
+            return execute(sql, params, many, context)
+
+        with ExitStack() as wrappers:
+            for alias in connections:
+                wrappers.enter_context(connections[alias].execute_wrapper(inspect))
+            response = get_response(request)
+
+        for (sql, caller), count in counts.items():
+            if count < settings.N_PLUS_ONE_THRESHOLD:
+                continue
+            frames = [frame for frame in stacks[(sql, caller)] if _is_project_frame(frame)]
+            logger.warning(
+                "N+1: %s %s ran %d times from %s\n%s\n%s",
+                request.method, request.path, count,
+                "%s:%d" % caller if caller else "unknown", sql,
+                "".join(traceback.format_list(frames)),
+            )
+        return response
+    return middleware
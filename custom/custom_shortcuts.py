@@ -1,4 +1,6 @@
+from django.core.handlers.asgi import ASGIRequest
 from rest_framework.exceptions import APIException
+from rest_framework.request import Request
 
 
 def _get_queryset(klass):
@@ -28,3 +30,8 @@ def get_object_or_raise(klass, exception: APIException,  *args, **kwargs):
         return queryset.get(*args, **kwargs)
     except queryset.model.DoesNotExist:
         raise exception  # pylint: disable=raise-missing-from
+
+
+def is_asgi_request(request: Request) -> bool:
+    """`True` if the request is served by `ai.asgi.application`, i.e. async streaming responses are available."""
+    return isinstance(request._request, ASGIRequest)  # pylint: disable=protected-access
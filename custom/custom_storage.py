@@ -1,6 +1,135 @@
+import hashlib
+import os
+import re
+from functools import partial
+from typing import Iterator
+
 from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import models, transaction
+from django.db.models import F
 from storages.backends.s3boto3 import S3Boto3Storage
 
+# blobs/<first 2 hex digits>/<SHA-256 of the content><extension>
+BLOB_NAME = re.compile(r"(?:^|/)blobs/[0-9a-f]{2}/[0-9a-f]{64}(?:\.\w+)?$")
+BLOB_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class ContentAddressedMixin:
+    """
+        Saves files as blobs named by the hash of their content, whatever name the model asked for, so
+        identical files are stored (and uploaded) once. Every save is a reference to the blob and every
+        delete releases one; the blob is deleted with its last reference (see `main.models.MediaBlob`).
+        A stored name assigned to a row without saving a file takes its own reference (`assign_file`).
+        Names that are not blobs (files saved before) are stored and deleted as usual.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        return name  # the name is chosen by `_save`, blobs with the same name have the same content
+
+    def _save(self, name, content):
+        from main.models import MediaBlob  # pylint: disable=import-outside-toplevel
+
+        sha256 = hashlib.sha256()
+        for chunk in content.chunks():
+            sha256.update(chunk)
+        digest = sha256.hexdigest()
+        if MediaBlob.objects.filter(digest=digest).update(refcount=F("refcount") + 1):
+            return MediaBlob.objects.values_list("name", flat=True).get(digest=digest)
+        blob_name = f"blobs/{digest[:2]}/{digest}{os.path.splitext(name)[1].lower()}"
+        content.seek(0)
+        saved = super()._save(blob_name, content)  # concurrent uploads of a new blob write the same bytes
+        blob, created = MediaBlob.objects.get_or_create(
+            digest=digest, defaults={"name": saved, "size": content.size})
+        if not created:
+            MediaBlob.objects.filter(digest=digest).update(refcount=F("refcount") + 1)
+        return blob.name
+
+    def reference(self, name) -> bool:
+        """Takes a reference to the stored blob `name`, `False` if it is not one."""
+        from main.models import MediaBlob  # pylint: disable=import-outside-toplevel
+
+        return bool(BLOB_NAME.search(name) and MediaBlob.objects.filter(name=name).update(refcount=F("refcount") + 1))
+
+    def delete(self, name):
+        from main.models import MediaBlob  # pylint: disable=import-outside-toplevel
+
+        if not BLOB_NAME.search(name):
+            super().delete(name)
+            return
+        with transaction.atomic():
+            # Locked until the blob is deleted, a concurrent save of the same content waits and uploads it again
+            blob = MediaBlob.objects.select_for_update().filter(name=name).first()
+            if blob is None:
+                return  # not a reference of this storage
+            if blob.refcount > 1:
+                MediaBlob.objects.filter(pk=blob.pk).update(refcount=F("refcount") - 1)
+                return
+            blob.delete()
+            super().delete(name)
+
+
+def _blob_fields(instance: models.Model) -> Iterator[models.FileField]:
+    for field in instance._meta.concrete_fields:
+        if isinstance(field, models.FileField) and isinstance(field.storage, ContentAddressedMixin):
+            yield field
+
+
+def _name(value) -> str:
+    return getattr(value, "name", value) or ""
+
+
+def _release(storage: ContentAddressedMixin, name: str) -> None:
+    """Releases the row's reference to the blob `name` after the commit (files that are not blobs are kept)."""
+    if BLOB_NAME.search(name):
+        transaction.on_commit(partial(storage.delete, name))
+
+
+def track_files(sender, instance: models.Model, **kwargs) -> None:
+    """`post_init` receiver: remembers the blobs the loaded row references (not the ones of a new row)."""
+    instance._referenced_files = {  # type: ignore
+        field.attname: _name(instance.__dict__[field.attname])
+        for field in _blob_fields(instance) if instance.pk is not None and field.attname in instance.__dict__
+    }
+
+
+def assign_file(instance: models.Model, attname: str, name: str) -> None:
+    """
+        Assigns the stored file `name` to the row (instead of saving a file, e.g. a URL sent by the client):
+        takes a reference to its blob and releases the replaced one after the commit. Call it in the
+        transaction that saves the row, also before bulk writes.
+    """
+    storage = instance._meta.get_field(attname).storage
+    referenced: dict = instance.__dict__.setdefault("_referenced_files", {})
+    old = referenced.get(attname, "")
+    if name == old:
+        return
+    setattr(instance, attname, name)
+    if isinstance(storage, ContentAddressedMixin):
+        storage.reference(name)
+        _release(storage, old)
+    referenced[attname] = name
+
+
+def release_replaced_files(sender, instance: models.Model, update_fields=None, **kwargs) -> None:
+    """`post_save` receiver: releases the blobs the row no longer references (replaced by a saved file)."""
+    referenced: dict = instance.__dict__.setdefault("_referenced_files", {})
+    for field in _blob_fields(instance):
+        if update_fields is not None and field.name not in update_fields or field.attname not in instance.__dict__:
+            continue
+        name = _name(instance.__dict__[field.attname])
+        if name != referenced.get(field.attname, ""):
+            _release(field.storage, referenced.get(field.attname, ""))
+            referenced[field.attname] = name
+
+
+def release_files(sender, instance: models.Model, **kwargs) -> None:
+    """`post_delete` receiver: releases the blobs of the deleted row after the commit."""
+    referenced: dict = getattr(instance, "_referenced_files", {})
+    for field in _blob_fields(instance):
+        _release(field.storage, referenced.get(field.attname, ""))
+
+
 class StaticStorage(S3Boto3Storage):
     """uploads to 'mybucket/static/', serves from 'cloudfront.net/static/'"""
     location = settings.STATICFILES_LOCATION
@@ -9,10 +138,23 @@ class StaticStorage(S3Boto3Storage):
         kwargs['custom_domain'] = settings.AWS_CLOUDFRONT_DOMAIN
         super(StaticStorage, self).__init__(*args, **kwargs)
 
-class MediaStorage(S3Boto3Storage):
-    """uploads to 'mybucket/media/', serves from 'cloudfront.net/media/'"""
+class MediaStorage(ContentAddressedMixin, S3Boto3Storage):
+    """uploads to 'mybucket/media/blobs/', serves from 'cloudfront.net/media/blobs/'"""
     location = settings.MEDIAFILES_LOCATION
 
     def __init__(self, *args, **kwargs):
         kwargs['custom_domain'] = settings.AWS_CLOUDFRONT_DOMAIN
-        super(MediaStorage, self).__init__(*args, **kwargs)
\ No newline at end of file
+        super(MediaStorage, self).__init__(*args, **kwargs)
+
+    def get_object_parameters(self, name):
+        params = super().get_object_parameters(name)
+        if BLOB_NAME.search(name):
+            params.setdefault("CacheControl", BLOB_CACHE_CONTROL)  # a blob never changes
+        return params
+
+class BlobFileSystemStorage(ContentAddressedMixin, FileSystemStorage):
+    """Content-addressed blobs in `MEDIA_ROOT`, for development and tests."""
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('allow_overwrite', True)
+        super().__init__(*args, **kwargs)
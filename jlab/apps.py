@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class JlabConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'jlab'
+
+    def ready(self):
+        import jlab.signals  # noqa: F401 pylint: disable=import-outside-toplevel,unused-import
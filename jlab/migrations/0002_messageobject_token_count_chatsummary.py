@@ -0,0 +1,34 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jlab', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageobject',
+            name='token_count',
+            field=models.PositiveIntegerField(blank=True, default=None, null=True, verbose_name='Token count'),
+        ),
+        migrations.CreateModel(
+            name='ChatSummary',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('agent_type', models.CharField(max_length=25, verbose_name='Agent type')),
+                ('content', models.TextField(blank=True, default='', verbose_name='Content')),
+                ('token_count', models.PositiveIntegerField(default=0, verbose_name='Token count')),
+                ('covered_until', models.BigIntegerField(verbose_name='Covers messages up to ID')),
+                ('date_updated', models.DateTimeField(auto_now=True, verbose_name='Date updated')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='jlab.projecttask', verbose_name='Task')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('task', 'agent_type'), name='chat-summary--task-agent_type-unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jlab', '0002_messageobject_token_count_chatsummary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='taskmessage',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='jlab.taskmessage', verbose_name='Parent message (for AI replies)'),
+        ),
+    ]
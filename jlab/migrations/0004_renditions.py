@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('jlab', '0003_taskmessage_parent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='editorobject',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Renditions'),
+        ),
+        migrations.AddField(
+            model_name='messageobject',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Renditions'),
+        ),
+    ]
@@ -2,6 +2,7 @@ from django.db import models
 from django.utils.translation import gettext_lazy as _
 from rest_framework.fields import MinValueValidator
 from main.models import Agent
+from main.utils import count_tokens
 
 
 class ProjectTaskType(models.TextChoices):
@@ -76,6 +77,7 @@ class EditorObject(models.Model):
     content_type = models.CharField(_("Type"), max_length=10, choices=EditorObjectTypes.choices)
     content = models.TextField(_("Content"), default="", blank=True)
     file = models.FileField(_("File"), upload_to="jlab/editor/", null=True, blank=True)
+    renditions = models.JSONField(_("Renditions"), default=dict, blank=True, editable=False)  # see main.renditions
     is_checked = models.BooleanField(_("Is checked?"), default=False)
     order = models.PositiveIntegerField(_("Order"), default=1, validators=[MinValueValidator(1)])
     inline_styles = models.JSONField(_("Inline styles"), blank=True, null=True)
@@ -91,7 +93,7 @@ class TaskMessage(models.Model):
     date_created = models.DateTimeField(_("Date created"), auto_now_add=True)
     csat = models.BooleanField(_("CSAT Liked?"), null=True, blank=True, default=None)
     parameters = models.JSONField(_("Prompt parameters"), blank=True, null=True)
-    # parent = models.ForeignKey("self", models.SET_NULL, verbose_name=_("Parent message (for AI replies)"), null=True, blank=True)
+    parent = models.ForeignKey("self", models.SET_NULL, verbose_name=_("Parent message (for AI replies)"), null=True, blank=True)
     # objs
 
     class Meta:
@@ -103,10 +105,54 @@ class MessageObject(models.Model):
     content_type = models.CharField(_("Type"), max_length=10, choices=MessageObjectTypes.choices)
     content = models.TextField(_("Content"), default="", blank=True)
     file = models.FileField(_("File"), upload_to="jlab/ai_chat/", null=True, blank=True)
+    renditions = models.JSONField(_("Renditions"), default=dict, blank=True, editable=False)  # see main.renditions
     status = models.CharField(_("Status"), choices=MessageObjectStatuses.choices, default=MessageObjectStatuses.INITIAL, max_length=20)
     video_id = models.CharField(_("Synclab video ID"), null=True, default=None, blank=True, max_length=255)
+    token_count = models.PositiveIntegerField(_("Token count"), null=True, blank=True, default=None)
 
     class Meta:
         indexes = [
             models.Index(fields=["video_id"], condition=models.Q(video_id__isnull=False), name="message-object--video_id-index"),
         ]
+
+    _counted_content = None  # the content `token_count` was counted for
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if instance.__dict__.get("token_count") is not None:
+            instance._counted_content = instance.__dict__.get("content")
+        return instance
+
+    def update_token_count(self):
+        """Counts the tokens of the content. Call before `bulk_create`, `.save()` calls it when the content changed."""
+        self.token_count = count_tokens(self.content)
+        self._counted_content = self.content
+
+    def get_token_count(self) -> int:
+        """Stored token count, counted on the fly for objects written before the field existed."""
+        if self.token_count is None:
+            return count_tokens(self.content)
+        return self.token_count
+
+    def save(self, *args, **kwargs):
+        # a deferred content is not loaded just to be counted, it did not change
+        if "content" in self.__dict__ and (self.token_count is None or self.content != self._counted_content):
+            self.update_token_count()
+            if "content" in (kwargs.get("update_fields") or ()):
+                kwargs["update_fields"] = {*kwargs["update_fields"], "token_count"}
+        super().save(*args, **kwargs)
+
+
+class ChatSummary(models.Model):
+    task = models.ForeignKey(ProjectTask, verbose_name=_("Task"), related_name="summaries", on_delete=models.CASCADE)
+    agent_type = models.CharField(_("Agent type"), max_length=25)
+    content = models.TextField(_("Content"), default="", blank=True)
+    token_count = models.PositiveIntegerField(_("Token count"), default=0)
+    covered_until = models.BigIntegerField(_("Covers messages up to ID"))
+    date_updated = models.DateTimeField(_("Date updated"), auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["task", "agent_type"], name="chat-summary--task-agent_type-unique"),
+        ]
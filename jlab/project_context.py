@@ -0,0 +1,67 @@
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from jlab.models import Project
+
+
+@dataclass
+class ProjectContext:
+    """What the task plan prompts need from a project, cached until the project or its tasks change (`jlab.signals`)."""
+    title: str
+    deliverables: str
+    description: str
+    goal: str
+    duration: int
+    tasks: Dict[int, str] = field(default_factory=dict)  # task ID -> title
+
+    @classmethod
+    def load(cls, project_id: int) -> "ProjectContext":
+        """Builds the context with one query (a row per task). Raises `Project.DoesNotExist`."""
+        rows = Project.objects.filter(pk=project_id).values(
+            "title", "deliverables", "description", "goal", "duration", "tasks__id", "tasks__title")
+        context = None
+        for row in rows:
+            if context is None:
+                context = cls(row["title"], row["deliverables"], row["description"], row["goal"], row["duration"])
+            if row["tasks__id"] is not None:
+                context.tasks[row["tasks__id"]] = row["tasks__title"]
+        if context is None:
+            raise Project.DoesNotExist()
+        return context
+
+
+def _cache_key(project_id: int) -> str:
+    return f"project-context:{project_id}"
+
+
+def _version_key(project_id: int) -> str:
+    return f"project-context-version:{project_id}"
+
+
+def get_project_context(project_id: int) -> ProjectContext:
+    """
+        The context is kept in the process (`settings.PROJECT_CONTEXT["LOCAL_CACHE"]`) with the project's version
+        from the shared cache, which is compared at most every `settings.PROJECT_CONTEXT["CHECK_INTERVAL"]` seconds,
+        so repeated prompts of a project do not query the database.
+    """
+    config = settings.PROJECT_CONTEXT
+    local, shared = caches[config["LOCAL_CACHE"]], caches[config["CACHE"]]
+    entry: Optional[Tuple[str, float, ProjectContext]] = local.get(_cache_key(project_id))
+    now = time.monotonic()
+    if entry is not None and now - entry[1] < config["CHECK_INTERVAL"]:
+        return entry[2]
+    version = shared.get_or_set(_version_key(project_id), lambda: uuid.uuid4().hex, config["TTL"])
+    context = entry[2] if entry is not None and entry[0] == version else ProjectContext.load(project_id)
+    local.set(_cache_key(project_id), (version, now, context), config["TTL"])
+    return context
+
+
+def invalidate_project_context(project_id: int) -> None:
+    """Bumps the project's version: this process reloads the context on the next access, the others within the check interval."""
+    config = settings.PROJECT_CONTEXT
+    caches[config["CACHE"]].set(_version_key(project_id), uuid.uuid4().hex, config["TTL"])
+    caches[config["LOCAL_CACHE"]].delete(_cache_key(project_id))
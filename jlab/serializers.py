@@ -1,7 +1,11 @@
+from urllib.parse import unquote, urlsplit
+
 from django.db import transaction
 from rest_framework import serializers
 
+from custom.custom_storage import assign_file
 from main.models import Agent, AgentTypes
+from main.renditions import SrcSetField, schedule_renditions
 from jlab.models import (EditorObject, MessageObject, Project, ProjectTask,
                          TaskMessage)
 
@@ -25,13 +29,48 @@ class ProjectTaskCreateSerializer(serializers.ModelSerializer):
         }
 
 
+class StorageURLField(serializers.URLField):
+    """
+        URL of the model's file. URLs of the field's storage are saved as storage names (so the file is the
+        storage's own, e.g. it gets renditions), other URLs as they are. Storage URLs without a host (`MEDIA_URL`)
+        are on the request's host.
+    """
+
+    @property
+    def storage(self):
+        return self.parent.Meta.model._meta.get_field(self.source).storage
+
+    def run_validation(self, data=serializers.empty):
+        url = super().run_validation(data)
+        if not url:
+            return url
+        prefix = self.storage.url("x")  # the storage's URL of a name
+        request = self.context.get("request")
+        if prefix.startswith("/") and request is not None:
+            prefix = request.build_absolute_uri(prefix)
+        base = urlsplit(prefix)
+        parts = urlsplit(url)
+        if base.netloc and (base.scheme, base.netloc) == (parts.scheme, parts.netloc) \
+                and parts.path.startswith(base.path[:-1]) and parts.path != base.path[:-1]:
+            return unquote(parts.path[len(base.path) - 1:])
+        return url
+
+    def to_representation(self, value):
+        name = value.name or ""
+        if not name or "://" in name:
+            return name
+        request = self.context.get("request")
+        return request.build_absolute_uri(value.url) if request is not None else value.url
+
+
 class EditorObjectForTaskSerializer(serializers.ModelSerializer):
     delete = serializers.BooleanField(required=False, default=False, write_only=True)  # type: ignore
-    file = serializers.URLField()
+    file = StorageURLField()
+    srcset = SrcSetField()
 
     class Meta:
         model = EditorObject
-        exclude = ['task']
+        exclude = ['task', 'renditions']
         extra_kwargs = {
             'id': {'read_only': False},
         }
@@ -63,32 +102,48 @@ class ProjectTaskUpdateSerializer(serializers.ModelSerializer):
         for attr, value in validated_data.items():
             setattr(instance, attr, value)
             updated = True
-        to_create = []
+        to_create: list[tuple[EditorObject, str]] = []  # with the stored file to assign
         to_update: list[dict] = []
         to_delete: list[int] = []
         for obj_data in objs_data:
             delete = obj_data.pop("delete", False)
-            obj = EditorObject(**obj_data)
-            if delete and obj.pk is not None:
-                to_delete.append(obj.pk)
-                continue
-            if obj.pk is not None:
+            if delete and obj_data.get("id") is not None:
+                to_delete.append(obj_data["id"])
+            elif obj_data.get("id") is not None:
                 to_update.append(obj_data)
             else:
-                obj.task = instance
-                to_create.append(obj)
+                file = obj_data.pop("file", None)
+                to_create.append((EditorObject(task=instance, **obj_data), file))
         with transaction.atomic():
             if updated:
                 instance.save()
             if to_create:
-                instance.objs.bulk_create(to_create)
+                for obj, file in to_create:
+                    if file:
+                        assign_file(obj, "file", file)  # takes a reference to the stored file (`StorageURLField`)
+                created = instance.objs.bulk_create([obj for obj, _ in to_create])
+                for obj in created:
+                    schedule_renditions(EditorObject, obj)  # bulk operations do not send `post_save`
             if to_update:
-                # instance.objs.bulk_update(to_update, )
+                # One UPDATE for all objects, only the sent fields are set (the view prefetches `objs`)
+                existing = {obj.pk: obj for obj in instance.objs.all()}
+                objs = []
+                fields: set[str] = set()
                 for obj_data in to_update:
-                    EditorObject.objects.filter(
-                        pk=obj_data.pop("id"),
-                        task=instance
-                    ).update(**obj_data)
+                    obj = existing.get(obj_data.pop("id"))
+                    if obj is None:
+                        continue  # not an object of this task
+                    for attr, value in obj_data.items():
+                        if attr == "file":
+                            assign_file(obj, attr, value)
+                        else:
+                            setattr(obj, attr, value)
+                    fields.update(obj_data)
+                    objs.append(obj)
+                if objs and fields:
+                    EditorObject.objects.bulk_update(objs, list(fields))
+                    for obj in objs:
+                        schedule_renditions(EditorObject, obj, update_fields=fields)
             if to_delete:
                 EditorObject.objects.filter(
                     pk__in=to_delete,
@@ -98,9 +153,11 @@ class ProjectTaskUpdateSerializer(serializers.ModelSerializer):
 
 
 class MessageObjectListSerializer(serializers.ModelSerializer):
+    srcset = SrcSetField()
+
     class Meta:
         model = MessageObject
-        exclude = ['message']
+        exclude = ['message', 'renditions']
 
 
 class AgentShortSerializer(serializers.ModelSerializer):
@@ -141,7 +198,7 @@ class ProjectListSerializer(serializers.ModelSerializer):
 
 
 class ProjectTaskPreviewSerializer(serializers.ModelSerializer):
-    objs = serializers.HyperlinkedRelatedField(many=True, read_only=True, view_name="message_objects-detail")
+    objs = serializers.PrimaryKeyRelatedField(many=True, read_only=True)  # editor object IDs
     images = serializers.IntegerField()
     video = serializers.IntegerField()
 
@@ -176,9 +233,12 @@ class ProjectShortSerializer(serializers.ModelSerializer):
 
 
 class ProjectCreateRequestSerializer(serializers.ModelSerializer):
+    # Starts generating the plans of all tasks in the background (`ProjectViewSet.init_tasks` streams the progress)
+    generate_plans = serializers.BooleanField(required=False, default=False, write_only=True)
+
     class Meta:
         model = Project
-        fields = ['deliverables', 'description', 'goal', 'duration']
+        fields = ['deliverables', 'description', 'goal', 'duration', 'generate_plans']
 
 
 class ProjectCreateResponseSerializer(ProjectShortSerializer):
@@ -190,9 +250,11 @@ class ProjectCreateResponseSerializer(ProjectShortSerializer):
 
 
 class MessageObjectCreateSerializer(serializers.ModelSerializer):
+    srcset = SrcSetField()
+
     class Meta:
         model = MessageObject
-        exclude = ['message', 'status', 'video_id']
+        exclude = ['message', 'status', 'video_id', 'renditions']
         extra_kwargs = {
             'id': {'read_only': True}
         }
@@ -204,16 +266,20 @@ class TaskMessageCSATSerializer(serializers.ModelSerializer):
 
 class TaskMessageCreateSerializer(serializers.ModelSerializer):
     objs = MessageObjectCreateSerializer(many=True)
+    # Starts generating the answer of a text agent right away (`AiViewSet.stream` attaches to it)
+    generate = serializers.BooleanField(required=False, default=False, write_only=True)
 
     class Meta:
         model = TaskMessage
         exclude = ['task']
         extra_kwargs = {
             'id': {'read_only': True},
-            'is_answer': {'read_only': True}
+            'is_answer': {'read_only': True},
+            'parent': {'read_only': True},
         }
 
     def create(self, validated_data):
+        validated_data.pop('generate', None)
         objs_data: list[dict] = validated_data.pop('objs', [])
         instance = super().create(validated_data)
         to_create = []
@@ -221,7 +287,10 @@ class TaskMessageCreateSerializer(serializers.ModelSerializer):
         for obj_data in objs_data:
             obj = MessageObject(**obj_data)
             obj.message = instance
+            obj.update_token_count()
             to_create.append(obj)
         if to_create:
             instance.objs.bulk_create(to_create)
+            for obj in to_create:
+                schedule_renditions(MessageObject, obj)  # bulk operations do not send `post_save`
         return instance
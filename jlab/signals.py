@@ -0,0 +1,34 @@
+from functools import partial
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from custom.custom_storage import release_files, release_replaced_files, track_files
+from jlab.models import EditorObject, MessageObject, Project, ProjectTask
+from jlab.project_context import invalidate_project_context
+from main.renditions import remove_renditions, schedule_renditions
+
+
+@receiver([post_save, post_delete], sender=Project)
+def invalidate_project(sender, instance: Project, **kwargs):
+    transaction.on_commit(partial(invalidate_project_context, instance.pk))
+
+
+@receiver([post_save, post_delete], sender=ProjectTask)
+def invalidate_project_task(sender, instance: ProjectTask, **kwargs):
+    # Bulk operations do not send signals, call `invalidate_project_context` after them
+    transaction.on_commit(partial(invalidate_project_context, instance.project_id))
+
+
+# Images uploaded to the editor and generated images (the serializers' bulk writes call `schedule_renditions`)
+post_save.connect(schedule_renditions, sender=EditorObject)
+post_save.connect(schedule_renditions, sender=MessageObject)
+post_delete.connect(remove_renditions, sender=EditorObject)
+post_delete.connect(remove_renditions, sender=MessageObject)
+
+# Content-addressed files are shared, they are deleted with their last reference
+for model in (EditorObject, MessageObject):
+    post_init.connect(track_files, sender=model)
+    post_save.connect(release_replaced_files, sender=model)
+    post_delete.connect(release_files, sender=model)
@@ -1,3 +1,435 @@
-from django.test import TestCase
+import io
+import tempfile
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from openai.types.chat import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice, ChoiceDelta
+from PIL import Image
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from main.api import StreamAgentAPI
+from main.models import Agent, AgentTypes, MediaBlob
+from main.renditions import build_renditions, submit
+from main.streams import streams
+from jlab.models import (
+    EditorObject,
+    EditorObjectTypes,
+    MessageObject,
+    MessageObjectTypes,
+    Project,
+    ProjectTask,
+    TaskMessage,
+)
+from jlab.project_context import get_project_context
+from jlab.serializers import TaskMessageCreateSerializer
+from jlab.utils import ProjectMetadataStreamParser, ProjectTaskStreamParser, project_plan_stream
+from jlab.views import ProjectTaskViewSet, ProjectViewSet
+
+USER = {"user_id": "1", "email": "user@example.com", "subscriptions": []}
+TOKEN = {"subscriptions": [{"expires": "2100-01-01 00:00:00"}]}
+
+
+class QueryBudgetTest(TestCase):
+    """
+        Every action has a query budget, and its query count must not grow with the number of rows:
+        each action is run against a small and a large project and both counts are compared.
+    """
+    SIZES = (2, 12)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = Agent.objects.create(
+            type=AgentTypes.TEXT, name="Writer", sys_template="You are a writer.", user_template="{main_field}")
+
+    def seed(self, size: int) -> ProjectTask:
+        """A project with `size` tasks, the first one with `size` editor objects and `size` chat turns."""
+        project = Project.objects.create(user_id=USER["user_id"], user_email=USER["email"])
+        tasks = ProjectTask.objects.bulk_create([ProjectTask(project=project, title=f"Task {i}") for i in range(size)])
+        task = tasks[0]
+        EditorObject.objects.bulk_create([
+            EditorObject(task=task, content_type=EditorObjectTypes.CHECKBOX, content=f"Subtask {i}", order=i + 1)
+            for i in range(size)
+        ])
+        for i in range(size):
+            for is_answer in (False, True):
+                message = TaskMessage.objects.create(task=task, agent=self.agent, is_answer=is_answer, parameters={})
+                MessageObject.objects.bulk_create([
+                    MessageObject(message=message, content_type=MessageObjectTypes.TEXT, content=f"Text {i}"),
+                    MessageObject(message=message, content_type=MessageObjectTypes.QUOTE, content=f"Quote {i}"),
+                ])
+        return task
+
+    def count_queries(self, viewset, actions: dict, method: str, path: str, pk=None, data=None) -> int:
+        request = getattr(APIRequestFactory(), method)(path, data, format="json")
+        force_authenticate(request, user=USER, token=TOKEN)
+        view = viewset.as_view(actions)
+        with CaptureQueriesContext(connection) as queries:
+            response = view(request, pk=pk)
+            response.render()
+        self.assertLess(response.status_code, 300, response.data)
+        return len(queries)
+
+    def assertQueryBudget(self, budget: int, run) -> None:
+        """`run(task)` performs the action for the seeded task and returns its query count."""
+        counts = []
+        for size in self.SIZES:
+            Project.objects.all().delete()
+            counts.append(run(self.seed(size)))
+        self.assertEqual(counts[0], counts[-1], f"The query count grows with the rows: {counts}")
+        self.assertLessEqual(counts[-1], budget)
+
+    def test_project_list(self):
+        self.assertQueryBudget(3, lambda task: self.count_queries(
+            ProjectViewSet, {"get": "list"}, "get", "/projects/"))
+
+    def test_project_retrieve(self):
+        self.assertQueryBudget(3, lambda task: self.count_queries(
+            ProjectViewSet, {"get": "retrieve"}, "get", f"/projects/{task.project_id}/", pk=task.project_id))
+
+    def test_project_task_retrieve(self):
+        self.assertQueryBudget(2, lambda task: self.count_queries(
+            ProjectTaskViewSet, {"get": "retrieve"}, "get", f"/tasks/{task.pk}/", pk=task.pk))
+
+    def test_project_task_messages_list(self):
+        self.assertQueryBudget(4, lambda task: self.count_queries(
+            ProjectTaskViewSet, {"get": "messages_list"}, "get", f"/tasks/{task.pk}/messages/?type=text", pk=task.pk))
+
+    def test_project_task_update(self):
+        def run(task):
+            objs = [
+                {"id": obj.pk, "content_type": obj.content_type, "content": "Done", "is_checked": True, "order": obj.order}
+                for obj in task.objs.all()
+            ]
+            objs.append({"content_type": EditorObjectTypes.TEXT, "content": "New", "order": len(objs) + 1})
+            return self.count_queries(
+                ProjectTaskViewSet, {"patch": "partial_update"}, "patch", f"/tasks/{task.pk}/",
+                pk=task.pk, data={"objs": objs})
+
+        self.assertQueryBudget(8, run)
+        self.assertFalse(EditorObject.objects.filter(content_type=EditorObjectTypes.CHECKBOX, is_checked=False).exists())
+
+
+class ProjectCreateTest(TestCase):
+    def test_tasks_are_inserted_at_once_and_side_effects_run_after_commit(self):
+        request = APIRequestFactory().post(
+            "/projects/", {"description": "Product launch", "generate_plans": True}, format="json")
+        force_authenticate(request, user=USER, token=TOKEN)
+        generated = {"title": "Launch", "tasks": ["Logo", "Landing page", "Copy"]}
+        with mock.patch("jlab.views.get_project_metadata", return_value=generated), \
+                mock.patch("jlab.views.run_in_background") as run_in_background, \
+                mock.patch("jlab.views.project_plan_stream") as project_plan_stream, \
+                mock.patch("jlab.views.streams") as streams_:
+            with self.captureOnCommitCallbacks() as callbacks, CaptureQueriesContext(connection) as queries:
+                response = ProjectViewSet.as_view({"post": "create"})(request)
+            run_in_background.assert_not_called()
+            streams_.start.assert_not_called()
+            for callback in callbacks:
+                callback()
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual([task["title"] for task in response.data["project"]["tasks"]], generated["tasks"])
+        inserts = [query["sql"] for query in queries if query["sql"].startswith("INSERT")]
+        self.assertEqual(len(inserts), 2)  # the project, then all its tasks
+        project = Project.objects.get(pk=response.data["project"]["id"])
+        self.assertEqual((project.user_email, project.description), (USER["email"], "Product launch"))
+        run_in_background.assert_called_once()
+        tasks = project_plan_stream.call_args.args[1]
+        self.assertEqual([task.title for task in tasks], generated["tasks"])
+        streams_.start.assert_called_once_with(
+            ("init_tasks", project.pk), project_plan_stream.return_value, cancellable=False)
+
+
+class MessageObjectTokenCountTest(TestCase):
+    def test_tokens_are_counted_when_the_content_changes(self):
+        agent = Agent.objects.create(type=AgentTypes.TEXT, name="Writer", sys_template="", user_template="{main_field}")
+        project = Project.objects.create(user_id=USER["user_id"], user_email=USER["email"])
+        message = TaskMessage.objects.create(task=ProjectTask.objects.create(project=project), agent=agent)
+        with mock.patch("jlab.models.count_tokens", return_value=3) as count_tokens:
+            obj = MessageObject.objects.create(message=message, content_type=MessageObjectTypes.TEXT, content="Hi")
+            obj = MessageObject.objects.get(pk=obj.pk)
+            obj.status = "done"
+            obj.save()
+            self.assertEqual(count_tokens.call_count, 1)
+            obj.content = "Hello"
+            obj.save(update_fields=["content"])
+            self.assertEqual(count_tokens.call_count, 2)
+            MessageObject.objects.filter(pk=obj.pk).update(token_count=None)  # written before the field existed
+            obj = MessageObject.objects.get(pk=obj.pk)
+            obj.save()
+            self.assertEqual(count_tokens.call_count, 3)
+        self.assertEqual(MessageObject.objects.get(pk=obj.pk).token_count, 3)
+
+
+class EditorObjectFilesTest(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(
+            MEDIA_ROOT=media_root.name, MEDIA_URL="/media/", ALLOWED_HOSTS=["api.example.com"]))
+        self.task = ProjectTask.objects.create(
+            project=Project.objects.create(user_id=USER["user_id"], user_email=USER["email"]), title="Post")
+        self.storage = EditorObject._meta.get_field("file").storage
+
+    def upload(self, name: str, width: int) -> str:
+        buffer = io.BytesIO()
+        Image.new("RGB", (width, 400), "teal").save(buffer, "PNG")
+        return self.storage.save(name, ContentFile(buffer.getvalue()))
+
+    def patch(self, objs: list) -> list:
+        request = APIRequestFactory(SERVER_NAME="api.example.com").patch(
+            f"/tasks/{self.task.pk}/", {"objs": objs}, format="json")
+        force_authenticate(request, user=USER, token=TOKEN)
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            response = ProjectTaskViewSet.as_view({"patch": "partial_update"})(request, pk=self.task.pk)
+        self.assertEqual(response.status_code, 200, response.data)
+        return [callback.args for callback in callbacks if getattr(callback, "func", None) is submit]
+
+    def test_uploaded_images_get_renditions(self):
+        name = self.upload("jlab/editor/photo.png", 800)
+        url = f"http://api.example.com{self.storage.url(name)}"
+        scheduled = self.patch([
+            {"content_type": EditorObjectTypes.IMAGE, "file": url, "order": 1},
+            {"content_type": EditorObjectTypes.IMAGE, "file": "https://example.com/photo.png", "order": 2},
+        ])
+        image, external = EditorObject.objects.filter(task=self.task)
+        self.assertEqual((image.file.name, external.file.name), (name, "https://example.com/photo.png"))
+        self.assertEqual(scheduled, [(build_renditions, EditorObject, image.pk)])
+
+        build_renditions(EditorObject, image.pk)
+        request = APIRequestFactory(SERVER_NAME="api.example.com").get(f"/tasks/{self.task.pk}/")
+        force_authenticate(request, user=USER, token=TOKEN)
+        response = ProjectTaskViewSet.as_view({"get": "retrieve"})(request, pk=self.task.pk)
+        objs = response.data["objs"]
+        self.assertEqual([obj["file"] for obj in objs], [url, "https://example.com/photo.png"])
+        self.assertEqual(objs[0]["srcset"]["webp"].count("w, "), 2)  # 320, 640 and 800
+        self.assertEqual(objs[1]["srcset"], {})
+
+        # Replaced by another image, an unchanged one is not rebuilt
+        other = self.upload("jlab/editor/other.png", 500)
+        scheduled = self.patch([
+            {"id": image.pk, "content_type": EditorObjectTypes.IMAGE, "order": 1,
+             "file": f"http://api.example.com{self.storage.url(other)}"},
+            {"id": external.pk, "content_type": EditorObjectTypes.IMAGE, "content": "Caption", "order": 2},
+        ])
+        self.assertEqual(scheduled, [(build_renditions, EditorObject, image.pk)])
+
+    def test_uploaded_message_images_get_renditions(self):
+        agent = Agent.objects.create(type=AgentTypes.IMAGE, name="Painter")
+        buffer = io.BytesIO()
+        Image.new("RGB", (400, 400), "teal").save(buffer, "PNG")
+        serializer = TaskMessageCreateSerializer(data={"agent": agent.pk, "objs": [
+            {"content_type": MessageObjectTypes.IMAGE, "file": SimpleUploadedFile("photo.png", buffer.getvalue())},
+            {"content_type": MessageObjectTypes.TEXT, "content": "Like this"},
+        ]})
+        serializer.is_valid(raise_exception=True)
+        with self.captureOnCommitCallbacks(execute=False) as callbacks:
+            message = serializer.save(task=self.task)
+        image = message.objs.get(content_type=MessageObjectTypes.IMAGE)
+        self.assertEqual([callback.args for callback in callbacks if getattr(callback, "func", None) is submit],
+                         [(build_renditions, MessageObject, image.pk)])
+
+    def test_referenced_files_outlive_the_rows_referencing_them(self):
+        agent = Agent.objects.create(type=AgentTypes.IMAGE, name="Painter")
+        message = TaskMessage.objects.create(task=self.task, agent=agent)
+        upload = MessageObject(message=message, content_type=MessageObjectTypes.IMAGE)
+        upload.file.save("photo.png", ContentFile(b"not an image"))
+        name = upload.file.name
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 1)
+
+        # Another user's editor object refers to the file by its URL
+        with self.captureOnCommitCallbacks(execute=True):
+            self.patch([{"content_type": EditorObjectTypes.IMAGE, "order": 1,
+                         "file": f"http://api.example.com{self.storage.url(name)}"}])
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 2)
+        with self.captureOnCommitCallbacks(execute=True):
+            EditorObject.objects.get(task=self.task).delete()
+        self.assertEqual(MediaBlob.objects.get(name=name).refcount, 1)
+        self.assertTrue(self.storage.exists(name))
+
+        # Replaced files are released
+        other = MessageObject.objects.get(pk=upload.pk)
+        with self.captureOnCommitCallbacks(execute=True):
+            other.file.save("other.png", ContentFile(b"other bytes"))
+        self.assertFalse(MediaBlob.objects.filter(name=name).exists())
+        self.assertFalse(self.storage.exists(name))
+
+
+class SpeculativeAnswerTest(TransactionTestCase):
+    """`generate` starts the answer of a posted message in the background, the request does not wait for OpenAI."""
+
+    def setUp(self):
+        self.agent = Agent.objects.create(
+            type=AgentTypes.TEXT, name="Writer", sys_template="You are a writer.", user_template="{main_field}")
+        self.task = ProjectTask.objects.create(
+            project=Project.objects.create(user_id=USER["user_id"], user_email=USER["email"]), title="Chat")
+
+    @staticmethod
+    def completion(*args, **kwargs):
+        time.sleep(0.5)  # the time to the first token, `StartedStream` waits for it
+        return iter([
+            ChatCompletionChunk(
+                id="chatcmpl-1", choices=[Choice(index=0, delta=ChoiceDelta(content="Hello"), finish_reason=None)],
+                created=0, model="gpt-4o", object="chat.completion.chunk"),
+            ChatCompletionChunk(
+                id="chatcmpl-1", choices=[Choice(index=0, delta=ChoiceDelta(), finish_reason="stop")],
+                created=0, model="gpt-4o", object="chat.completion.chunk"),
+        ])
+
+    def test_post_returns_before_the_first_token(self):
+        request = APIRequestFactory().post(f"/tasks/{self.task.pk}/messages/", {
+            "agent": self.agent.pk, "generate": True,
+            "objs": [{"content_type": MessageObjectTypes.TEXT, "content": "Write a slogan"}],
+        }, format="json")
+        force_authenticate(request, user=USER, token=TOKEN)
+        with mock.patch("main.base_api.generate_chat_completion", self.completion), \
+                mock.patch("main.api.create_update_user_onboarding_task"):
+            started = time.monotonic()
+            response = ProjectTaskViewSet.as_view({"post": "messages"})(request, pk=self.task.pk)
+            elapsed = time.monotonic() - started
+            self.assertEqual(response.status_code, 201, response.data)
+            buffer = streams.get(("stream", self.task.pk, response.data["id"], self.agent.pk))
+            frames = list(buffer.iter_from(0))
+        self.assertLess(elapsed, 0.4)
+        self.assertIn(b"id: 1\ndata: Hello\n\n", frames)
+        self.assertTrue(MessageObject.objects.filter(message__parent_id=response.data["id"], content="Hello").exists())
+
+
+class ProjectContextTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.project = Project.objects.create(user_id="1", user_email="user@example.com", title="Launch")
+        cls.tasks = [ProjectTask.objects.create(project=cls.project, title=f"Task {i}") for i in range(5)]
+
+    def test_cached_until_a_task_changes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.tasks[0].save()  # the cached context is dropped
+        with CaptureQueriesContext(connection) as queries:
+            context = get_project_context(self.project.pk)
+        loads = [query for query in queries if "jlab_project" in query["sql"]]
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(context.tasks, {task.pk: task.title for task in self.tasks})
+        with CaptureQueriesContext(connection) as queries:
+            get_project_context(self.project.pk)
+        self.assertFalse([query for query in queries if "jlab_project" in query["sql"]])
+        with self.captureOnCommitCallbacks(execute=True):
+            ProjectTask.objects.create(project=self.project, title="Invoice")
+        self.assertIn("Invoice", get_project_context(self.project.pk).tasks.values())
+
+    def test_cached_in_the_process(self):
+        get_project_context(self.project.pk)
+        with self.assertNumQueries(0):
+            get_project_context(self.project.pk)
+        # Another process changed a task: the version is compared after the check interval
+        caches[settings.PROJECT_CONTEXT["CACHE"]].set(f"project-context-version:{self.project.pk}", "changed")
+        ProjectTask.objects.filter(pk=self.tasks[0].pk).update(title="Renamed")
+        with self.assertNumQueries(0):
+            self.assertEqual(get_project_context(self.project.pk).tasks[self.tasks[0].pk], "Task 0")
+        with override_settings(PROJECT_CONTEXT={**settings.PROJECT_CONTEXT, "CHECK_INTERVAL": 0}):
+            self.assertEqual(get_project_context(self.project.pk).tasks[self.tasks[0].pk], "Renamed")
+            with self.assertNumQueries(1):  # the version, the context is not loaded again
+                get_project_context(self.project.pk)
+
+    def test_saved_chat_title_drops_the_cached_context(self):
+        get_project_context(self.project.pk)
+        agent = Agent.objects.create(type=AgentTypes.TEXT, name="Writer")
+        api = StreamAgentAPI(TaskMessage(task=self.tasks[1], is_answer=True, agent=agent))
+        with mock.patch.object(StreamAgentAPI, "get_title", return_value="Press kit"):
+            api.save_title(None)
+        self.assertEqual(get_project_context(self.project.pk).tasks[self.tasks[1].pk], "Press kit")
+
+
+class ProjectMetadataStreamParserTest(SimpleTestCase):
+    completion = '{\n  "title": "Brand \\"Nova\\" launch",\n  "tasks": ["Logo", "Landing page, copy", "Client updates"]\n}'
+
+    def test_titles_are_returned_as_they_close(self):
+        parser = ProjectMetadataStreamParser()
+        events = []
+        for i, char in enumerate(self.completion):
+            for event in parser.feed(char):
+                events.append((i, event))
+        self.assertEqual([event for _, event in events], [
+            ("title", 'Brand "Nova" launch'),
+            ("task", "Logo"),
+            ("task", "Landing page, copy"),
+            ("task", "Client updates"),
+        ])
+        # Each title is returned with the chunk that closes it
+        self.assertEqual(events[1][0], self.completion.index('Logo"') + 4)
+
+    def test_keys_in_any_order(self):
+        parser = ProjectMetadataStreamParser()
+        self.assertEqual(parser.feed('{"tasks": ["A"], "title": "T"}'), [("task", "A"), ("title", "T")])
+
+    def test_raw_control_characters_and_invalid_escapes(self):
+        parser = ProjectMetadataStreamParser()
+        self.assertEqual(parser.feed('{"title": "Spring\nlaunch", "tasks": ["Tab\there", "C:\\x"]}'), [
+            ("title", "Spring\nlaunch"), ("task", "Tab\there"), ("task", "C:\\x")])
+
+
+class ProjectTaskStreamParserTest(SimpleTestCase):
+    def parse(self, chunks):
+        parser = ProjectTaskStreamParser(ProjectTask(title="Task"))
+        objs = [obj for chunk in chunks for obj in parser.feed(chunk)] + parser.close()
+        return [(obj.content_type, obj.content) for obj in objs]
+
+    def test_lines_split_across_chunks(self):
+        expected = [
+            (EditorObjectTypes.TEXT, "Write the brief."),
+            (EditorObjectTypes.CHECKBOX, "Research"),
+            (EditorObjectTypes.CHECKBOX, "Draft"),
+        ]
+        text = "Write the brief.\n\n* Research\n* Draft"
+        self.assertEqual(self.parse([text]), expected)
+        self.assertEqual(self.parse(list(text)), expected)
+        self.assertEqual(self.parse(["Write the", " brief.", "\n\n*", " Research\n* Dr", "aft\n"]), expected)
+
+
+class ProjectPlanStreamTest(TransactionTestCase):
+    """The plans of a project's tasks are generated concurrently: the stream takes about as long as the slowest task."""
+
+    def setUp(self):
+        self.project = Project.objects.create(user_id="1", user_email="user@example.com")
+        self.tasks = [ProjectTask.objects.create(project=self.project, title=f"Task {i}") for i in range(6)]
+
+    def task_generator(self, context, task_id):
+        # Tasks of different lengths, the slowest one takes 0.6s (all of them in sequence 2.4s)
+        delay = 0.05 + 0.02 * [task.pk for task in self.tasks].index(task_id)
+        for text in ["Description\n", "* First\n", "* Second\n", ""]:
+            time.sleep(delay)
+            yield ChatCompletionChunk(
+                id="chatcmpl-1",
+                choices=[Choice(index=0, delta=ChoiceDelta(content=text), finish_reason=None)],
+                created=0,
+                model="gpt-4o",
+                object="chat.completion.chunk",
+            )
+        yield ChatCompletionChunk(
+            id="chatcmpl-1",
+            choices=[Choice(index=0, delta=ChoiceDelta(), finish_reason="stop")],
+            created=0,
+            model="gpt-4o",
+            object="chat.completion.chunk",
+        )
+
+    @override_settings(PLAN_CONCURRENCY=6)
+    def test_tasks_are_generated_concurrently(self):
+        with mock.patch("jlab.utils.get_project_task_generator", self.task_generator):
+            started = time.monotonic()
+            frames = list(project_plan_stream(self.project, self.tasks))
+            elapsed = time.monotonic() - started
+        self.assertLess(elapsed, 1.2)
+        done = [frame for frame in frames if frame.startswith(b"event: done")]
+        self.assertEqual(len(done), 6)
+        self.assertEqual(frames[-1], b"data: Stop\0\n\n")
+        for task in self.tasks:
+            self.assertEqual(
+                list(EditorObject.objects.filter(task=task).values_list("content_type", flat=True)),
+                [EditorObjectTypes.TEXT, EditorObjectTypes.CHECKBOX, EditorObjectTypes.CHECKBOX],
+            )
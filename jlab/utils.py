@@ -1,8 +1,18 @@
+import asyncio
 import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import httpx
-from typing import List
+from typing import List, Optional, Tuple
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.db import close_old_connections, transaction
 from openai import (
+    AsyncStream,
     OpenAI,
     Stream
 )
@@ -18,58 +28,411 @@ from jlab.models import (
     Project, 
     ProjectTask,
 )
-from main.utils import generate_chat_completion
-from jlab.serializers import ProjectFullSerializer
+from main.cache import is_replay
+from main.metrics import record_cancelled_stream, record_completed_stream
+from main.sse import FrameCoalescer, multiline_frame
+from main.streams import aclose_upstream, close_upstream
+from main.utils import agenerate_chat_completion, generate_chat_completion
+from jlab.project_context import ProjectContext, get_project_context
+from jlab.serializers import ProjectShortSerializer, ProjectTaskShortSerializer
+
+
+class ProjectTaskStreamParser:
+    """
+        Turns streamed task plan chunks into (unsaved) EditorObjects:
+        the first line is the task description, every next line is a subtask checkbox.
+        Chunks are split into lines on a rolling buffer, so newlines may fall anywhere in (or between) chunks.
+    """
+
+    def __init__(self, task: ProjectTask) -> None:
+        self.task = task
+        self.buffer = ''
+        self.has_description = False
+
+    def _parse_line(self, line: str) -> Optional[EditorObject]:
+        line = line.strip()
+        if not line:
+            return None
+        if not self.has_description:
+            self.has_description = True
+            return EditorObject(task=self.task, content_type=EditorObjectTypes.TEXT, content=line)
+        return EditorObject(
+            task=self.task, content_type=EditorObjectTypes.CHECKBOX, content=line.removeprefix("*").strip())
+
+    def feed(self, chunk_text: str) -> List[EditorObject]:
+        """Returns the objects of the lines completed by `chunk_text`."""
+        self.buffer += chunk_text
+        if '\n' not in chunk_text:
+            return []
+        *lines, self.buffer = self.buffer.split('\n')
+        return [obj for line in lines if (obj := self._parse_line(line))]
+
+    def close(self) -> List[EditorObject]:
+        """Returns the object of the last line (which has no trailing newline)."""
+        line, self.buffer = self.buffer, ''
+        obj = self._parse_line(line)
+        return [obj] if obj else []
+
+
+def save_editor_objects(objs: List[EditorObject]) -> None:
+    """Writes parsed EditorObjects with one INSERT."""
+    if objs:
+        with transaction.atomic():
+            EditorObject.objects.bulk_create(objs)
 
 
 def project_task_stream(project: Project, task_id: int):
     task = ProjectTask.objects.get(pk=task_id)
-    metadata: dict = ProjectFullSerializer(project).data  # type: ignore
-    state = 0
-    content = ''
-    next_task = False
-    for chunk in get_project_task_generator(metadata, task_id):  # pylint: disable=not-an-iterable
-        answer = chunk.choices[0]
-        if answer.finish_reason:
-            break
-        chunk_text: str = answer.delta.content or ""
-        if chunk_text.find('\n') != -1:
-            if state == 0:
-                state = 1
-            elif state == 2:
-                next_task = True
-        match state:
-            case 0:
-                content += chunk_text
-            case 1:
-                EditorObject.objects.create(
-                    task=task,
-                    content_type=EditorObjectTypes.TEXT,
-                    content=content
-                )
-                state = 2
-                content = ''
-            case 2 if next_task:
-                EditorObject.objects.create(
-                    task=task,
-                    content_type=EditorObjectTypes.CHECKBOX,
-                    content=content.replace("\n", "").removeprefix("*")
-                )
-                next_task = False
-                content = ''
-            case 2:
-                content += chunk_text
-        yield (f'data: {chunk_text}\n\n').encode()
+    context = get_project_context(project.pk)
+    parser = ProjectTaskStreamParser(task)
+    coalescer = FrameCoalescer(formatter=multiline_frame)
+    generator = get_project_task_generator(context, task_id)
+    parts: List[str] = []
+    # Parsed objects are written in batches every `settings.SSE_CHECKPOINT_INTERVAL` seconds and at the end
+    pending: List[EditorObject] = []
+    saved_at = time.monotonic()
+    try:
+        for chunk in generator:  # pylint: disable=not-an-iterable
+            answer = chunk.choices[0]
+            if answer.finish_reason:
+                break
+            chunk_text: str = answer.delta.content or ""
+            parts.append(chunk_text)
+            pending += parser.feed(chunk_text)
+            if pending and time.monotonic() - saved_at >= settings.SSE_CHECKPOINT_INTERVAL:
+                save_editor_objects(pending)
+                pending, saved_at = [], time.monotonic()
+            if frame := coalescer.push(chunk_text):
+                yield frame
+        save_editor_objects(pending + parser.close())
+        pending = []
+        if frame := coalescer.flush():
+            yield frame
+    except GeneratorExit:
+        # The client is gone: stop generating, keep the complete lines parsed so far
+        close_upstream(generator)
+        save_editor_objects(pending)
+        record_cancelled_stream("init_task", "".join(parts), is_replay(generator))
+        raise
+    record_completed_stream("init_task", "".join(parts), is_replay(generator))
     yield ('data: Stop\0\n\n').encode()
 
 
-def get_project_metadata(form_data: dict):
-    """Generates project title and titles for its tasks from the provided information
+async def aproject_task_stream(project: Project, task_id: int):
+    """Async counterpart of `project_task_stream` for ASGI: ORM calls are offloaded to a thread."""
+    task = await ProjectTask.objects.aget(pk=task_id)
+    context = await sync_to_async(get_project_context)(project.pk)
+    parser = ProjectTaskStreamParser(task)
+    generator = await aget_project_task_generator(context, task_id)
+    coalescer = FrameCoalescer(formatter=multiline_frame)
+    parts: List[str] = []
+    pending: List[EditorObject] = []
+    saved_at = time.monotonic()
+    try:
+        async for chunk in generator:
+            answer = chunk.choices[0]
+            if answer.finish_reason:
+                break
+            chunk_text: str = answer.delta.content or ""
+            parts.append(chunk_text)
+            pending += parser.feed(chunk_text)
+            if pending and time.monotonic() - saved_at >= settings.SSE_CHECKPOINT_INTERVAL:
+                await sync_to_async(save_editor_objects)(pending)
+                pending, saved_at = [], time.monotonic()
+            if frame := coalescer.push(chunk_text):
+                yield frame
+        await sync_to_async(save_editor_objects)(pending + parser.close())
+        pending = []
+        if frame := coalescer.flush():
+            yield frame
+    except (GeneratorExit, asyncio.CancelledError):
+        await aclose_upstream(generator)
+        await sync_to_async(save_editor_objects)(pending)
+        record_cancelled_stream("init_task", "".join(parts), is_replay(generator))
+        raise
+    record_completed_stream("init_task", "".join(parts), is_replay(generator))
+    yield ('data: Stop\0\n\n').encode()
 
-    :param data: form data submitted by the user
-    :type data: dict
-    :return: dictionary with metadata
-    :rtype: dict
+
+def task_frame(task_id: int, text: str) -> bytes:
+    """SSE frame of one task's text in a multiplexed plan stream."""
+    return f'event: task-{task_id}\n'.encode() + multiline_frame(text)
+
+
+def project_plan_stream(project: Project, tasks: List[ProjectTask]):
+    """
+        Generates the plans (description and subtasks) of several tasks concurrently, at most `settings.PLAN_CONCURRENCY`
+        at a time, and multiplexes them into one SSE stream. The text of a task is sent as `event: task-<id>`,
+        once its EditorObjects are saved `event: done` (or `event: error`) is sent with the task ID,
+        `data: Stop` ends the stream. Closing the stream cancels the generations that are still running.
+    """
+    context = get_project_context(project.pk)
+    events: queue.Queue = queue.Queue()
+    cancelled = threading.Event()
+
+    def generate(task: ProjectTask) -> None:
+        close_old_connections()
+        parser = ProjectTaskStreamParser(task)
+        objs: List[EditorObject] = []
+        parts: List[str] = []
+        try:
+            generator = get_project_task_generator(context, task.pk)
+            for chunk in generator:  # pylint: disable=not-an-iterable
+                if cancelled.is_set():
+                    close_upstream(generator)
+                    record_cancelled_stream("init_task", "".join(parts), is_replay(generator))
+                    return
+                answer = chunk.choices[0]
+                if answer.finish_reason:
+                    break
+                chunk_text: str = answer.delta.content or ""
+                parts.append(chunk_text)
+                objs += parser.feed(chunk_text)
+                events.put((task.pk, "text", chunk_text))
+            save_editor_objects(objs + parser.close())
+            record_completed_stream("init_task", "".join(parts), is_replay(generator))
+            events.put((task.pk, "done", ""))
+        except Exception as e:  # pylint: disable=broad-except
+            logging.exception(e)
+            events.put((task.pk, "error", ""))
+        finally:
+            close_old_connections()
+
+    coalescers = {task.pk: FrameCoalescer(formatter=partial(task_frame, task.pk)) for task in tasks}
+    executor = ThreadPoolExecutor(max_workers=min(len(tasks), settings.PLAN_CONCURRENCY), thread_name_prefix="plan")
+    for task in tasks:
+        executor.submit(generate, task)
+    try:
+        running = len(tasks)
+        while running:
+            task_id, kind, text = events.get()
+            if kind == "text":
+                if frame := coalescers[task_id].push(text):
+                    yield frame
+                continue
+            running -= 1
+            if frame := coalescers[task_id].flush():
+                yield frame
+            yield f'event: {kind}\ndata: {task_id}\n\n'.encode()
+        yield ('data: Stop\0\n\n').encode()
+    finally:
+        cancelled.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def aproject_plan_stream(project: Project, tasks: List[ProjectTask]):
+    """Async counterpart of `project_plan_stream`: the generations are tasks on the event loop."""
+    context = await sync_to_async(get_project_context)(project.pk)
+    events: asyncio.Queue = asyncio.Queue()
+    semaphore = asyncio.Semaphore(settings.PLAN_CONCURRENCY)
+
+    async def generate(task: ProjectTask) -> None:
+        parser = ProjectTaskStreamParser(task)
+        objs: List[EditorObject] = []
+        parts: List[str] = []
+        generator = None
+        async with semaphore:
+            try:
+                generator = await aget_project_task_generator(context, task.pk)
+                async for chunk in generator:
+                    answer = chunk.choices[0]
+                    if answer.finish_reason:
+                        break
+                    chunk_text: str = answer.delta.content or ""
+                    parts.append(chunk_text)
+                    objs += parser.feed(chunk_text)
+                    events.put_nowait((task.pk, "text", chunk_text))
+                await sync_to_async(save_editor_objects)(objs + parser.close())
+                record_completed_stream("init_task", "".join(parts), is_replay(generator))
+                events.put_nowait((task.pk, "done", ""))
+            except asyncio.CancelledError:
+                if generator is not None:
+                    await aclose_upstream(generator)
+                record_cancelled_stream("init_task", "".join(parts), is_replay(generator))
+                raise
+            except Exception as e:  # pylint: disable=broad-except
+                logging.exception(e)
+                events.put_nowait((task.pk, "error", ""))
+
+    coalescers = {task.pk: FrameCoalescer(formatter=partial(task_frame, task.pk)) for task in tasks}
+    workers = [asyncio.ensure_future(generate(task)) for task in tasks]
+    try:
+        running = len(tasks)
+        while running:
+            task_id, kind, text = await events.get()
+            if kind == "text":
+                if frame := coalescers[task_id].push(text):
+                    yield frame
+                continue
+            running -= 1
+            if frame := coalescers[task_id].flush():
+                yield frame
+            yield f'event: {kind}\ndata: {task_id}\n\n'.encode()
+        yield ('data: Stop\0\n\n').encode()
+    finally:
+        for worker in workers:
+            worker.cancel()
+
+
+class ProjectMetadataStreamParser:
+    """
+        Incremental parser of the streamed project metadata JSON (`{"title": str, "tasks": [str, ...]}`,
+        see `get_project_metadata_messages`). Returns `("title", title)` and `("task", title)` as soon as
+        the string literal is closed, whatever the chunk boundaries and the order of the keys.
+    """
+
+    def __init__(self) -> None:
+        self.stack: List[str] = []
+        self.key = ''
+        self.expecting_key = False
+        self.in_string = False
+        self.escape = False
+        self.literal: List[str] = []
+
+    def _close_string(self) -> Optional[Tuple[str, str]]:
+        literal = "".join(self.literal)
+        try:
+            # Models sometimes put raw newlines or tabs in the strings
+            value: str = json.loads('"' + literal + '"', strict=False)
+        except json.JSONDecodeError:  # e.g. an invalid escape
+            value = literal
+        if self.stack == ['{'] and self.expecting_key:
+            self.key = value
+        elif self.stack == ['{'] and self.key == 'title':
+            return ("title", value)
+        elif self.stack == ['{', '['] and self.key == 'tasks':
+            return ("task", value)
+        return None
+
+    def feed(self, chunk_text: str) -> List[Tuple[str, str]]:
+        events = []
+        for char in chunk_text:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+                    if event := self._close_string():
+                        events.append(event)
+                    continue
+                self.literal.append(char)
+            elif char == '"':
+                self.in_string = True
+                self.literal = []
+            elif char in '{[':
+                self.stack.append(char)
+                self.expecting_key = char == '{'
+            elif char in '}]':
+                if self.stack:
+                    self.stack.pop()
+            elif char == ':':
+                self.expecting_key = False
+            elif char == ',':
+                self.expecting_key = self.stack[-1:] == ['{']
+        return events
+
+
+class ProjectCreator:
+    """Creates the Project and its tasks as `ProjectMetadataStreamParser` events arrive, returns them as SSE frames."""
+
+    def __init__(self, user_id: str, user_email: str, fields: dict) -> None:
+        self.user_id = user_id
+        self.user_email = user_email
+        self.fields = fields
+        self.project: Optional[Project] = None
+        self.titles: List[str] = []  # tasks that arrived before the project title
+
+    def _create_project(self, title: str) -> bytes:
+        self.project = Project.objects.create(
+            user_id=self.user_id, user_email=self.user_email, title=title[0:100], **self.fields)
+        return f'event: project\ndata: {json.dumps(ProjectShortSerializer(self.project).data)}\n\n'.encode()
+
+    def _create_task(self, title: str) -> bytes:
+        task = ProjectTask.objects.create(project=self.project, title=title)
+        return f'event: task\ndata: {json.dumps(ProjectTaskShortSerializer(task).data)}\n\n'.encode()
+
+    def handle(self, events: List[Tuple[str, str]]) -> List[bytes]:
+        frames = []
+        for kind, value in events:
+            if kind == "title" and self.project is None:
+                frames.append(self._create_project(value))
+                frames += [self._create_task(title) for title in self.titles]
+                self.titles = []
+            elif kind == "task" and self.project is None:
+                self.titles.append(value)
+            elif kind == "task":
+                frames.append(self._create_task(value))
+        return frames
+
+    def finish(self) -> List[bytes]:
+        """Creates the project if the completion had no title."""
+        if self.project is not None:
+            return []
+        return self.handle([("title", Project._meta.get_field("title").default)])
+
+
+def project_create_stream(user_id: str, user_email: str, fields: dict):
+    """
+        Generates the project metadata and creates the Project (`event: project`) as soon as its title is complete
+        and every ProjectTask (`event: task`) as soon as its title is, `data: Stop` ends the stream.
+        Both events carry the serialized instance as JSON.
+    """
+    parser = ProjectMetadataStreamParser()
+    creator = ProjectCreator(user_id, user_email, fields)
+    generator = generate_chat_completion(
+        get_project_metadata_messages(fields), stream=True, reply_json=True, call_type="project")
+    parts: List[str] = []
+    try:
+        for chunk in generator:  # type: ignore
+            answer = chunk.choices[0]
+            if answer.finish_reason:
+                break
+            parts.append(answer.delta.content or "")
+            yield from creator.handle(parser.feed(parts[-1]))
+        yield from creator.finish()
+    except GeneratorExit:
+        close_upstream(generator)
+        record_cancelled_stream("create_project", "".join(parts), is_replay(generator))
+        raise
+    record_completed_stream("create_project", "".join(parts), is_replay(generator))
+    yield ('data: Stop\0\n\n').encode()
+
+
+async def aproject_create_stream(user_id: str, user_email: str, fields: dict):
+    """Async counterpart of `project_create_stream` for ASGI: ORM calls are offloaded to a thread."""
+    parser = ProjectMetadataStreamParser()
+    creator = ProjectCreator(user_id, user_email, fields)
+    generator = await agenerate_chat_completion(
+        get_project_metadata_messages(fields), stream=True, reply_json=True, call_type="project")
+    parts: List[str] = []
+    try:
+        async for chunk in generator:  # type: ignore
+            answer = chunk.choices[0]
+            if answer.finish_reason:
+                break
+            parts.append(answer.delta.content or "")
+            if events := parser.feed(parts[-1]):
+                for frame in await sync_to_async(creator.handle)(events):
+                    yield frame
+        for frame in await sync_to_async(creator.finish)():
+            yield frame
+    except (GeneratorExit, asyncio.CancelledError):
+        await aclose_upstream(generator)
+        record_cancelled_stream("create_project", "".join(parts), is_replay(generator))
+        raise
+    record_completed_stream("create_project", "".join(parts), is_replay(generator))
+    yield ('data: Stop\0\n\n').encode()
+
+
+def get_project_metadata_messages(form_data: dict) -> List[ChatCompletionMessageParam]:
+    """Builds the messages for generating project title and titles for its tasks from the provided information
+
+    :param form_data: form data submitted by the user
+    :type form_data: dict
+    :return: chat completion messages
+    :rtype: List[ChatCompletionMessageParam]
     """
 
     json_format = """
@@ -129,18 +492,32 @@ def get_project_metadata(form_data: dict):
             "content": user_prompt,
         }
     ]
-    completion: ChatCompletion = generate_chat_completion(messages, reply_json=True)  # type: ignore
-    return json.loads(completion.choices[0].message.content or "{}")
+    return messages
 
 
-def get_project_task_generator(metadata: dict, task_id: int) -> Stream[ChatCompletionChunk]:
-    """Generates project task description and subtasks from the provided information
+def get_project_metadata(form_data: dict):
+    """Generates project title and titles for its tasks from the provided information
 
-    :param data: project metadata
+    :param data: form data submitted by the user
     :type data: dict
     :return: dictionary with metadata
     :rtype: dict
     """
+    messages = get_project_metadata_messages(form_data)
+    completion: ChatCompletion = generate_chat_completion(messages, reply_json=True, call_type="project")  # type: ignore
+    return json.loads(completion.choices[0].message.content or "{}")
+
+
+def get_project_task_messages(context: ProjectContext, task_id: int) -> List[ChatCompletionMessageParam]:
+    """Builds the messages for generating project task description and subtasks from the provided information
+
+    :param context: project context
+    :type context: ProjectContext
+    :param task_id: ProjectTask ID
+    :type task_id: int
+    :return: chat completion messages
+    :rtype: List[ChatCompletionMessageParam]
+    """
     SYS_TEMPLATE = """
     Act as very experienced freelancer that helps other users to create very effective plan of work depending on user's information.
     User provides following information:
@@ -177,19 +554,14 @@ def get_project_task_generator(metadata: dict, task_id: int) -> Stream[ChatCompl
     Do not write Description:, Subtask in your response
     """
 
-    for task in metadata['tasks']:
-        if task["id"] == task_id:
-            this_task: dict = task
-            break
-
     system_prompt = SYS_TEMPLATE
     user_prompt = USER_TEMPLATE.format(
-        deliverables=metadata['deliverables'],
-        description=metadata['description'],
-        goal=metadata['goal'],
-        duration=metadata['duration'],
-        title=metadata['title'],
-        task_title=this_task['title'],
+        deliverables=context.deliverables,
+        description=context.description,
+        goal=context.goal,
+        duration=context.duration,
+        title=context.title,
+        task_title=context.tasks[task_id],
     )
 
     messages: List[ChatCompletionMessageParam] = [
@@ -202,4 +574,22 @@ def get_project_task_generator(metadata: dict, task_id: int) -> Stream[ChatCompl
             "content": user_prompt,
         }
     ]
-    return generate_chat_completion(messages, stream=True)  # type: ignore
+    return messages
+
+
+def get_project_task_generator(context: ProjectContext, task_id: int) -> Stream[ChatCompletionChunk]:
+    """Generates project task description and subtasks from the provided information
+
+    :param context: project context
+    :type context: ProjectContext
+    :return: chat completion stream
+    :rtype: Stream[ChatCompletionChunk]
+    """
+    messages = get_project_task_messages(context, task_id)
+    return generate_chat_completion(messages, stream=True, call_type="task_plan")  # type: ignore
+
+
+async def aget_project_task_generator(context: ProjectContext, task_id: int) -> AsyncStream[ChatCompletionChunk]:
+    """Async counterpart of `get_project_task_generator`."""
+    messages = get_project_task_messages(context, task_id)
+    return await agenerate_chat_completion(messages, stream=True, call_type="task_plan")  # type: ignore
@@ -1,7 +1,9 @@
 from typing import Any
 
+from django.conf import settings
+from django.db import transaction
 from django.db.models import Count, Prefetch, Q
-from django.http import Http404, StreamingHttpResponse
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from drf_spectacular.utils import extend_schema
@@ -12,8 +14,11 @@ from rest_framework.response import Response
 from rest_framework.serializers import Serializer
 
 # from account.models import UserOnboarding
+from main.api import start_answer_stream
+from main.background import run_in_background
 from main.models import AgentTypes
 from main.serializers import AgentTypeSerializer
+from main.streams import event_stream_response, get_last_event_id, streams
 # from main.tasks import (
 #     update_user_onboarding_task
 # )
@@ -21,6 +26,7 @@ from main.google_tasks import create_update_user_onboarding_task
 from custom.custom_exceptions import BadRequest
 from custom.custom_permissions import HasUnexpiredSubscription
 from custom.custom_renderers import ServerSentEventRenderer
+from custom.custom_shortcuts import is_asgi_request
 from jlab.models import (
     EditorObject,
     EditorObjectTypes,
@@ -47,7 +53,12 @@ from jlab.serializers import (
     TaskMessageCSATSerializer
 )
 from jlab.utils import (
+    aproject_create_stream,
+    aproject_plan_stream,
+    aproject_task_stream,
     get_project_metadata,
+    project_create_stream,
+    project_plan_stream,
     project_task_stream
 )
 
@@ -57,7 +68,7 @@ class ProjectViewSet(viewsets.ModelViewSet, mixins.DestroyModelMixin):
     permission_classes = [HasUnexpiredSubscription]
 
     def get_queryset(self):
-        queryset = super().get_queryset().filter(user=self.request.user)
+        queryset = super().get_queryset().filter(user_id=self.request.user['user_id'])
         if self.action in ['list', 'init_task']:
             return queryset.prefetch_related('tasks')
         if self.action == 'retrieve':
@@ -91,31 +102,65 @@ class ProjectViewSet(viewsets.ModelViewSet, mixins.DestroyModelMixin):
     @ extend_schema(responses={201: ProjectCreateResponseSerializer})
     def create(self, request, *args, **kwargs):
         user_id = request.user['user_id']
-        user_email = request.user['user_email']
+        user_email = request.user['email']
         ser = self.get_serializer(data=request.data)
         ser.is_valid(raise_exception=True)
+        fields = dict(ser.validated_data)
+        generate_plans = fields.pop('generate_plans')
         # Generate metadata
         generated = get_project_metadata(ser.data)
         # Create instances
-        response_data: Any = {}
-        if len(generated['title']) > 100:
-            generated['title'] = generated['title'][0:100]
-        project = Project.objects.create(
-            user_id=user_id, user_email=user_email, title=generated['title'], **ser.data)
-        response_data['project'] = ProjectShortSerializer(project).data
-        response_data['project']['tasks'] = []
-        for title in generated['tasks']:
-            task = ProjectTask.objects.create(project=project, title=title)
-            response_data['project']['tasks'].append(
-                ProjectTaskShortSerializer(task).data)
-        # update_user_onboarding_task.delay(request.user['user_id'], {"first_project": True}, request.auth)
-        create_update_user_onboarding_task({
-                "first_project": True
-            }, str(request.auth))
-        
+        with transaction.atomic():
+            project = Project.objects.create(
+                user_id=user_id, user_email=user_email, title=generated['title'][0:100], **fields)
+            tasks = ProjectTask.objects.bulk_create(
+                [ProjectTask(project=project, title=title) for title in generated['tasks']])
+            # Side effects run once the rows are committed, off the request path
+            # update_user_onboarding_task.delay(request.user['user_id'], {"first_project": True}, request.auth)
+            transaction.on_commit(lambda: run_in_background(
+                create_update_user_onboarding_task, {"first_project": True}, str(request.auth)))
+            if generate_plans and tasks:
+                # Not cancellable: the plans are saved for when the user opens a task, even if nobody watches them
+                transaction.on_commit(lambda: streams.start(
+                    ("init_tasks", project.pk), project_plan_stream(project, tasks), cancellable=False))
         # UserOnboarding.objects.filter(user=request.user).update(first_project=True)
+        response_data: Any = {'project': ProjectShortSerializer(project).data}
+        response_data['project']['tasks'] = ProjectTaskShortSerializer(tasks, many=True).data
         return Response(response_data, status.HTTP_201_CREATED)
 
+    @ extend_schema(
+        responses={
+            (200, 'text/event-stream'): {
+                'name': 'Empty',
+                'type': 'string',
+            }
+        },
+        request=ProjectCreateRequestSerializer
+    )
+    @ action(['post'], False, renderer_classes=[ServerSentEventRenderer])
+    def create_stream(self, request: Request):
+        """
+            Streaming version of `create`: returns an HTTP Streaming Response with the Project (`event: project`)
+            and each ProjectTask (`event: task`) created as soon as the AI generated its title.
+            A client reconnecting with `Last-Event-ID` resumes the running generation.
+        """
+        user_id = request.user['user_id']
+        asgi = is_asgi_request(request)
+        key = ("create_project", user_id)
+        last_event_id = get_last_event_id(request)
+        if last_event_id is not None and (buffer := streams.get(key)):
+            return event_stream_response(buffer.subscribe(last_event_id, asgi))
+        ser = ProjectCreateRequestSerializer(data=request.data)
+        ser.is_valid(raise_exception=True)
+        fields = dict(ser.validated_data)
+        fields.pop('generate_plans')
+        if asgi:
+            stream = aproject_create_stream(user_id, request.user['email'], fields)
+        else:
+            stream = project_create_stream(user_id, request.user['email'], fields)
+        run_in_background(create_update_user_onboarding_task, {"first_project": True}, str(request.auth))
+        return event_stream_response(streams.start(key, stream).subscribe(0, asgi))
+
     @ extend_schema(
         responses={
             (200, 'text/event-stream'): {
@@ -131,6 +176,7 @@ class ProjectViewSet(viewsets.ModelViewSet, mixins.DestroyModelMixin):
             Returns an HTTP Streaming Response with ProjectTask description
             and/or subtasks generated by AI.
             Raises Bad Request if requested task does not belong to the project.
+            A client reconnecting with `Last-Event-ID` resumes the running generation (see `AiViewSet.stream`).
         """
         project = self.get_object()
         ser = ProjectTaskIdSerializer(data=request.query_params)
@@ -138,15 +184,55 @@ class ProjectViewSet(viewsets.ModelViewSet, mixins.DestroyModelMixin):
         task_id: int = ser.data["task_id"]  # type: ignore
         if task_id not in project.tasks.values_list('id', flat=True):
             raise BadRequest("Invalid task ID.")
+        asgi = is_asgi_request(request)
+        key = ("init_task", task_id)
+        last_event_id = get_last_event_id(request)
+        # Checked before "Task is not empty", the resumed generation has already saved objects
+        if last_event_id is not None and (buffer := streams.get(key)):
+            return event_stream_response(buffer.subscribe(last_event_id, asgi))
         if EditorObject.objects.filter(task__pk=task_id).exists():
             raise BadRequest("Task is not empty.")
-        stream = project_task_stream(project, task_id)
-        response = StreamingHttpResponse(
-            stream, content_type="text/event-stream")
-        response['X-Accel-Buffering'] = 'no'  # Disable buffering in nginx
-        # Ensure clients don't cache the data
-        response['Cache-Control'] = 'no-cache'
-        return response
+        if (buffer := streams.get(("init_tasks", project.pk))) and not buffer.finished:
+            raise BadRequest("Task is being generated.")
+        if asgi:
+            stream = aproject_task_stream(project, task_id)
+        else:
+            stream = project_task_stream(project, task_id)
+        return event_stream_response(streams.start(key, stream).subscribe(0, asgi))
+
+    @ extend_schema(
+        responses={
+            (200, 'text/event-stream'): {
+                'name': 'Empty',
+                'type': 'string',
+            }
+        },
+        request=None
+    )
+    @ action(detail=True, renderer_classes=[ServerSentEventRenderer])
+    def init_tasks(self, request: Request, pk=None):
+        """
+            Returns an HTTP Streaming Response with the descriptions and subtasks of all empty tasks of the project,
+            generated concurrently (see `project_plan_stream` for the events).
+            Attaches to the generation started by `create` (`generate_plans`) while it is running.
+            Raises Bad Request if the project has no empty tasks.
+        """
+        project = self.get_object()
+        asgi = is_asgi_request(request)
+        key = ("init_tasks", project.pk)
+        last_event_id = get_last_event_id(request)
+        buffer = streams.get(key)
+        # The plans may be generated in the background since the project was created (see `create`)
+        if buffer and (last_event_id is not None or not buffer.finished):
+            return event_stream_response(buffer.subscribe(last_event_id or 0, asgi))
+        tasks = list(project.tasks.filter(objs__isnull=True).order_by('id'))
+        if not tasks:
+            raise BadRequest("Project has no empty tasks.")
+        if asgi:
+            stream = aproject_plan_stream(project, tasks)
+        else:
+            stream = project_plan_stream(project, tasks)
+        return event_stream_response(streams.start(key, stream).subscribe(0, asgi))
 
     @ action(['post'], True)
     def create_task(self, request: Request, pk=None):
@@ -194,7 +280,7 @@ class ProjectTaskViewSet(viewsets.GenericViewSet,
         return Project.objects.filter(id=project_id).update(date_updated=timezone.now())
 
     def get_queryset(self):
-        queryset = super().get_queryset().filter(project__user=self.request.user)
+        queryset = super().get_queryset().filter(project__user_id=self.request.user['user_id'])
         if self.action == 'retrieve':
             return queryset.prefetch_related('objs')\
                 .annotate(videos=Count("objs", filter=Q(objs__content_type=EditorObjectTypes.VIDEO)))\
@@ -233,7 +319,12 @@ class ProjectTaskViewSet(viewsets.GenericViewSet,
 
     @ action(['post'], True)
     def messages(self, request: Request, pk=None):
-        """Create user's TaskMessage with objects corresponding to it"""
+        """
+            Create user's TaskMessage with objects corresponding to it.
+            With `generate`, the answer of a text agent is generated right away and buffered,
+            `AiViewSet.stream` for the message attaches to it (it is discarded if nobody does within
+            `settings.SSE_UNCLAIMED_TTL` seconds).
+        """
         task = self.get_object()
         ser = self.get_serializer(data=request.data)
         ser.is_valid(raise_exception=True)
@@ -241,6 +332,9 @@ class ProjectTaskViewSet(viewsets.GenericViewSet,
         message = ser.save(task=task)
         task.date_updated = timezone.now()
         task.save()
+        if ser.validated_data['generate'] and message.agent.type == AgentTypes.TEXT:
+            transaction.on_commit(lambda: start_answer_stream(
+                task, message.agent, message.pk, str(request.auth), False, unclaimed_ttl=settings.SSE_UNCLAIMED_TTL))
         ser2 = self.get_serializer(message)
         return Response(ser2.data, status=status.HTTP_201_CREATED)
 
@@ -253,6 +347,7 @@ class ProjectTaskViewSet(viewsets.GenericViewSet,
         ser.is_valid(raise_exception=True)
         self.__update_project_last_modified(task.project_id)
         task.messages.filter(agent__type=ser.data['type']).delete()
+        task.summaries.filter(agent_type=ser.data['type']).delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @ extend_schema(parameters=[AgentTypeSerializer])
@@ -1,22 +1,42 @@
+import asyncio
 import logging
+import time
 from collections import defaultdict
+from functools import cached_property, partial
 from typing import (
     Any,
+    AsyncIterator,
+    Callable,
     Iterable,
+    Iterator,
     List,
+    Optional,
+    Tuple,
 )
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Prefetch, QuerySet
 from openai.types.chat import ChatCompletion
-from main.utils import generate_chat_completion
+from main.utils import count_tokens, generate_chat_completion
 from main.base_api import BaseGenerationAPI
+from main.background import run_in_background
+from main.context import ChatTurn, ContextWindow
+from main.google_tasks import create_update_user_onboarding_task
+from main.locks import SharedGeneration, ahold_lock, hold_lock, lock_key, stream_locks
+from main.sse import text_frame
+from main.streams import StreamBuffer, streams
 from main.models import (
     Agent,
     AgentTypes
 )
 from jlab.models import (
     MessageObject,
+    MessageObjectStatuses,
     MessageObjectTypes,
+    ProjectTask,
     TaskMessage,
 )
+from jlab.project_context import invalidate_project_context
 
 
 class StreamAgentAPI(BaseGenerationAPI):
@@ -30,13 +50,57 @@ class StreamAgentAPI(BaseGenerationAPI):
         as the appropriate response. In addition to this, API is written to automatically create
         new TaskMessage with a MessageObject, corresponding to the answer of the Agent.
     """
+    IMAGE_TOKENS = 765  # a high detail 1024x1024 image
     agent: Agent
     agent_message: TaskMessage
+    answer_object: Optional[MessageObject] = None
+    context: ContextWindow
 
     def __init__(self, message: TaskMessage) -> None:
+        """`message` is the Agent's answer. It may be unsaved, then it is saved after the first token was streamed."""
+        super().__init__()
         self.agent = message.agent  # type: ignore
+        self.agent_id = message.agent_id  # type: ignore
         self.agent_message = message
 
+    @staticmethod
+    def get_task_messages(task: ProjectTask, agent_type: str) -> QuerySet[TaskMessage]:
+        """
+            Returns the chat of a ProjectTask for the given agent type with everything `.pre_generate` reads
+            (agent and ordered objects) loaded up front, so assembling the conversation takes a constant number of queries.
+        """
+        return TaskMessage.objects.filter(task=task, agent__type=agent_type)\
+            .select_related('agent')\
+            .prefetch_related(Prefetch('objs', MessageObject.objects.order_by('pk')))
+
+    @cached_property
+    def user_params(self) -> dict:
+        """
+            Prompt parameters describing the project's owner. The project is shared by the whole chat, so it is read once.
+            Users live in the users service, a Project only keeps `user_id` and `user_email`: `full_name` has no source
+            here and is left to the "Not defined." placeholder (`project.user.full_name` did not exist either).
+        """
+        project = self.agent_message.task.project
+        return {
+            "email": project.user_email,
+        }
+
+    @cached_property
+    def user_template_tokens(self) -> int:
+        return count_tokens(self.get_user_prompt())
+
+    def get_message_tokens(self, task_message: TaskMessage) -> int:
+        """Estimates the prompt tokens of a message from the token counts stored on its objects."""
+        tokens = 0
+        for obj in task_message.objs.all():  # type: ignore
+            if obj.content_type == MessageObjectTypes.IMAGE:
+                tokens += self.IMAGE_TOKENS
+            else:
+                tokens += obj.get_token_count()
+        if not task_message.is_answer:
+            tokens += self.user_template_tokens
+        return tokens
+
     # @override ( Requires Python version 3.12 )
     def get_system_prompt(self, *args, **kwargs):
         return self.agent.sys_template
@@ -46,13 +110,14 @@ class StreamAgentAPI(BaseGenerationAPI):
         return self.agent.user_template
 
     def get_message_text_content(self, task_message: TaskMessage) -> str:
+        # `.all()` reuses the prefetched objects, `.first()`/`.filter()` would query for every message
+        objs = list(task_message.objs.all())  # type: ignore
         if task_message.is_answer:
-            if obj := task_message.objs.first():  # type: ignore
-                return obj.content
+            if objs:
+                return objs[0].content
             return ""
 
         params = defaultdict(lambda: self.NOT_DEFINED)
-        project = task_message.task.project
 
         if isinstance(task_message.parameters, dict):
             params.update(task_message.parameters)
@@ -60,25 +125,20 @@ class StreamAgentAPI(BaseGenerationAPI):
             logging.warning(
                 "StreamAgentAPI: task_message.parameters is not a dictionary. Ignoring parameters. task_message.pk=%d", task_message.pk)
 
-        # type: ignore
-        for obj in task_message.objs.filter(content_type__in=[MessageObjectTypes.QUOTE, MessageObjectTypes.TEXT]):
+        for obj in objs:
             if obj.content_type == MessageObjectTypes.QUOTE:
                 params.update(quote=obj.content)
             elif obj.content_type == MessageObjectTypes.TEXT:
                 params.update(main_field=obj.content)
 
         if task_message.agent.type == AgentTypes.TEXT:
-            params.update(
-                full_name=project.user.full_name,
-                email=project.user.email
-            )
+            params.update(self.user_params)
 
-        return self.get_user_prompt().format_map(params)
+        return self.agent.user_prompt.render(params)
 
     def get_message_full_content(self, task_message: TaskMessage) -> List[Any]:
         content = []
         params = defaultdict(lambda: self.NOT_DEFINED)
-        project = task_message.task.project
 
         if isinstance(task_message.parameters, dict):
             params.update(task_message.parameters)
@@ -99,12 +159,9 @@ class StreamAgentAPI(BaseGenerationAPI):
                 })
 
         if task_message.agent.type == AgentTypes.TEXT:
-            params.update(
-                full_name=project.user.full_name,
-                email=project.user.email
-            )
+            params.update(self.user_params)
 
-        text = self.get_user_prompt().format_map(params)
+        text = self.agent.user_prompt.render(params)
         content.append({
             "type": "text",
             "text": text
@@ -112,17 +169,40 @@ class StreamAgentAPI(BaseGenerationAPI):
         return content
 
     # @override ( Requires Python version 3.12 )
-    def post_generate(self, full_content: str) -> None:
-        MessageObject.objects.create(
+    def on_first_token(self) -> None:
+        """Saves the answer with an AWAITING text object, which `.checkpoint` fills while the stream runs."""
+        if self.agent_message.pk is None:
+            self.agent_message.save()
+        self.answer_object = MessageObject.objects.create(
             message=self.agent_message,
             content_type=MessageObjectTypes.TEXT,
-            content=full_content,
+            status=MessageObjectStatuses.AWAITING,
         )
+        super().on_first_token()
+
+    # @override ( Requires Python version 3.12 )
+    def checkpoint(self, partial_content: str) -> None:
+        if self.answer_object is not None:
+            MessageObject.objects.filter(pk=self.answer_object.pk).update(content=partial_content)
+
+    # @override ( Requires Python version 3.12 )
+    def post_generate(self, full_content: str) -> None:
+        if self.agent_message.pk is None:
+            self.agent_message.save()
+        if self.answer_object is None:
+            self.answer_object = MessageObject(message=self.agent_message, content_type=MessageObjectTypes.TEXT)
+        self.answer_object.content = full_content
+        self.answer_object.status = MessageObjectStatuses.INITIAL
+        self.answer_object.save()
+        if self.context.overflow:
+            run_in_background(self.context.update_summary)
 
     # @override ( Requires Python version 3.12 )
     def pre_generate(self, *args, **kwargs) -> None:
+        """Appends the chat history fitted into the Agent's token budget by `ContextWindow`."""
         task_messages = kwargs["task_messages"]
         last_msg_id = kwargs["last_msg_id"]
+        turns = []
         for task_message in task_messages:
             if task_message == self.agent_message:
                 continue
@@ -131,8 +211,16 @@ class StreamAgentAPI(BaseGenerationAPI):
             else:
                 content = self.get_message_full_content(task_message)
             if content:
-                role = "assistant" if task_message.is_answer else "user"
-                self.append_message(content, role)
+                turns.append(ChatTurn(
+                    message_id=task_message.pk,
+                    role="assistant" if task_message.is_answer else "user",
+                    content=content,
+                    tokens=self.get_message_tokens(task_message),
+                    pinned=task_message.pk == last_msg_id,
+                ))
+        self.context = ContextWindow(self.agent, self.agent_message.task, self.get_system_prompt())
+        for message in self.context.fit(turns):
+            self.append_message(message["content"], message["role"])
 
     # @override ( Requires Python version 3.12 )
     def get_text_stream(self, task_messages: Iterable[TaskMessage], last_msg_id: Any):  # pylint: disable=W0221
@@ -140,7 +228,11 @@ class StreamAgentAPI(BaseGenerationAPI):
             return self._get_text_stream(task_messages=task_messages, last_msg_id=last_msg_id)
         except Exception as e:
             logging.exception(e)
-            return self.fake_stream("Currently, the AI service is experiencing high demand, please try a few minutes later.")
+            return self.fake_stream(self.HIGH_DEMAND)
+
+    # @override ( Requires Python version 3.12 )
+    def aget_text_stream(self, task_messages: Iterable[TaskMessage], last_msg_id: Any):  # pylint: disable=W0221
+        return super().aget_text_stream(task_messages=task_messages, last_msg_id=last_msg_id)
 
     def get_title(self, user_msg_id: Any):
         data = MessageObject.objects.filter(
@@ -158,9 +250,137 @@ class StreamAgentAPI(BaseGenerationAPI):
             }
         ]
         try:
-            response = generate_chat_completion(messages)
+            response = generate_chat_completion(messages, call_type="title", agent_id=self.agent_id)
         except Exception as e:
             logging.exception(e)
             return "None"
         assert isinstance(response, ChatCompletion)
         return response.choices[0].message.content or "None"
+
+    def save_title(self, user_msg_id: Any) -> str:
+        """Generates and saves the title of the chat's ProjectTask. Meant to run concurrently with the answer stream."""
+        title = self.get_title(user_msg_id)[:100]
+        ProjectTask.objects.filter(pk=self.agent_message.task_id).update(title=title)  # type: ignore
+        invalidate_project_context(self.agent_message.task.project_id)  # `update` sends no `post_save`
+        return title
+
+    def discard(self) -> None:
+        """Deletes the answer of a generation nobody received (see `StreamBuffer.on_expire`)."""
+        if self.agent_message.pk is not None:
+            self.agent_message.delete()
+
+    def _poll_answer(self, since: int, is_running: Callable[[], bool],
+                     shared: Optional[SharedGeneration]) -> Tuple[Optional[dict], bool]:
+        """Returns the newest answer to the parent message saved after the answer `since` and whether it is final."""
+        if shared is not None:
+            shared.follow()
+        running = is_running()  # checked first, so the last read sees the final content
+        answer = MessageObject.objects.filter(
+            message__parent_id=self.agent_message.parent_id,  # type: ignore
+            message__agent_id=self.agent_id,
+            message__is_answer=True,
+            message_id__gt=since,
+            content_type=MessageObjectTypes.TEXT,
+        ).order_by("-message_id").values("message_id", "content", "status").first()
+        return answer, not running or (answer is not None and answer["status"] != MessageObjectStatuses.AWAITING)
+
+    def _newest_answer_id(self, finished: bool = False) -> int:
+        """The newest answer to the parent message (only a `finished` one, if set), 0 if there is none."""
+        answers = TaskMessage.objects.filter(
+            parent_id=self.agent_message.parent_id, agent_id=self.agent_id, is_answer=True)  # type: ignore
+        if finished:
+            answers = answers.exclude(objs__status=MessageObjectStatuses.AWAITING)
+        return answers.order_by("-pk").values_list("pk", flat=True).first() or 0
+
+    def _follow_since(self, shared: Optional[SharedGeneration]) -> int:
+        """
+            Answers after this one are the followed generation's: the newest answer when it started, as published
+            by the worker running it, or else the newest finished one (the running one is being saved).
+        """
+        since = shared.since() if shared is not None else None
+        return self._newest_answer_id(finished=True) if since is None else since
+
+    def follow_stream(self, is_running: Callable[[], bool], shared: Optional[SharedGeneration] = None) -> Iterator[bytes]:
+        """
+            Streams the answer another worker process is generating for the same user message (see `main.locks`)
+            by polling the content it saves (`.checkpoint`) every `settings.STREAM_LOCK["POLL_INTERVAL"]` seconds.
+            Ends once the answer is saved or `is_running()` tells the other worker stopped. Every poll is
+            reported to `shared`, so the other worker does not cancel the generation while it is followed.
+        """
+        since = self._follow_since(shared)
+        sent = 0
+        while True:
+            answer, final = self._poll_answer(since, is_running, shared)
+            if answer is not None and len(answer["content"]) > sent:
+                yield text_frame(answer["content"][sent:])
+                sent = len(answer["content"])
+            if final:
+                break
+            time.sleep(settings.STREAM_LOCK["POLL_INTERVAL"])
+        yield ('data: Stop\0\n\n').encode()
+
+    async def afollow_stream(self, is_running: Callable[[], bool],
+                             shared: Optional[SharedGeneration] = None) -> AsyncIterator[bytes]:
+        """Async counterpart of `.follow_stream`."""
+        since = await sync_to_async(self._follow_since)(shared)
+        sent = 0
+        while True:
+            answer, final = await sync_to_async(self._poll_answer)(since, is_running, shared)
+            if answer is not None and len(answer["content"]) > sent:
+                yield text_frame(answer["content"][sent:])
+                sent = len(answer["content"])
+            if final:
+                break
+            await asyncio.sleep(settings.STREAM_LOCK["POLL_INTERVAL"])
+        yield ('data: Stop\0\n\n').encode()
+
+
+def start_answer_stream(task: ProjectTask, agent: Agent, message_id: int, token: str, asgi: bool,
+                        replay: bool = False, unclaimed_ttl: Optional[float] = None) -> Tuple[StreamBuffer, bool]:
+    """
+        Returns the buffer of the Agent's answer to the user message `message_id` and whether it was started now
+        (see `StreamRegistry.claim`, `replay` attaches to a finished one too).
+
+        Identical requests share one generation: within a worker process they attach to the same buffer,
+        in other processes they follow the answer the worker holding the lock of the generation saves (see `main.locks`).
+        A generation started before anyone asked for it (`unclaimed_ttl`, see `ProjectTaskViewSet.messages`)
+        is sync, and it is cancelled and its answer deleted if nobody subscribed within `unclaimed_ttl` seconds.
+    """
+    key = ("stream", task.pk, message_id, agent.pk)
+    buffer, created = streams.claim(key, replay=replay)
+    if not created:
+        return buffer, False
+    asgi = asgi and unclaimed_ttl is None
+    # The answer is saved and the side effects are run only after the first token was sent
+    api = StreamAgentAPI(TaskMessage(task=task, is_answer=True, agent=agent, parent_id=message_id))
+    try:
+        lock = stream_locks.acquire(lock_key(key))
+        shared = SharedGeneration(lock_key(key)) if stream_locks.shared else None
+        if lock is None:
+            is_running = partial(stream_locks.locked, lock_key(key))
+            buffer.start(api.afollow_stream(is_running, shared) if asgi else api.follow_stream(is_running, shared))
+            return buffer, True
+        try:
+            if shared is not None:
+                shared.start(api._newest_answer_id())
+            task_messages = StreamAgentAPI.get_task_messages(task, agent.type)
+            # UserOnboarding.objects.filter(
+            #     pk=request.user['user_id']).update(first_text=True)
+            api.defer(create_update_user_onboarding_task, {
+                "first_text": True
+            }, token)  # Use the token from the request.auth
+            if task.title == "Untitled":
+                # Generated concurrently with the answer and sent as `event: title`
+                api.add_event("title", run_in_background(api.save_title, message_id))
+            if asgi:
+                stream = ahold_lock(api.aget_text_stream(task_messages, message_id), lock, shared)
+            else:
+                stream = hold_lock(api.get_text_stream(task_messages, message_id), lock, shared)
+        except BaseException:
+            stream_locks.release(lock)
+            raise
+        buffer.start(stream, unclaimed_ttl, api.discard, shared=shared)
+    except BaseException:
+        buffer.finish()
+        raise
+    return buffer, True
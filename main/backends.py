@@ -0,0 +1,603 @@
+"""
+    Chat completion backends (`settings.LLM_BACKENDS`) with hedged requests and fallback.
+
+    Backends are configured per call type ("chat", "title", "summary", "project", "task_plan",
+    unknown types use "default"). The first backend of a call type is the primary one. If a stream has not started
+    within `settings.LLM_HEDGE_AFTER` seconds after the rate limiter admitted it, the next backend is requested
+    concurrently (a hedged request) and whichever starts first wins, the other request is cancelled (see `Cancellation`).
+    Other calls answer at once with the whole response, they are only hedged after
+    `settings.LLM_HEDGE_AFTER_COMPLETE` seconds (None, the default, disables it). A backend that fails
+    is replaced by the next one right away.
+
+    Every request is admitted by `main.ratelimit.limiter`. Requests rejected by the provider with 429
+    (or failed with a connection or server error) are retried with jittered backoff, this replaces
+    the retries of the OpenAI SDK, so there is one retry policy.
+
+    Every completion is measured by `CompletionTelemetry` (queue wait, time to first token, inter-token latency,
+    duration and the token usage the provider reports, streams request it with `stream_options`).
+"""
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    TypeVar,
+)
+
+import httpx
+from django.conf import settings
+from django.db import close_old_connections
+from openai import (
+    APIConnectionError,
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    InternalServerError,
+    OpenAI,
+    RateLimitError,
+)
+from main.metrics import (
+    LLM_BACKEND_ERRORS,
+    LLM_COMPLETION_TOKENS,
+    LLM_DURATION,
+    LLM_HEDGED_REQUESTS,
+    LLM_HTTP_CONNECTIONS,
+    LLM_HTTP_REQUESTS,
+    LLM_INTER_TOKEN_LATENCY,
+    LLM_PROMPT_TOKENS,
+    LLM_QUEUE_WAIT,
+    LLM_TIME_TO_FIRST_TOKEN,
+    LLM_TOKENS_PER_SECOND,
+)
+from main.ratelimit import backoff, limiter
+from main.streams import aclose_upstream, close_upstream
+
+T = TypeVar("T")
+
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+executor = ThreadPoolExecutor(max_workers=settings.LLM_HEDGE_WORKERS, thread_name_prefix="llm")
+
+
+def _http_options() -> dict:
+    config = settings.LLM_HTTP
+    return {
+        "limits": httpx.Limits(
+            max_connections=config["MAX_CONNECTIONS"],
+            max_keepalive_connections=config["MAX_KEEPALIVE_CONNECTIONS"],
+            keepalive_expiry=config["KEEPALIVE_EXPIRY"],
+        ),
+        "http2": config["HTTP2"],
+        "timeout": httpx.Timeout(timeout=config["TIMEOUT"], connect=config["CONNECT_TIMEOUT"]),
+    }
+
+
+def _trace(event: str, info: dict) -> None:
+    """httpcore trace callback, counts the connections opened (the rest of the requests reused one)."""
+    if event == "connection.connect_tcp.complete":
+        LLM_HTTP_CONNECTIONS.inc()
+
+
+async def _atrace(event: str, info: dict) -> None:
+    _trace(event, info)
+
+
+def _on_request(request: httpx.Request) -> None:
+    LLM_HTTP_REQUESTS.inc()
+    request.extensions["trace"] = _trace
+
+
+async def _aon_request(request: httpx.Request) -> None:
+    LLM_HTTP_REQUESTS.inc()
+    request.extensions["trace"] = _atrace
+
+
+@lru_cache(maxsize=None)
+def get_client(api_key: str, base_url: Optional[str] = None) -> OpenAI:
+    """Shared client per endpoint, so backends of the same endpoint share one connection pool (`settings.LLM_HTTP`)."""
+    http_client = DefaultHttpxClient(event_hooks={"request": [_on_request]}, **_http_options())
+    return OpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http_client,
+                  timeout=http_client.timeout)
+
+
+@lru_cache(maxsize=None)
+def get_async_client(api_key: str, base_url: Optional[str] = None) -> AsyncOpenAI:
+    http_client = DefaultAsyncHttpxClient(event_hooks={"request": [_aon_request]}, **_http_options())
+    return AsyncOpenAI(api_key=api_key, base_url=base_url, max_retries=0, http_client=http_client,
+                       timeout=http_client.timeout)
+
+
+@dataclass(frozen=True)
+class Backend:
+    name: str
+    model: str
+    api_key: str
+    base_url: Optional[str] = None
+
+    @property
+    def bucket(self) -> str:
+        """Rate limit bucket, the provider's limits are per model."""
+        return f"{self.base_url or 'openai'} {self.model}"
+
+    @property
+    def client(self) -> OpenAI:
+        return get_client(self.api_key, self.base_url)
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        return get_async_client(self.api_key, self.base_url)
+
+
+def get_backends(call_type: str) -> List[Backend]:
+    configs = settings.LLM_BACKENDS.get(call_type) or settings.LLM_BACKENDS["default"]
+    return [
+        Backend(
+            name=config.get("NAME", config["MODEL"]),
+            model=config["MODEL"],
+            api_key=config.get("API_KEY", settings.GPT_API_KEY),
+            base_url=config.get("BASE_URL", settings.OPENAI_BASE_URL),
+        )
+        for config in configs
+    ]
+
+
+class CompletionTelemetry:
+    """Latency and token metrics of one completion request to one backend, labelled by call type, agent and model."""
+
+    def __init__(self, call_type: str, agent: str, model: str, started: Optional[float] = None) -> None:
+        self.labels = (call_type, agent, model)
+        self.started = time.monotonic() if started is None else started
+        self.first_at: Optional[float] = None
+        self.last_at: Optional[float] = None
+        self.chunks = 0
+        self.usage: Any = None
+
+    def queued(self, seconds: float) -> None:
+        LLM_QUEUE_WAIT.labels(*self.labels).observe(seconds)
+
+    def chunk(self, chunk: Any) -> None:
+        self.last_at = time.monotonic()
+        if self.first_at is None:
+            self.first_at = self.last_at
+        self.chunks += 1
+        if getattr(chunk, "usage", None) is not None:
+            self.usage = chunk.usage
+
+    def finish(self, usage: Any = None) -> None:
+        now = time.monotonic()
+        LLM_DURATION.labels(*self.labels).observe(now - self.started)
+        if self.chunks > 1:
+            LLM_INTER_TOKEN_LATENCY.labels(*self.labels).observe((self.last_at - self.first_at) / (self.chunks - 1))  # type: ignore
+        usage = usage or self.usage
+        if usage is None:
+            return
+        LLM_PROMPT_TOKENS.labels(*self.labels).observe(usage.prompt_tokens)
+        LLM_COMPLETION_TOKENS.labels(*self.labels).observe(usage.completion_tokens)
+        if self.first_at is not None and self.last_at > self.first_at:  # type: ignore
+            LLM_TOKENS_PER_SECOND.labels(*self.labels).observe(
+                usage.completion_tokens / (self.last_at - self.first_at))  # type: ignore
+
+
+class AttemptCancelled(Exception):
+    """Raised in a sync attempt that lost the race, its result would only be discarded."""
+
+
+class Cancellation:
+    """
+        Cancels a sync attempt from the thread that picked the winner (async attempts are cancelled as tasks).
+        A thread blocked on the socket cannot be interrupted, so the attempt checks `cancelled` before it sends
+        the request, and a response it is reading is closed, which ends the read with an error.
+        A non-streamed response is read at once by the SDK, it is only discarded once it arrived.
+    """
+
+    def __init__(self) -> None:
+        self.cancelled = False
+        self._response: Any = None
+        self._lock = threading.Lock()
+
+    def check(self) -> None:
+        if self.cancelled:
+            raise AttemptCancelled()
+
+    def reading(self, response: Any) -> Any:
+        """Registers the response the attempt reads from, closes it if the attempt was cancelled meanwhile."""
+        with self._lock:
+            self._response = response
+        if self.cancelled:
+            close_upstream(response)
+            raise AttemptCancelled()
+        return response
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            response = self._response
+        if response is not None:
+            close_upstream(response)
+
+
+class StartedStream:
+    """
+        A completion stream whose first chunk was already received (that is what the backends race for).
+
+        The usage chunk (no choices) that follows the last chunk is not passed on: it is read together
+        with the chunk that has `finish_reason`, because consumers stop iterating at that one.
+    """
+
+    def __init__(self, stream: Any, telemetry: Optional[CompletionTelemetry] = None) -> None:
+        self.stream = stream
+        self.telemetry = telemetry
+        self.iterator = iter(stream)
+        try:
+            self.first = next(self.iterator)
+        except BaseException:
+            close_upstream(stream)
+            raise
+        self._observe(self.first)
+
+    def _observe(self, chunk: Any) -> None:
+        if self.telemetry is not None:
+            self.telemetry.chunk(chunk)
+
+    def _finish(self) -> None:
+        if self.telemetry is not None:
+            self.telemetry.finish()
+            self.telemetry = None
+
+    def __iter__(self) -> Iterator[Any]:
+        try:
+            chunk = self.first
+            while True:
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    for usage_chunk in self.iterator:
+                        self._observe(usage_chunk)
+                    self._finish()
+                if chunk.choices:
+                    yield chunk
+                chunk = next(self.iterator, None)
+                if chunk is None:
+                    self._finish()
+                    return
+                self._observe(chunk)
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        close_upstream(self.stream)
+
+
+class AsyncStartedStream:
+    """Async counterpart of `StartedStream`, create it with `await AsyncStartedStream.start(stream)`."""
+
+    def __init__(self, stream: Any, iterator: AsyncIterator[Any], first: Any,
+                 telemetry: Optional[CompletionTelemetry] = None) -> None:
+        self.stream = stream
+        self.iterator = iterator
+        self.first = first
+        self.telemetry = telemetry
+        self._observe(first)
+
+    @classmethod
+    async def start(cls, stream: Any, telemetry: Optional[CompletionTelemetry] = None) -> "AsyncStartedStream":
+        iterator = stream.__aiter__()
+        try:
+            return cls(stream, iterator, await iterator.__anext__(), telemetry)
+        except BaseException:
+            await aclose_upstream(stream)
+            raise
+
+    _observe = StartedStream._observe
+    _finish = StartedStream._finish
+
+    async def __aiter__(self) -> AsyncIterator[Any]:
+        try:
+            chunk = self.first
+            while True:
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    async for usage_chunk in self.iterator:
+                        self._observe(usage_chunk)
+                    self._finish()
+                if chunk.choices:
+                    yield chunk
+                chunk = await anext(self.iterator, None)
+                if chunk is None:
+                    self._finish()
+                    return
+                self._observe(chunk)
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        await aclose_upstream(self.stream)
+
+
+def _endpoints() -> List[Backend]:
+    """One backend per configured endpoint."""
+    endpoints = {}
+    for call_type in settings.LLM_BACKENDS:
+        for backend in get_backends(call_type):
+            endpoints.setdefault((backend.api_key, backend.base_url), backend)
+    return list(endpoints.values())
+
+
+def warm_up() -> None:
+    """Opens the connections of the sync clients (DNS, TCP and TLS) before the first user request needs them."""
+    for backend in _endpoints():
+        try:
+            backend.client.with_options(timeout=10).models.list()
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning("warm_up: %s is unreachable. Exception = %s", backend.name, str(e))
+
+
+async def awarm_up() -> None:
+    """Async counterpart of `warm_up` for the async clients, must run on the event loop that serves the requests."""
+    async def warm(backend: Backend) -> None:
+        try:
+            await backend.async_client.with_options(timeout=10).models.list()
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning("awarm_up: %s is unreachable. Exception = %s", backend.name, str(e))
+
+    await asyncio.gather(*(warm(backend) for backend in _endpoints()))
+
+
+def _observe(call_type: str, backends: List[Backend], winner: Backend, started: float, agent: str) -> None:
+    LLM_TIME_TO_FIRST_TOKEN.labels(call_type, winner.name, agent, winner.model).observe(time.monotonic() - started)
+    if len(backends) > 1:
+        LLM_HEDGED_REQUESTS.labels(call_type, "primary" if winner is backends[0] else "hedge").inc()
+
+
+def _discard_late(discard: Callable[[Any], None], future: Future) -> None:
+    if not future.cancelled() and future.exception() is None:
+        discard(future.result())
+
+
+def _run_attempt(attempt: Callable[[Backend, Callable[[], None]], T], backend: Backend,
+                 admitted: Callable[[], None]) -> T:
+    """Runs an attempt on an `executor` thread, the rate limiter may use the database (like `main.background`)."""
+    close_old_connections()
+    try:
+        return attempt(backend, admitted)
+    finally:
+        close_old_connections()
+
+
+def _admission(future: Any) -> Callable[[], None]:
+    """The `admitted` callback of an attempt: sets `future` to the time the rate limiter first admitted it."""
+    def admitted() -> None:
+        if not future.done():
+            future.set_result(time.monotonic())
+    return admitted
+
+
+def hedge(call_type: str, backends: List[Backend], attempt: Callable[[Backend, Callable[[], None]], T],
+          discard: Callable[[T], None] = lambda result: None, agent: str = "",
+          hedge_after: Optional[float] = None, answered: Callable[[Backend], None] = lambda backend: None,
+          cancel: Callable[[Backend], None] = lambda backend: None) -> T:
+    """
+        Returns the result of the first successful `attempt(backend, admitted)`, falling back as described
+        in the module docstring. An attempt calls `admitted()` once the rate limiter let it through: if it
+        did not return `hedge_after` seconds later, the next backend is requested too (None only falls back).
+        The attempts still running when the winner returned are passed to `cancel` (see `Cancellation`),
+        results that arrive after the winner to `discard`. Raises the last error if every backend failed.
+        `answered` is called with the backend whose result is returned.
+    """
+    started = time.monotonic()
+    if len(backends) == 1:
+        result = attempt(backends[0], lambda: None)
+        _observe(call_type, backends, backends[0], started, agent)
+        answered(backends[0])
+        return result
+    remaining = list(backends)
+    pending: Dict[Future, Backend] = {}
+    admission: Future = Future()  # of the last launched attempt
+    error: Optional[BaseException] = None
+
+    def launch() -> None:
+        nonlocal admission
+        backend = remaining.pop(0)
+        admission = Future()
+        pending[executor.submit(_run_attempt, attempt, backend, _admission(admission))] = backend
+
+    launch()
+    while pending:
+        waiting, timeout = set(pending), None
+        hedging = bool(remaining) and hedge_after is not None
+        if hedging and admission.done():
+            timeout = max(0.0, admission.result() + hedge_after - time.monotonic())
+        elif hedging:
+            waiting.add(admission)  # the timer starts with the admission
+        done, _ = wait(waiting, timeout=timeout, return_when=FIRST_COMPLETED)
+        done.discard(admission)
+        if not done:
+            if timeout is not None:
+                launch()
+            continue
+        for future in done:
+            backend = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                LLM_BACKEND_ERRORS.labels(backend.name).inc()
+                logging.warning("hedge: backend %s failed. Exception = %s", backend.name, str(e))
+                error = e
+                continue
+            for other, loser in pending.items():
+                cancel(loser)
+                other.add_done_callback(lambda f: _discard_late(discard, f))
+            _observe(call_type, backends, backend, started, agent)
+            answered(backend)
+            return result
+        if remaining:
+            launch()
+    assert error is not None
+    raise error
+
+
+async def ahedge(call_type: str, backends: List[Backend], attempt: Callable[[Backend, Callable[[], None]], Awaitable[T]],
+                 discard: Callable[[T], Awaitable[None]], agent: str = "", hedge_after: Optional[float] = None,
+                 answered: Callable[[Backend], None] = lambda backend: None) -> T:
+    """Async counterpart of `hedge`: the losing requests are cancelled."""
+    started = time.monotonic()
+    loop = asyncio.get_running_loop()
+    remaining = list(backends)
+    pending: Dict[asyncio.Future, Backend] = {}
+    admission: asyncio.Future = loop.create_future()
+    error: Optional[BaseException] = None
+
+    def launch() -> None:
+        nonlocal admission
+        backend = remaining.pop(0)
+        admission = loop.create_future()
+        pending[asyncio.ensure_future(attempt(backend, _admission(admission)))] = backend
+
+    launch()
+    try:
+        while pending:
+            waiting, timeout = set(pending), None
+            hedging = bool(remaining) and hedge_after is not None
+            if hedging and admission.done():
+                timeout = max(0.0, admission.result() + hedge_after - time.monotonic())
+            elif hedging:
+                waiting.add(admission)
+            done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            done.discard(admission)
+            if not done:
+                if timeout is not None:
+                    launch()
+                continue
+            winner = None
+            for task in done:
+                backend = pending.pop(task)
+                if task.exception() is not None:
+                    LLM_BACKEND_ERRORS.labels(backend.name).inc()
+                    logging.warning("ahedge: backend %s failed. Exception = %s", backend.name, str(task.exception()))
+                    error = task.exception()
+                elif winner is None:
+                    winner = backend, task.result()
+                else:
+                    await discard(task.result())
+            if winner is not None:
+                _observe(call_type, backends, winner[0], started, agent)
+                answered(winner[0])
+                return winner[1]
+            if remaining:
+                launch()
+    finally:
+        for task in pending:
+            task.cancel()
+    assert error is not None
+    raise error
+
+
+def create(backend: Backend, tokens: int, telemetry: Optional[CompletionTelemetry] = None,
+           admitted: Callable[[], None] = lambda: None, cancellation: Optional[Cancellation] = None, **kwargs) -> Any:
+    """
+        `chat.completions.create` admitted by the rate limiter (`admitted` is called after every admission),
+        retryable errors are retried with jittered backoff. A cancelled request is not sent.
+    """
+    retries = settings.LLM_RATE_LIMIT["RETRIES"]
+    for retry in range(retries + 1):
+        queued = time.monotonic()
+        if cancellation is not None:
+            cancellation.check()
+        limiter.acquire(backend.bucket, tokens)
+        if cancellation is not None:
+            cancellation.check()
+        admitted()
+        if telemetry is not None:
+            telemetry.queued(time.monotonic() - queued)
+        try:
+            return backend.client.chat.completions.create(model=backend.model, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if retry == retries:
+                raise
+            logging.warning("create: retrying %s. Exception = %s", backend.name, str(e))
+            time.sleep(backoff(retry))
+
+
+async def acreate(backend: Backend, tokens: int, telemetry: Optional[CompletionTelemetry] = None,
+                  admitted: Callable[[], None] = lambda: None, **kwargs) -> Any:
+    """Async counterpart of `create`."""
+    retries = settings.LLM_RATE_LIMIT["RETRIES"]
+    for retry in range(retries + 1):
+        queued = time.monotonic()
+        await limiter.aacquire(backend.bucket, tokens)
+        admitted()
+        if telemetry is not None:
+            telemetry.queued(time.monotonic() - queued)
+        try:
+            return await backend.async_client.chat.completions.create(model=backend.model, **kwargs)
+        except RETRYABLE_ERRORS as e:
+            if retry == retries:
+                raise
+            logging.warning("acreate: retrying %s. Exception = %s", backend.name, str(e))
+            await asyncio.sleep(backoff(retry))
+
+
+def _hedge_after(stream: bool) -> Optional[float]:
+    return settings.LLM_HEDGE_AFTER if stream else settings.LLM_HEDGE_AFTER_COMPLETE
+
+
+def complete(call_type: str, prompt_tokens: int = 0, stream: bool = False, agent_id: Optional[int] = None,
+             answered: Callable[[Backend], None] = lambda backend: None, **kwargs) -> Any:
+    """
+        `chat.completions.create(**kwargs)` on the backends of `call_type`. Streams are returned as `StartedStream`.
+        `prompt_tokens` (plus the expected completion length) is counted against the tokens per minute limit.
+        `agent_id` labels the metrics of Agent chats, `answered` is called with the backend that answered.
+    """
+    backends = get_backends(call_type)
+    tokens = prompt_tokens + settings.LLM_RATE_LIMIT["COMPLETION_TOKENS"]
+    agent = "" if agent_id is None else str(agent_id)
+    started = time.monotonic()
+
+    cancellations = {backend: Cancellation() for backend in backends}
+
+    def attempt(backend: Backend, admitted: Callable[[], None]) -> Any:
+        telemetry = CompletionTelemetry(call_type, agent, backend.model, started)
+        cancellation = cancellations[backend]
+        if stream:
+            response = create(backend, tokens, telemetry, admitted, cancellation,
+                              stream=True, stream_options={"include_usage": True}, **kwargs)
+            return StartedStream(cancellation.reading(response), telemetry)
+        response = create(backend, tokens, telemetry, admitted, cancellation, **kwargs)
+        telemetry.finish(response.usage)
+        return response
+
+    return hedge(call_type, backends, attempt, close_upstream if stream else lambda result: None, agent,
+                 _hedge_after(stream), answered, lambda backend: cancellations[backend].cancel())
+
+
+async def acomplete(call_type: str, prompt_tokens: int = 0, stream: bool = False, agent_id: Optional[int] = None,
+                    answered: Callable[[Backend], None] = lambda backend: None, **kwargs) -> Any:
+    """Async counterpart of `complete`. Streams are returned as `AsyncStartedStream`."""
+    backends = get_backends(call_type)
+    tokens = prompt_tokens + settings.LLM_RATE_LIMIT["COMPLETION_TOKENS"]
+    agent = "" if agent_id is None else str(agent_id)
+    started = time.monotonic()
+
+    async def attempt(backend: Backend, admitted: Callable[[], None]) -> Any:
+        telemetry = CompletionTelemetry(call_type, agent, backend.model, started)
+        if stream:
+            response = await acreate(
+                backend, tokens, telemetry, admitted, stream=True, stream_options={"include_usage": True}, **kwargs)
+            return await AsyncStartedStream.start(response, telemetry)
+        response = await acreate(backend, tokens, telemetry, admitted, **kwargs)
+        telemetry.finish(response.usage)
+        return response
+
+    async def discard(result: Any) -> None:
+        if stream:
+            await aclose_upstream(result)
+
+    return await ahedge(call_type, backends, attempt, discard, agent, _hedge_after(stream), answered)
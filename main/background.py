@@ -0,0 +1,27 @@
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable
+
+from django.conf import settings
+from django.db import close_old_connections
+
+executor = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix="background")
+
+
+def _run(func: Callable, *args, **kwargs):
+    close_old_connections()
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        logging.exception(e)
+        raise
+    finally:
+        close_old_connections()
+
+
+def run_in_background(func: Callable, *args, **kwargs) -> Future:
+    """
+        Runs `func(*args, **kwargs)` in the shared background thread pool, so the caller (e.g. a stream) does not wait for it.
+        Exceptions are logged (and set on the returned Future), stale database connections are closed around the call.
+    """
+    return executor.submit(_run, func, *args, **kwargs)
@@ -1,12 +1,28 @@
+import asyncio
 import logging
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import Future
 from typing import (
     Any,
+    AsyncIterable,
+    AsyncIterator,
+    Callable,
     Iterable,
+    Iterator,
     List,
+    Optional,
+    Tuple,
 )
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from openai.types.chat import ChatCompletionMessageParam
-from main.utils import generate_chat_completion
+from main.background import run_in_background
+from main.cache import is_replay
+from main.metrics import record_cancelled_stream, record_completed_stream
+from main.sse import FrameCoalescer
+from main.streams import aclose_upstream, close_upstream
+from main.utils import agenerate_chat_completion, generate_chat_completion
 
 
 class BaseGenerationAPI(ABC):
@@ -14,28 +30,133 @@ class BaseGenerationAPI(ABC):
         Base API for working with AI generatio
     """
     NOT_DEFINED = "Not defined."
+    HIGH_DEMAND = "Currently, the AI service is experiencing high demand, please try a few minutes later."
+    call_type = "chat"  # selects the backends in `settings.LLM_BACKENDS`
+    agent_id: Optional[int] = None  # labels the completion metrics
     _messages: List[ChatCompletionMessageParam] = []
+    _events: List[Tuple[str, Future]]
+    _deferred: List[Tuple[Callable, tuple, dict]]
+
+    def __init__(self) -> None:
+        self._events = []
+        self._deferred = []
 
     def _text_stream(self, generator: Iterable):
         """A generator that returns GPT's streaming response in Server-side event data format.
+        Small chunks are coalesced into fewer frames by `FrameCoalescer`,
+        the partial content is passed to `.checkpoint` every `settings.SSE_CHECKPOINT_INTERVAL` seconds.
+        If the stream is closed early (the client disconnected), the upstream stream is closed
+        and the content generated so far is passed to `.post_generate`.
 
         :param generator: OpenAi chat completion generator
         :type generator: Iterable
         :yield: text stream formatted for a server-side event.
         :rtype: Generator [bytes, Any, None]
         """
-        full_content = ""
-        for _, chunk in enumerate(generator):
-            answer = chunk.choices[0]  # type: ignore
-            if answer.finish_reason:
-                break
-            chunk_text: str = answer.delta.content or ""
-            full_content += chunk_text
-            chunk_text = chunk_text.replace("\n", "<br/>")
-            yield (f'data: {chunk_text}\n\n').encode()
-        self.post_generate(full_content)
+        parts: List[str] = []
+        coalescer = FrameCoalescer()
+        last_checkpoint = time.monotonic()
+        try:
+            for chunk in generator:
+                answer = chunk.choices[0]  # type: ignore
+                if answer.finish_reason:
+                    break
+                chunk_text: str = answer.delta.content or ""
+                parts.append(chunk_text)
+                if frame := coalescer.push(chunk_text):
+                    yield frame
+                    if coalescer.frames == 1:
+                        self.on_first_token()
+                    elif time.monotonic() - last_checkpoint >= settings.SSE_CHECKPOINT_INTERVAL:
+                        self.checkpoint("".join(parts))
+                        last_checkpoint = time.monotonic()
+                if self._events:
+                    yield from self._pop_events()
+            if frame := coalescer.flush():
+                yield frame
+        except GeneratorExit:
+            # Closed because the client is gone: stop generating, keep what was generated so far
+            close_upstream(generator)
+            record_cancelled_stream(type(self).__name__, "".join(parts), is_replay(generator))
+            if content := "".join(parts):
+                self.post_generate(content)
+            raise
+        record_completed_stream(type(self).__name__, "".join(parts), is_replay(generator))
+        self.post_generate("".join(parts))
+        yield from self._pop_events(wait=True)
+        yield ('data: Stop\0\n\n').encode()
+
+    async def _atext_stream(self, generator: AsyncIterable):
+        """Async counterpart of `._text_stream` for `AsyncOpenAI` streams.
+
+        The hooks are offloaded to a thread, so the ORM is never called from the event loop.
+
+        :param generator: AsyncOpenAi chat completion generator
+        :type generator: AsyncIterable
+        :yield: text stream formatted for a server-side event.
+        :rtype: AsyncGenerator [bytes, None]
+        """
+        parts: List[str] = []
+        coalescer = FrameCoalescer()
+        last_checkpoint = time.monotonic()
+        try:
+            async for chunk in generator:
+                answer = chunk.choices[0]  # type: ignore
+                if answer.finish_reason:
+                    break
+                chunk_text: str = answer.delta.content or ""
+                parts.append(chunk_text)
+                if frame := coalescer.push(chunk_text):
+                    yield frame
+                    if coalescer.frames == 1:
+                        await sync_to_async(self.on_first_token)()
+                    elif time.monotonic() - last_checkpoint >= settings.SSE_CHECKPOINT_INTERVAL:
+                        await sync_to_async(self.checkpoint)("".join(parts))
+                        last_checkpoint = time.monotonic()
+                if self._events:
+                    for frame in self._pop_events():
+                        yield frame
+            if frame := coalescer.flush():
+                yield frame
+        except (GeneratorExit, asyncio.CancelledError):
+            await aclose_upstream(generator)
+            record_cancelled_stream(type(self).__name__, "".join(parts), is_replay(generator))
+            if content := "".join(parts):
+                await sync_to_async(self.post_generate)(content)
+            raise
+        record_completed_stream(type(self).__name__, "".join(parts), is_replay(generator))
+        await sync_to_async(self.post_generate)("".join(parts))
+        if self._events:
+            await asyncio.wait([asyncio.wrap_future(future) for _, future in self._events])
+        for frame in self._pop_events():
+            yield frame
         yield ('data: Stop\0\n\n').encode()
 
+    def _pop_events(self, wait: bool = False) -> Iterator[bytes]:
+        """Yields the events added with `.add_event` that are ready (or all of them, if `wait`) as SSE frames."""
+        pending = []
+        for name, future in self._events:
+            if not wait and not future.done():
+                pending.append((name, future))
+                continue
+            try:
+                data = str(future.result()).replace("\n", " ")
+            except Exception:  # pylint: disable=broad-except
+                continue  # logged by `run_in_background`
+            yield (f'event: {name}\ndata: {data}\n\n').encode()
+        self._events = pending
+
+    def add_event(self, name: str, future: Future) -> None:
+        """
+            Sends the result of `future` to the client as a separate SSE event (`event: <name>`)
+            as soon as it is ready, but before the final Stop packet.
+        """
+        self._events.append((name, future))
+
+    def defer(self, func: Callable, *args, **kwargs) -> None:
+        """Registers a side effect that is run in the background after the first token was sent."""
+        self._deferred.append((func, args, kwargs))
+
     @abstractmethod
     def get_system_prompt(self, *args, **kwargs) -> str:
         """Returns system prompt based on initialization and/or additional arguments."""
@@ -75,16 +196,34 @@ class BaseGenerationAPI(ABC):
         """A helper function that is called in `.__text_stream` after the full completion and before the last message packet were sent."""
         return
 
+    def checkpoint(self, partial_content: str) -> None:
+        """A helper function that is called in `.__text_stream` periodically with the content streamed so far."""
+        return
+
     def pre_generate(self, *args, **kwargs) -> None:
         """A helper function that is called in `.__get_text_stream` before generating a chat completion from `self.messages`."""
         return
 
+    def on_first_token(self) -> None:
+        """A helper function that is called in `.__text_stream` after the first packet was sent. Runs the deferred side effects."""
+        for func, args, kwargs in self._deferred:
+            run_in_background(func, *args, **kwargs)
+
+    def _get_completion_stream(self):
+        """Requests the completion from inside the stream, so the view can return before OpenAI answers."""
+        try:
+            generator = generate_chat_completion(self.messages, stream=True, call_type=self.call_type, agent_id=self.agent_id)
+        except Exception as e:
+            logging.exception(e)
+            yield from self.fake_stream(self.HIGH_DEMAND)
+            return
+        yield from self._text_stream(generator)
+
     def _get_text_stream(self, *args, **kwargs):
         """Args and kwargs are passed down to `.pre_generate` and `.init_messages` -> `.get_system_prompt`."""
         self.init_messages(*args, **kwargs)
         self.pre_generate(*args, **kwargs)
-        generator = generate_chat_completion(self.messages, stream=True)
-        return self._text_stream(generator)
+        return self._get_completion_stream()
 
     def get_text_stream(self, *args, **kwargs) -> Any:
         """A simple wrapper with a possibility to add types when overriding."""
@@ -92,9 +231,41 @@ class BaseGenerationAPI(ABC):
             return self._get_text_stream(*args, **kwargs)
         except Exception as e:
             logging.exception(e)
-            return self.fake_stream("Currently, the AI service is experiencing high demand, please try a few minutes later.")
+            return self.fake_stream(self.HIGH_DEMAND)
+
+    async def _aget_completion_stream(self):
+        """Requests the completion from inside the stream, so the view can return before OpenAI answers."""
+        try:
+            generator = await agenerate_chat_completion(self.messages, stream=True, call_type=self.call_type, agent_id=self.agent_id)
+        except Exception as e:
+            logging.exception(e)
+            async for frame in self.afake_stream(self.HIGH_DEMAND):
+                yield frame
+            return
+        async for frame in self._atext_stream(generator):
+            yield frame
+
+    def aget_text_stream(self, *args, **kwargs) -> AsyncIterator[bytes]:
+        """
+            Async counterpart of `.get_text_stream` for views served over ASGI.
+
+            `.init_messages` and `.pre_generate` (ORM work) run in the calling sync view,
+            the returned async generator is consumed by the event loop and does not hold a worker thread.
+        """
+        try:
+            self.init_messages(*args, **kwargs)
+            self.pre_generate(*args, **kwargs)
+        except Exception as e:
+            logging.exception(e)
+            return self.afake_stream(self.HIGH_DEMAND)
+        return self._aget_completion_stream()
 
     def fake_stream(self, text):
         """Fake stream for streaming errors."""
         yield (f'data: {text}\n\n').encode()
         yield ('data: Stop\0\n\n').encode()
+
+    async def afake_stream(self, text):
+        """Async fake stream for streaming errors."""
+        yield (f'data: {text}\n\n').encode()
+        yield ('data: Stop\0\n\n').encode()
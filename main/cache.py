@@ -0,0 +1,252 @@
+import hashlib
+import json
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Collection,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+)
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice, ChoiceDelta
+from main.metrics import COMPLETION_CACHE_REQUESTS
+from main.streams import aclose_upstream, close_upstream
+
+
+class CompletionCacheBackend(ABC):
+    """Storage of the completion cache. Values are JSON strings."""
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[str]:
+        """Returns the value or `None` if it is missing or expired."""
+
+    @abstractmethod
+    def set(self, key: str, value: str, ttl: int) -> None:
+        """Stores the value for `ttl` seconds."""
+
+    async def aget(self, key: str) -> Optional[str]:
+        return self.get(key)
+
+    async def aset(self, key: str, value: str, ttl: int) -> None:
+        self.set(key, value, ttl)
+
+
+class LocMemBackend(CompletionCacheBackend):
+    """Per-process LRU cache with TTL. Cheap enough to be called from the event loop."""
+
+    def __init__(self, max_entries: int = 1000) -> None:
+        self.max_entries = max_entries
+        self._data: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+class DjangoCacheBackend(CompletionCacheBackend):
+    """Stores completions in one of `settings.CACHES` (e.g. Redis or database cache shared by all workers)."""
+
+    def __init__(self, alias: str = "default", key_prefix: str = "completion") -> None:
+        self.alias = alias
+        self.key_prefix = key_prefix
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(f"{self.key_prefix}:{key}")
+
+    def set(self, key, value, ttl):
+        self.cache.set(f"{self.key_prefix}:{key}", value, ttl)
+
+    async def aget(self, key):
+        return await self.cache.aget(f"{self.key_prefix}:{key}")
+
+    async def aset(self, key, value, ttl):
+        await self.cache.aset(f"{self.key_prefix}:{key}", value, ttl)
+
+
+class Replay:
+    """A cached stream replayed chunk by chunk: nothing is generated for it (see `main.metrics`)."""
+
+    def __init__(self, chunks: List[ChatCompletionChunk]) -> None:
+        self._chunks = iter(chunks)
+
+    def __iter__(self) -> Iterator[ChatCompletionChunk]:
+        return self
+
+    def __next__(self) -> ChatCompletionChunk:
+        return next(self._chunks)
+
+    def __aiter__(self) -> AsyncIterator[ChatCompletionChunk]:
+        return self
+
+    async def __anext__(self) -> ChatCompletionChunk:
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            raise StopAsyncIteration from None
+
+
+def is_replay(stream: Any) -> bool:
+    return isinstance(stream, Replay)
+
+
+class CompletionCache:
+    """
+        Exact-match cache of chat completions keyed by a hash of (model, messages, temperature, response_format).
+        Only the call types listed in `call_types` are cached: e.g. chat answers must not repeat themselves.
+
+        Non-streamed completions are returned as `ChatCompletion`. Streamed completions are recorded
+        delta by delta and replayed as `ChatCompletionChunk`s, so they go through the regular
+        SSE formatting (e.g. `BaseGenerationAPI._text_stream`).
+    """
+    backend: CompletionCacheBackend
+
+    def __init__(self, backend: CompletionCacheBackend, ttl: int, max_temperature: float = 0,
+                 call_types: Collection[str] = ()) -> None:
+        self.backend = backend
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.call_types = frozenset(call_types)
+
+    @classmethod
+    def from_settings(cls) -> "CompletionCache":
+        config = settings.COMPLETION_CACHE
+        backend = import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+        return cls(backend, config.get("TTL", 60 * 60), config.get("MAX_TEMPERATURE", 0), config.get("CALL_TYPES", ()))
+
+    def make_key(self, call_type: str, model: str, messages: Any, temperature: float,
+                 response_format: Any) -> Optional[str]:
+        """Returns the cache key or `None` if the request should not be cached."""
+        if call_type not in self.call_types or temperature > self.max_temperature:
+            return None
+        payload = json.dumps([model, messages, temperature, response_format], sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _count(self, value: Optional[str], stream: bool):
+        COMPLETION_CACHE_REQUESTS.labels(result="miss" if value is None else "hit", stream=stream).inc()
+
+    def _load_completion(self, value: Optional[str]) -> Optional[ChatCompletion]:
+        self._count(value, False)
+        if value is None:
+            return None
+        return ChatCompletion.model_validate_json(value)
+
+    def _load_chunks(self, value: Optional[str]) -> Optional[List[ChatCompletionChunk]]:
+        self._count(value, True)
+        if value is None:
+            return None
+        data = json.loads(value)
+        chunks = [
+            ChatCompletionChunk(
+                id=data["id"],
+                choices=[Choice(index=0, delta=ChoiceDelta(content=delta), finish_reason=None)],
+                created=data["created"],
+                model=data["model"],
+                object="chat.completion.chunk",
+            )
+            for delta in data["deltas"]
+        ]
+        chunks.append(ChatCompletionChunk(
+            id=data["id"],
+            choices=[Choice(index=0, delta=ChoiceDelta(), finish_reason=data["finish_reason"])],
+            created=data["created"],
+            model=data["model"],
+            object="chat.completion.chunk",
+        ))
+        return chunks
+
+    @staticmethod
+    def _dump_chunks(first: ChatCompletionChunk, deltas: List[str], finish_reason: str) -> str:
+        return json.dumps({
+            "id": first.id,
+            "created": first.created,
+            "model": first.model,
+            "deltas": deltas,
+            "finish_reason": finish_reason,
+        })
+
+    def get_completion(self, key: str) -> Optional[ChatCompletion]:
+        return self._load_completion(self.backend.get(key))
+
+    def set_completion(self, key: str, completion: ChatCompletion) -> None:
+        self.backend.set(key, completion.model_dump_json(), self.ttl)
+
+    def replay(self, key: str) -> Optional[Replay]:
+        """Returns an iterator over the cached stream or `None` on a miss."""
+        chunks = self._load_chunks(self.backend.get(key))
+        return Replay(chunks) if chunks is not None else None
+
+    def record(self, key: str, stream: Iterable[ChatCompletionChunk]) -> Iterator[ChatCompletionChunk]:
+        """Passes the stream through and caches it once it finished. Interrupted streams are not cached, closing the iterator closes `stream`."""
+        first = None
+        deltas = []
+        try:
+            for chunk in stream:
+                first = first or chunk
+                if chunk.choices:
+                    answer = chunk.choices[0]
+                    if answer.delta and answer.delta.content:
+                        deltas.append(answer.delta.content)
+                    if answer.finish_reason:
+                        self.backend.set(key, self._dump_chunks(first, deltas, answer.finish_reason), self.ttl)
+                yield chunk
+        finally:
+            close_upstream(stream)
+
+    async def aget_completion(self, key: str) -> Optional[ChatCompletion]:
+        return self._load_completion(await self.backend.aget(key))
+
+    async def aset_completion(self, key: str, completion: ChatCompletion) -> None:
+        await self.backend.aset(key, completion.model_dump_json(), self.ttl)
+
+    async def areplay(self, key: str) -> Optional[Replay]:
+        chunks = self._load_chunks(await self.backend.aget(key))
+        return Replay(chunks) if chunks is not None else None
+
+    async def arecord(self, key: str, stream: AsyncIterable[ChatCompletionChunk]) -> AsyncIterator[ChatCompletionChunk]:
+        first = None
+        deltas = []
+        try:
+            async for chunk in stream:
+                first = first or chunk
+                if chunk.choices:
+                    answer = chunk.choices[0]
+                    if answer.delta and answer.delta.content:
+                        deltas.append(answer.delta.content)
+                    if answer.finish_reason:
+                        await self.backend.aset(key, self._dump_chunks(first, deltas, answer.finish_reason), self.ttl)
+                yield chunk
+        finally:
+            await aclose_upstream(stream)
+
+
+completion_cache = CompletionCache.from_settings()
@@ -0,0 +1,117 @@
+from dataclasses import dataclass
+from typing import (
+    Any,
+    List,
+    Optional,
+)
+from openai.types.chat import ChatCompletion, ChatCompletionMessageParam
+from main.models import Agent
+from main.utils import count_tokens, generate_chat_completion
+from jlab.models import ChatSummary, ProjectTask
+
+
+@dataclass
+class ChatTurn:
+    message_id: int
+    role: str
+    content: Any
+    tokens: int
+    pinned: bool = False
+
+
+class ContextWindow:
+    """
+        Fits the history of an AI chat into the Agent's token budget (`Agent.context_budget`).
+
+        The most recent turns are kept verbatim. Turns already covered by the chat's ChatSummary
+        are replaced with the summary. Older turns that no longer fit are collected in `.overflow`;
+        `.update_summary` folds them into the summary after the answer was generated, so the prompt
+        stays bounded without a summarization call before the first token.
+    """
+    MESSAGE_OVERHEAD = 4  # tokens added by the chat format to every message
+    SUMMARY_SYS_PROMPT = (
+        "Summarize the conversation between a user and an AI assistant. Keep the facts, decisions, names, "
+        "numbers and open questions the assistant needs to continue the conversation. "
+        "If a previous summary is provided, extend it. Answer with the summary only, in at most 300 words."
+    )
+    agent: Agent
+    task: ProjectTask
+    summary: Optional[ChatSummary]
+    overflow: List[ChatTurn]
+
+    def __init__(self, agent: Agent, task: ProjectTask, system_prompt: str = "") -> None:
+        self.agent = agent
+        self.task = task
+        self.budget = agent.context_budget - count_tokens(system_prompt) - self.MESSAGE_OVERHEAD
+        self.summary = ChatSummary.objects.filter(task=task, agent_type=agent.type).first()
+        self.overflow = []
+
+    def fit(self, turns: List[ChatTurn]) -> List[ChatCompletionMessageParam]:
+        """Returns the messages to send, in the original order. Pinned turns (the new request) are always kept."""
+        covered_until = self.summary.covered_until if self.summary else 0
+        budget = self.budget - sum(turn.tokens + self.MESSAGE_OVERHEAD for turn in turns if turn.pinned)
+        if self.summary:
+            budget -= self.summary.token_count + self.MESSAGE_OVERHEAD
+        kept = set()
+        overflowed = False
+        for i in reversed(range(len(turns))):
+            turn = turns[i]
+            if turn.pinned:
+                kept.add(i)
+                continue
+            if turn.message_id <= covered_until:
+                continue
+            if not overflowed and turn.tokens + self.MESSAGE_OVERHEAD <= budget:
+                budget -= turn.tokens + self.MESSAGE_OVERHEAD
+                kept.add(i)
+            else:
+                # keep the window contiguous: everything older than the first turn that didn't fit is summarized
+                overflowed = True
+                self.overflow.insert(0, turn)
+        messages: List[ChatCompletionMessageParam] = []
+        if self.summary:
+            messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{self.summary.content}",
+            })
+        for i, turn in enumerate(turns):
+            if i in kept:
+                messages.append({"role": turn.role, "content": turn.content})  # type: ignore
+        return messages
+
+    def update_summary(self) -> None:
+        """Folds `.overflow` into the persisted ChatSummary. Makes a (non-streamed) chat completion."""
+        if not self.overflow:
+            return
+        summary = ChatSummary.objects.filter(task=self.task, agent_type=self.agent.type).first()
+        covered_until = summary.covered_until if summary else 0
+        turns = [turn for turn in self.overflow if turn.message_id > covered_until]
+        if not turns:
+            return
+        transcript = "\n\n".join(
+            f"{'Assistant' if turn.role == 'assistant' else 'User'}: {turn.content}" for turn in turns
+        )
+        if summary:
+            transcript = f"Previous summary:\n{summary.content}\n\nConversation:\n{transcript}"
+        messages: List[ChatCompletionMessageParam] = [
+            {
+                "role": "system",
+                "content": self.SUMMARY_SYS_PROMPT,
+            },
+            {
+                "role": "user",
+                "content": transcript,
+            }
+        ]
+        response = generate_chat_completion(messages, call_type="summary")
+        assert isinstance(response, ChatCompletion)
+        content = response.choices[0].message.content or ""
+        ChatSummary.objects.update_or_create(
+            task=self.task,
+            agent_type=self.agent.type,
+            defaults={
+                "content": content,
+                "token_count": count_tokens(content),
+                "covered_until": turns[-1].message_id,
+            }
+        )
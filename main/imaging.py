@@ -0,0 +1,36 @@
+"""
+    Resizing and encoding of image renditions with Pillow (see `main.renditions`).
+    Runs in spawned worker processes, so it must not import Django.
+"""
+import io
+from typing import List, Sequence, Tuple
+
+from PIL import Image, ImageOps
+
+Rendition = Tuple[str, int, int, bytes]  # format, width, height, encoded image
+
+
+def supported_formats(formats: Sequence[str]) -> List[str]:
+    """The formats Pillow can save here (AVIF needs Pillow 11.2 or the `pillow-avif-plugin`)."""
+    Image.init()
+    return [fmt for fmt in formats if fmt.upper() in Image.SAVE]
+
+
+def render(data: bytes, widths: Sequence[int], formats: Sequence[str], quality: int) -> Tuple[int, int, List[Rendition]]:
+    """
+        Returns the size of the image `data` and its renditions in every format: one per width smaller
+        than the original and one at the original width (images are never upscaled).
+    """
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)  # the first frame of animations
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+        renditions: List[Rendition] = []
+        for width in sorted({width for width in widths if width < image.width} | {image.width}):
+            height = max(1, round(image.height * width / image.width))
+            resized = image if width == image.width else image.resize((width, height), Image.Resampling.LANCZOS)
+            for fmt in formats:
+                buffer = io.BytesIO()
+                resized.save(buffer, fmt.upper(), quality=quality)
+                renditions.append((fmt, width, height, buffer.getvalue()))
+        return image.width, image.height, renditions
@@ -0,0 +1,153 @@
+"""
+    Bounded in-process executor for slow jobs (image generation, see `main.tasks`), so views return right away
+    without a Celery broker.
+
+    Jobs run on a fixed number of threads with a bounded queue: a job that does not fit is rejected
+    with `JobQueueFull` instead of piling up in memory. A failed job is retried with exponential backoff
+    (`on_retry` is called before every retry), `on_failure` is called once it failed for good, or if it is dropped
+    because the process shuts down (`JobExecutor.shutdown`, called by the ASGI lifespan in `ai.asgi` and at exit).
+    A delayed job waits on a timer and takes a worker only when it starts.
+
+    `image_jobs` generates images (`main.tasks`), `rendition_jobs` builds image renditions (`main.renditions`).
+"""
+import atexit
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from functools import partial
+from typing import Callable, Dict, Optional
+
+from django.conf import settings
+from django.db import close_old_connections
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobExecutor:
+    def __init__(self, name: str, workers: int, max_queue: int, retries: int,
+                 backoff_base: float, backoff_cap: float) -> None:
+        self.name = name
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        self._jobs: Dict[Future, Optional[Callable[[], None]]] = {}  # submitted and not done, with their `on_failure`
+        self._timers: Dict[Future, threading.Timer] = {}  # delayed jobs that did not start
+
+    def submit(self, func: Callable, *args, delay: float = 0, on_retry: Optional[Callable[[], None]] = None,
+               on_failure: Optional[Callable[[], None]] = None) -> Future:
+        """Schedules `func(*args)` to start after `delay` seconds, a delayed job counts against the queue."""
+        if self._stopping.is_set() or not self._slots.acquire(blocking=False):
+            raise JobQueueFull(f"{self.name}: too many jobs.")
+        job = (func, args, on_retry, on_failure)
+        if delay:
+            future: Future = Future()
+            timer = threading.Timer(delay, self._start, (future, job))
+            timer.daemon = True
+            with self._lock:
+                self._jobs[future] = on_failure
+                self._timers[future] = timer
+            future.add_done_callback(self._done)
+            timer.start()
+            return future
+        future = self._executor.submit(self._run, *job)
+        with self._lock:
+            self._jobs[future] = on_failure
+        future.add_done_callback(self._done)
+        return future
+
+    def _start(self, future: Future, job: tuple) -> None:
+        """Submits a delayed job when its timer fires, its future follows the one of the executor."""
+        with self._lock:
+            if self._timers.pop(future, None) is None or not future.set_running_or_notify_cancel():
+                return  # dropped by `shutdown` (or cancelled)
+            started = self._executor.submit(self._run, *job)
+        started.add_done_callback(partial(self._started_done, future, job[3]))
+
+    def _started_done(self, future: Future, on_failure: Optional[Callable[[], None]], started: Future) -> None:
+        if started.cancelled():  # dropped by `shutdown` before a worker took it
+            self._call(on_failure)
+        future.set_result(None)
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self._jobs.pop(future, None)
+        self._slots.release()
+
+    def _run(self, func: Callable, args: tuple, on_retry: Optional[Callable[[], None]],
+             on_failure: Optional[Callable[[], None]]) -> None:
+        for attempt in range(self.retries + 1):
+            close_old_connections()
+            try:
+                func(*args)
+                return
+            except Exception as e:  # pylint: disable=broad-except
+                logging.warning("%s: %s failed (attempt %d). Exception = %s", self.name, func.__name__, attempt + 1, e)
+            finally:
+                close_old_connections()
+            if attempt == self.retries:
+                break
+            self._call(on_retry)
+            if self._stopping.wait(min(self.backoff_cap, self.backoff_base * 2 ** attempt)):
+                break  # shutting down, the job is not retried
+        self._call(on_failure)
+
+    @staticmethod
+    def _call(callback: Optional[Callable[[], None]]) -> None:
+        if callback is None:
+            return
+        try:
+            callback()
+        except Exception as e:  # pylint: disable=broad-except
+            logging.exception(e)
+        finally:
+            close_old_connections()
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        """
+            Stops accepting jobs, drops the ones that did not start (calling their `on_failure`), stops retries
+            and waits up to `timeout` seconds for the running ones.
+        """
+        if self._stopping.is_set():
+            return
+        self._stopping.set()
+        with self._lock:
+            jobs = dict(self._jobs)  # cancelled jobs leave `_jobs` right away
+            timers, self._timers = self._timers, {}
+        for future, timer in timers.items():
+            timer.cancel()
+            future.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        for future, on_failure in jobs.items():
+            if future.cancelled():
+                self._call(on_failure)
+        running = [future for future in jobs if not future.cancelled()]
+        if running:
+            _, not_done = wait(running, timeout)
+            if not_done:
+                logging.warning("%s: %d jobs still running at shutdown.", self.name, len(not_done))
+
+
+def from_settings(name: str, config: dict) -> JobExecutor:
+    """An executor configured like `settings.IMAGE_JOBS`, shut down when the process exits."""
+    executor = JobExecutor(
+        name,
+        workers=config["WORKERS"],
+        max_queue=config["MAX_QUEUE"],
+        retries=config["RETRIES"],
+        backoff_base=config["BACKOFF_BASE"],
+        backoff_cap=config["BACKOFF_CAP"],
+    )
+    # Outside of ASGI (e.g. management commands) `concurrent.futures` runs the queued jobs before `atexit`,
+    # only the delayed ones are dropped here
+    atexit.register(executor.shutdown, config["SHUTDOWN_TIMEOUT"])
+    return executor
+
+
+image_jobs = from_settings("image_jobs", settings.IMAGE_JOBS)
+rendition_jobs = from_settings("rendition_jobs", settings.IMAGE_RENDITIONS["JOBS"])
@@ -0,0 +1,234 @@
+"""
+    Locks of in-flight generations shared by all worker processes (single-flight, see `AiViewSet.stream`).
+
+    Within a process identical requests attach to the running `main.streams.StreamBuffer`. Across processes
+    the worker that acquires the generation's lock runs it, the others follow the answer it persists
+    and record that in the shared cache (`SharedGeneration`).
+"""
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Iterator, Optional, Set
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connection, connections
+from django.utils.module_loading import import_string
+
+
+class LockBackend(ABC):
+    shared = True  # other processes may follow the generations
+
+    @abstractmethod
+    def acquire(self, key: str) -> Any:
+        """Returns a handle if the lock was free (does not wait), otherwise `None`."""
+
+    @abstractmethod
+    def release(self, handle: Any) -> None:
+        pass
+
+    def locked(self, key: str) -> bool:
+        handle = self.acquire(key)
+        if handle is None:
+            return True
+        self.release(handle)
+        return False
+
+
+class AdvisoryLockBackend(LockBackend):
+    """
+        Postgres session level advisory locks, all taken on one connection of the process (closing it releases
+        the locks even if the worker dies), whatever the number of running generations. A session may take
+        its own lock again, so the locks the process holds are also tracked here.
+    """
+
+    def __init__(self) -> None:
+        self._connection: Any = None
+        self._session = 0  # incremented when the connection is replaced, its locks were released with it
+        self._held: Set[int] = set()
+        self._mutex = threading.Lock()
+
+    @staticmethod
+    def _lock_id(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big", signed=True)
+
+    def _reset(self) -> None:
+        with contextlib.suppress(DatabaseError):
+            self._connection.close()
+        self._connection = None
+        self._session += 1
+        self._held.clear()
+
+    def _execute(self, sql: str, lock_id: int) -> bool:
+        if self._connection is None:
+            self._connection = connections.create_connection(DEFAULT_DB_ALIAS)
+            self._connection.inc_thread_sharing()  # used by the threads (or tasks) that run the generations
+        try:
+            with self._connection.cursor() as cursor:
+                cursor.execute(sql, [lock_id])
+                return cursor.fetchone()[0]
+        except DatabaseError:
+            self._reset()
+            raise
+
+    def acquire(self, key: str) -> Any:
+        lock_id = self._lock_id(key)
+        with self._mutex:
+            if lock_id in self._held:
+                return None
+            try:
+                acquired = self._execute("SELECT pg_try_advisory_lock(%s)", lock_id)
+            except DatabaseError as e:  # e.g. the idle connection was closed by the server
+                logging.warning("AdvisoryLockBackend: reconnecting. Exception = %s", str(e))
+                acquired = self._execute("SELECT pg_try_advisory_lock(%s)", lock_id)
+            if not acquired:
+                return None
+            self._held.add(lock_id)
+            return self._session, lock_id
+
+    def release(self, handle: Any) -> None:
+        session, lock_id = handle
+        with self._mutex:
+            if session != self._session:
+                return  # released with the connection it was taken on
+            self._held.discard(lock_id)
+            self._execute("SELECT pg_advisory_unlock(%s)", lock_id)
+
+    def locked(self, key: str) -> bool:
+        """Checks `pg_locks` on the request's connection instead of opening one."""
+        lock_id = self._lock_id(key) & 0xFFFFFFFFFFFFFFFF
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT EXISTS(SELECT 1 FROM pg_locks WHERE locktype = 'advisory' AND classid = %s AND objid = %s"
+                " AND objsubid = 1 AND granted)",
+                [lock_id >> 32, lock_id & 0xFFFFFFFF],
+            )
+            return cursor.fetchone()[0]
+
+
+class FileLockBackend(LockBackend):
+    """`flock` on one file per key in `path`, for the processes of one machine (development and tests)."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def acquire(self, key: str) -> Any:
+        file = open(os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest() + ".lock"), "a")  # pylint: disable=consider-using-with
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            file.close()
+            return None
+        return file
+
+    def release(self, handle: Any) -> None:
+        fcntl.flock(handle, fcntl.LOCK_UN)
+        handle.close()
+
+
+class LocalLockBackend(LockBackend):
+    """No coordination between processes (`StreamRegistry` already deduplicates within one)."""
+    shared = False
+
+    def acquire(self, key: str) -> Any:
+        return key
+
+    def release(self, handle: Any) -> None:
+        pass
+
+    def locked(self, key: str) -> bool:
+        return False
+
+
+class SharedGeneration:
+    """
+        What the processes sharing a generation (`key`) know about each other, in the shared cache.
+
+        The worker holding the lock publishes the newest answer that existed when it started (`.start`), so
+        followers only stream answers saved after it. Followers report themselves on every poll (`.follow`),
+        the worker treats a process following the generation like a subscriber (see `StreamBuffer.shared`).
+    """
+
+    def __init__(self, key: str) -> None:
+        self.since_key = f"generation:{key}:since"
+        self.followed_key = f"generation:{key}:followed"
+        self._followed_at = float("-inf")
+
+    @property
+    def _cache(self):
+        return caches[settings.STREAM_LOCK["CACHE"]]
+
+    def start(self, since: int) -> None:
+        """Called by the worker holding the lock before it generates: its answer is saved after the answer `since`."""
+        self._cache.set(self.since_key, since, settings.STREAM_LOCK["STATE_TTL"])
+        self._cache.delete(self.followed_key)  # followers of a previous generation
+
+    def finish(self) -> None:
+        """Called before the lock is released, so followers of the next generation do not read a stale `since`."""
+        self._cache.delete(self.since_key)
+
+    def since(self) -> Optional[int]:
+        return self._cache.get(self.since_key)
+
+    def follow(self) -> None:
+        """Called by a follower on every poll, writes at most every `FOLLOWER_TTL / 2` seconds."""
+        now = time.monotonic()
+        if now - self._followed_at >= settings.STREAM_LOCK["FOLLOWER_TTL"] / 2:
+            self._cache.set(self.followed_key, time.time(), settings.STREAM_LOCK["STATE_TTL"])
+            self._followed_at = now
+
+    def followed(self) -> bool:
+        """A process followed the generation since it started (a follower received its answer)."""
+        return self._cache.get(self.followed_key) is not None
+
+    def following(self) -> bool:
+        """A process followed the generation within `settings.STREAM_LOCK["FOLLOWER_TTL"]` seconds."""
+        followed_at = self._cache.get(self.followed_key)
+        return followed_at is not None and time.time() - followed_at < settings.STREAM_LOCK["FOLLOWER_TTL"]
+
+
+def hold_lock(stream: Iterator[bytes], handle: Any, shared: Optional[SharedGeneration] = None) -> Iterator[bytes]:
+    """Yields from the generation's stream and releases its lock when the stream ends or is closed."""
+    try:
+        yield from stream
+    finally:
+        try:
+            if shared is not None:
+                shared.finish()
+        finally:
+            stream_locks.release(handle)
+
+
+async def ahold_lock(stream: AsyncIterator[bytes], handle: Any,
+                     shared: Optional[SharedGeneration] = None) -> AsyncIterator[bytes]:
+    """Async counterpart of `hold_lock`."""
+    try:
+        async for frame in stream:
+            yield frame
+    finally:
+        try:
+            if shared is not None:
+                await sync_to_async(shared.finish)()
+        finally:
+            await sync_to_async(stream_locks.release, thread_sensitive=False)(handle)
+
+
+def lock_key(key: Any) -> str:
+    return ":".join(str(part) for part in key)
+
+
+def _from_settings() -> LockBackend:
+    config = settings.STREAM_LOCK
+    if not config.get("BACKEND"):
+        return LocalLockBackend()
+    return import_string(config["BACKEND"])(**config.get("OPTIONS", {}))
+
+
+stream_locks = _from_settings()
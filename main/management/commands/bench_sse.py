@@ -0,0 +1,102 @@
+import random
+import socket
+import threading
+import time
+from functools import partial
+from types import SimpleNamespace
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+
+from main.base_api import BaseGenerationAPI
+from main.sse import FrameCoalescer
+
+
+class SimulatedClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class BenchmarkAPI(BaseGenerationAPI):
+    def get_system_prompt(self, *args, **kwargs):
+        return ""
+
+    def get_user_prompt(self, *args, **kwargs):
+        return ""
+
+
+def legacy_text_stream(generator):
+    """`BaseGenerationAPI._text_stream` before coalescing: one frame per delta, quadratic accumulation."""
+    full_content = ""
+    for chunk in generator:
+        answer = chunk.choices[0]
+        if answer.finish_reason:
+            break
+        chunk_text: str = answer.delta.content or ""
+        full_content += chunk_text
+        chunk_text = chunk_text.replace("\n", "<br/>")
+        yield (f'data: {chunk_text}\n\n').encode()
+    yield ('data: Stop\0\n\n').encode()
+
+
+def chunks(deltas, clock: SimulatedClock, interval: float):
+    for delta in deltas:
+        clock.now += interval
+        yield SimpleNamespace(choices=[SimpleNamespace(finish_reason=None, delta=SimpleNamespace(content=delta))])
+    yield SimpleNamespace(choices=[SimpleNamespace(finish_reason="stop", delta=SimpleNamespace(content=None))])
+
+
+class Command(BaseCommand):
+    help = "Benchmarks SSE framing of a completion stream: frames per second and CPU per stream, before and after coalescing."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--streams", type=int, default=200)
+        parser.add_argument("--tokens", type=int, default=2000, help="deltas per stream")
+        parser.add_argument("--token-interval", type=float, default=0.02, help="simulated seconds between deltas")
+        parser.add_argument("--window", type=float, default=None, help="defaults to settings.SSE_COALESCE_WINDOW")
+        parser.add_argument("--max-bytes", type=int, default=None, help="defaults to settings.SSE_COALESCE_BYTES")
+
+    def run(self, stream_factory, deltas, interval, streams):
+        """Every frame is sent over a local socket, so the per-frame syscall is part of the measured CPU time."""
+        frames = 0
+        sent = 0
+        writer, reader = socket.socketpair()
+        drain = threading.Thread(target=lambda: all(iter(lambda: reader.recv(65536), b"")), daemon=True)
+        drain.start()
+        started = time.process_time()
+        for _ in range(streams):
+            clock = SimulatedClock()
+            for frame in stream_factory(chunks(deltas, clock, interval), clock):
+                writer.sendall(frame)
+                frames += 1
+                sent += len(frame)
+        cpu = time.process_time() - started
+        writer.close()
+        drain.join()
+        reader.close()
+        duration = len(deltas) * interval
+        return frames / streams / duration, cpu / streams * 1000, sent / streams
+
+    def handle(self, *args, **options):
+        rng = random.Random(0)
+        words = ["the", " plan", " for", " your", " client", ",", " and", " deliverables", ".", "\n", " a", "ing"]
+        deltas = [rng.choice(words) for _ in range(options["tokens"])]
+        interval = options["token_interval"]
+        streams = options["streams"]
+
+        def before(generator, clock):
+            return legacy_text_stream(generator)
+
+        def after(generator, clock):
+            coalescer = partial(FrameCoalescer, options["window"], options["max_bytes"], clock)
+            with mock.patch("main.base_api.FrameCoalescer", coalescer):
+                yield from BenchmarkAPI()._text_stream(generator)
+
+        self.stdout.write(f"{streams} streams x {len(deltas)} deltas, one delta every {interval * 1000:.0f}ms\n")
+        self.stdout.write(f"{'':<8}{'frames/s':>12}{'CPU ms/stream':>16}{'bytes/stream':>14}")
+        for name, factory in [("before", before), ("after", after)]:
+            fps, cpu, sent = self.run(factory, deltas, interval, streams)
+            self.stdout.write(f"{name:<8}{fps:>12.1f}{cpu:>16.2f}{sent:>14.0f}")
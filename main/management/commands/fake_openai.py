@@ -0,0 +1,158 @@
+import json
+import random
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from django.core.management.base import BaseCommand
+
+WORDS = ["the", " plan", " for", " your", " client", ",", " and", " deliverables", ".", "\n", " a", "ing"]
+PROJECT = {
+    "title": "Brand launch",
+    "tasks": ["Research the market", "Design the logo", "Write the landing page", "Client communication"],
+}
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """
+        OpenAI compatible chat completions, images and models endpoints with simulated latency.
+        `server.options` holds the command options.
+    """
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API, streams use chunked encoding
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        if self.server.options["verbosity"] > 1:  # type: ignore
+            super().log_message(format, *args)
+
+    @property
+    def options(self) -> dict:
+        return self.server.options  # type: ignore
+
+    def send_json(self, status: int, body: dict, headers: dict = {}) -> None:  # pylint: disable=dangerous-default-value
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def read_body(self) -> dict:
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def inject_error(self) -> bool:
+        """Answers with a 429 or a 500 at the configured rates."""
+        roll = random.random()
+        if roll < self.options["rate_limit_rate"]:
+            self.send_json(429, {"error": {"message": "Rate limit reached (fake).", "type": "requests",
+                                           "code": "rate_limit_exceeded"}}, {"Retry-After": "1"})
+            return True
+        if roll < self.options["rate_limit_rate"] + self.options["error_rate"]:
+            self.send_json(500, {"error": {"message": "The server had an error (fake).", "type": "server_error"}})
+            return True
+        return False
+
+    def completion_text(self, body: dict) -> list:
+        if (body.get("response_format") or {}).get("type") == "json_object":
+            text = json.dumps(PROJECT, indent=2)
+            return [text[i:i + 4] for i in range(0, len(text), 4)]
+        return [random.choice(WORDS) for _ in range(self.options["tokens"])]
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            self.send_json(200, {"object": "list", "data": [{"id": "gpt-4o", "object": "model", "created": 0,
+                                                             "owned_by": "fake"}]})
+        else:
+            self.send_json(404, {"error": {"message": "Not found."}})
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            self.chat_completions(body)
+        elif self.path.rstrip("/").endswith("/images/generations"):
+            self.images(body)
+        else:
+            self.send_json(404, {"error": {"message": "Not found."}})
+
+    def chat_completions(self, body: dict) -> None:
+        if self.inject_error():
+            return
+        deltas = self.completion_text(body)
+        model = body.get("model", "gpt-4o")
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        usage = {"prompt_tokens": 100, "completion_tokens": len(deltas), "total_tokens": 100 + len(deltas)}
+        time.sleep(self.options["ttft"])
+        if not body.get("stream"):
+            time.sleep(len(deltas) / self.options["tokens_per_second"])
+            self.send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": "".join(deltas)}}],
+                "usage": usage,
+            })
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def event(choices: list, **extra) -> None:
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": model, "choices": choices, **extra}
+            self.write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        interval = 1 / self.options["tokens_per_second"]
+        try:
+            for delta in deltas:
+                event([{"index": 0, "delta": {"content": delta}, "finish_reason": None}])
+                time.sleep(interval)
+            event([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if (body.get("stream_options") or {}).get("include_usage"):
+                event([], usage=usage)
+            self.write_chunk(b"data: [DONE]\n\n")
+            self.write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True  # the client cancelled the stream
+
+    def images(self, body: dict) -> None:
+        if self.inject_error():
+            return
+        time.sleep(self.options["image_latency"])
+        self.send_json(200, {
+            "created": int(time.time()),
+            "data": [{"url": f"https://example.com/fake/{uuid.uuid4().hex}.png", "revised_prompt": body.get("prompt")}
+                     for _ in range(body.get("n", 1))],
+        })
+
+
+class Command(BaseCommand):
+    help = (
+        "Runs a local OpenAI compatible server (chat completions, images, models) with simulated latency and errors. "
+        "Point the app at it with OPENAI_BASE_URL=http://127.0.0.1:<port>/v1 to load-test without spending tokens."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8808)
+        parser.add_argument("--ttft", type=float, default=0.5, help="seconds before the first token")
+        parser.add_argument("--tokens-per-second", type=float, default=50)
+        parser.add_argument("--tokens", type=int, default=300, help="deltas per completion")
+        parser.add_argument("--error-rate", type=float, default=0, help="share of requests answered with 500")
+        parser.add_argument("--rate-limit-rate", type=float, default=0, help="share of requests answered with 429")
+        parser.add_argument("--image-latency", type=float, default=10, help="seconds per image generation")
+
+    def handle(self, *args, **options):
+        server = ThreadingHTTPServer((options["host"], options["port"]), FakeOpenAIHandler)
+        server.daemon_threads = True
+        server.options = options  # type: ignore
+        self.stdout.write(f"Fake OpenAI API on http://{options['host']}:{options['port']}/v1")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -0,0 +1,143 @@
+import asyncio
+import json
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import httpx
+from django.core.management.base import BaseCommand, CommandError
+
+
+@dataclass
+class StreamResult:
+    status: int = 0
+    ttfb: Optional[float] = None  # first byte of the body
+    first_data: Optional[float] = None  # first `data:` frame (first token)
+    duration: float = 0.0
+    frames: int = 0
+    size: int = 0
+    error: str = ""
+
+
+def percentile(values: List[float], p: float) -> float:
+    """Nearest-rank percentile, 0 for no values."""
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))]
+
+
+class Command(BaseCommand):
+    help = (
+        "Opens concurrent SSE streams against the app (e.g. `AiViewSet.stream` or `init_task`) and reports "
+        "throughput, TTFB and first token percentiles and, with --metrics-url, the peak of active streams "
+        "and generations (worker saturation). Run the app against `manage.py fake_openai` to spend no tokens."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("url", help="SSE endpoint, e.g. http://127.0.0.1:8000/api/v1/jlab/projects/1/init_task/?task_id=1")
+        parser.add_argument("--method", default="GET")
+        parser.add_argument("--data", default=None, help="JSON body")
+        parser.add_argument("-H", "--header", action="append", default=[], help='"Name: value", e.g. the JWT')
+        parser.add_argument("-c", "--concurrency", type=int, default=50, help="streams open at the same time")
+        parser.add_argument("-n", "--requests", type=int, default=None, help="streams in total, defaults to --concurrency")
+        parser.add_argument("--timeout", type=float, default=300)
+        parser.add_argument("--metrics-url", default=None, help="the app's /metrics/ endpoint")
+        parser.add_argument("--metrics-token", default="", help="settings.METRICS_TOKEN")
+
+    async def stream(self, client: httpx.AsyncClient, options: dict) -> StreamResult:
+        result = StreamResult()
+        started = time.monotonic()
+        body = json.loads(options["data"]) if options["data"] else None
+        try:
+            async with client.stream(options["method"], options["url"], json=body) as response:
+                result.status = response.status_code
+                async for line in response.aiter_lines():
+                    now = time.monotonic() - started
+                    if result.ttfb is None:
+                        result.ttfb = now
+                    if line.startswith("data:"):
+                        if result.first_data is None:
+                            result.first_data = now
+                    elif not line:
+                        result.frames += 1
+                    result.size += len(line) + 1
+        except httpx.HTTPError as e:
+            result.error = type(e).__name__
+        result.duration = time.monotonic() - started
+        if result.status and result.status >= 400:
+            result.error = f"HTTP {result.status}"
+        return result
+
+    async def sample_metrics(self, options: dict, peaks: Dict[str, float], stop: asyncio.Event) -> None:
+        """Polls the gauges of `main.metrics` and keeps their peaks."""
+        pattern = re.compile(r"^(sse_active_connections|sse_active_generations)(?:\{[^}]*\})? ([0-9.e+-]+)$", re.M)
+        headers = {"Authorization": f"Bearer {options['metrics_token']}"}
+        async with httpx.AsyncClient(timeout=5) as client:
+            while not stop.is_set():
+                try:
+                    text = (await client.get(options["metrics_url"], headers=headers)).text
+                    for name, value in pattern.findall(text):
+                        peaks[name] = max(peaks.get(name, 0), float(value))
+                except httpx.HTTPError:
+                    pass
+                try:
+                    await asyncio.wait_for(stop.wait(), 0.5)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def run(self, options: dict):
+        total = options["requests"] or options["concurrency"]
+        headers = dict(header.split(":", 1) for header in options["header"])
+        headers = {name.strip(): value.strip() for name, value in headers.items()}
+        headers.setdefault("Accept", "text/event-stream")
+        limits = httpx.Limits(max_connections=options["concurrency"], max_keepalive_connections=options["concurrency"])
+        queue: asyncio.Queue = asyncio.Queue()
+        for _ in range(total):
+            queue.put_nowait(None)
+        results: List[StreamResult] = []
+        peaks: Dict[str, float] = {}
+        stop = asyncio.Event()
+
+        async with httpx.AsyncClient(headers=headers, limits=limits, timeout=options["timeout"]) as client:
+            async def worker():
+                while not queue.empty():
+                    queue.get_nowait()
+                    results.append(await self.stream(client, options))
+
+            sampler = asyncio.ensure_future(self.sample_metrics(options, peaks, stop)) if options["metrics_url"] else None
+            started = time.monotonic()
+            await asyncio.gather(*(worker() for _ in range(min(options["concurrency"], total))))
+            elapsed = time.monotonic() - started
+            stop.set()
+            if sampler is not None:
+                await sampler
+        return results, elapsed, peaks
+
+    def handle(self, *args, **options):
+        if options["method"].upper() not in ("GET", "POST"):
+            raise CommandError("--method must be GET or POST.")
+        results, elapsed, peaks = asyncio.run(self.run(options))
+        ok = [result for result in results if not result.error]
+        errors: Dict[str, int] = {}
+        for result in results:
+            if result.error:
+                errors[result.error] = errors.get(result.error, 0) + 1
+        self.stdout.write(f"{len(results)} streams, {options['concurrency']} concurrent, {elapsed:.1f}s")
+        self.stdout.write(f"ok {len(ok)}, failed {len(results) - len(ok)} {errors or ''}")
+        self.stdout.write(
+            f"throughput: {len(ok) / elapsed:.2f} streams/s, {sum(r.frames for r in ok) / elapsed:.1f} frames/s, "
+            f"{sum(r.size for r in ok) / elapsed / 1024:.1f} KiB/s")
+        self.stdout.write(f"{'':<14}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+        for name, values in [
+            ("TTFB", [r.ttfb for r in ok if r.ttfb is not None]),
+            ("first token", [r.first_data for r in ok if r.first_data is not None]),
+            ("duration", [r.duration for r in ok]),
+        ]:
+            row = "".join(f"{percentile(values, p):>8.3f}s" for p in (50, 95, 99, 100))
+            self.stdout.write(f"{name:<14}{row}")
+        if peaks:
+            self.stdout.write(
+                f"saturation: peak {peaks.get('sse_active_connections', 0):.0f} connections, "
+                f"{peaks.get('sse_active_generations', 0):.0f} generations")
@@ -0,0 +1,165 @@
+"""
+    Prometheus metrics of the AI backend, exported by `main.views.metrics`.
+
+    With several gunicorn workers set `PROMETHEUS_MULTIPROC_DIR`, so the exported values are aggregated across processes.
+"""
+import os
+from collections import defaultdict
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    REGISTRY,
+)
+
+COMPLETION_CACHE_REQUESTS = Counter(
+    "llm_completion_cache_requests",
+    "Chat completion cache lookups.",
+    ["result", "stream"],
+)
+
+STREAMS_CANCELLED = Counter(
+    "llm_streams_cancelled",
+    "Completion streams cancelled because the client disconnected.",
+    ["source"],
+)
+COMPLETION_TOKENS_SAVED = Counter(
+    "llm_completion_tokens_saved",
+    "Estimated completion tokens not generated because the stream was cancelled (replays of cached streams excluded).",
+    ["source"],
+)
+LLM_TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time until the winning backend returned the first chunk (the whole response when not streamed).",
+    ["call_type", "backend", "agent", "model"],
+    buckets=(0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 8, 13, 30, 60),
+)
+# Per completion, labelled by call type (call site), agent ID ("" outside of agent chats) and model
+LLM_QUEUE_WAIT = Histogram(
+    "llm_queue_wait_seconds",
+    "Time a completion request waited for the rate limiter before it was sent.",
+    ["call_type", "agent", "model"],
+    buckets=(0.005, 0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30),
+)
+LLM_INTER_TOKEN_LATENCY = Histogram(
+    "llm_inter_token_latency_seconds",
+    "Average gap between the chunks of a completion stream.",
+    ["call_type", "agent", "model"],
+    buckets=(0.005, 0.01, 0.02, 0.03, 0.05, 0.075, 0.1, 0.2, 0.5, 1),
+)
+LLM_DURATION = Histogram(
+    "llm_duration_seconds",
+    "Time from the request until the last chunk (the response when not streamed).",
+    ["call_type", "agent", "model"],
+    buckets=(0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60, 120),
+)
+LLM_TOKENS_PER_SECOND = Histogram(
+    "llm_output_tokens_per_second",
+    "Completion tokens per second after the first token.",
+    ["call_type", "agent", "model"],
+    buckets=(5, 10, 20, 30, 40, 50, 60, 80, 100, 150, 200),
+)
+LLM_PROMPT_TOKENS = Histogram(
+    "llm_prompt_tokens",
+    "Prompt tokens reported by the provider.",
+    ["call_type", "agent", "model"],
+    buckets=(100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+)
+LLM_COMPLETION_TOKENS = Histogram(
+    "llm_completion_tokens",
+    "Completion tokens reported by the provider.",
+    ["call_type", "agent", "model"],
+    buckets=(10, 50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000),
+)
+LLM_HEDGED_REQUESTS = Counter(
+    "llm_hedged_requests",
+    "Requests sent to more than one backend, by the backend that won.",
+    ["call_type", "winner"],
+)
+LLM_BACKEND_ERRORS = Counter(
+    "llm_backend_errors",
+    "Failed chat completion requests by backend.",
+    ["backend"],
+)
+LLM_HTTP_REQUESTS = Counter(
+    "llm_http_requests",
+    "HTTP requests sent to the LLM providers.",
+)
+LLM_HTTP_CONNECTIONS = Counter(
+    "llm_http_connections",
+    "Connections opened to the LLM providers, 1 - connections / requests is the connection reuse rate.",
+)
+LLM_ADMISSION_WAIT = Histogram(
+    "llm_admission_wait_seconds",
+    "Time requests waited for the rate limiter.",
+    ["bucket"],
+    buckets=(0.01, 0.1, 0.5, 1, 2, 5, 10, 20, 30, 60),
+)
+LLM_RATE_LIMITED = Counter(
+    "llm_rate_limited",
+    "Requests rejected by the rate limiter.",
+    ["bucket", "reason"],
+)
+
+SSE_ACTIVE_CONNECTIONS = Gauge(
+    "sse_active_connections",
+    "Clients subscribed to a stream (see main.streams), per worker the saturation of its event loop or threads.",
+    multiprocess_mode="livesum",
+)
+SSE_ACTIVE_GENERATIONS = Gauge(
+    "sse_active_generations",
+    "Running stream producers (generations).",
+    multiprocess_mode="livesum",
+)
+
+
+class RunningAverage:
+    """Exponentially weighted moving average (per process, the GIL makes the float update safe enough)."""
+
+    def __init__(self, alpha: float = 0.1) -> None:
+        self.alpha = alpha
+        self.value = 0.0
+        self.count = 0
+
+    def update(self, value: float) -> None:
+        self.value = value if self.count == 0 else self.value + self.alpha * (value - self.value)
+        self.count += 1
+
+
+# Completion lengths (in tokens) of the finished streams generated by the backends by source
+completion_lengths = defaultdict(RunningAverage)
+
+
+def _count_tokens(text: str) -> int:
+    from main.utils import count_tokens  # pylint: disable=import-outside-toplevel
+
+    return count_tokens(text)
+
+
+def record_completed_stream(source: str, text: str, replayed: bool = False) -> None:
+    """`text` is the completion of the finished stream, `replayed` if it came from the cache (not counted)."""
+    if not replayed:
+        completion_lengths[source].update(_count_tokens(text))
+
+
+def record_cancelled_stream(source: str, text: str, replayed: bool = False) -> None:
+    """
+        Counts a cancelled stream (`text` was received), the tokens saved are estimated from the average length
+        of finished streams. Cancelling the replay of a cached stream saves nothing.
+    """
+    STREAMS_CANCELLED.labels(source).inc()
+    if not replayed:
+        COMPLETION_TOKENS_SAVED.labels(source).inc(max(completion_lengths[source].value - _count_tokens(text), 0))
+
+
+def render_latest() -> bytes:
+    """Returns the metrics in the Prometheus text format."""
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
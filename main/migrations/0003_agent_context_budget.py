@@ -0,0 +1,19 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:02
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agent',
+            name='context_budget',
+            field=models.PositiveIntegerField(default=8000, validators=[django.core.validators.MinValueValidator(1000)], verbose_name='Context budget (tokens)'),
+        ),
+    ]
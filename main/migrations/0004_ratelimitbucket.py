@@ -0,0 +1,21 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0003_agent_context_budget'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RateLimitBucket',
+            fields=[
+                ('name', models.CharField(max_length=255, primary_key=True, serialize=False, verbose_name='Name')),
+                ('level', models.FloatField(verbose_name='Level')),
+                ('updated', models.FloatField(verbose_name='Updated (UNIX time)')),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0004_ratelimitbucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='agentimageexample',
+            name='renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Renditions'),
+        ),
+        migrations.AddField(
+            model_name='videoavatar',
+            name='photo_renditions',
+            field=models.JSONField(blank=True, default=dict, editable=False, verbose_name='Photo renditions'),
+        ),
+    ]
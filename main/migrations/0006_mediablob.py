@@ -0,0 +1,23 @@
+# Generated by Django 5.1.2 on 2026-10-18 19:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0005_renditions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('digest', models.CharField(max_length=64, primary_key=True, serialize=False, verbose_name='SHA-256')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Name')),
+                ('size', models.PositiveBigIntegerField(verbose_name='Size')),
+                ('refcount', models.PositiveIntegerField(default=1, verbose_name='References')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+            ],
+        ),
+    ]
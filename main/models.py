@@ -1,7 +1,11 @@
+from functools import cached_property
+
 from django.db import models
 from django.utils.translation.trans_null import gettext_lazy as _
 from rest_framework.fields import MinValueValidator
 
+from main.prompts import PromptTemplate
+
 # class AgentTypes(models.TextChoices):
 #     ARTICLE = 'article', _('Article')
 #     EMAIL = 'email', _('Email')
@@ -27,6 +31,7 @@ class VideoAvatar(models.Model):
         _("Default video"), upload_to='jlab/avatars/video/', max_length=100, null=True, blank=True)
     photo = models.ImageField(
         _("Photo"), upload_to='jlab/avatars/photo', null=True, blank=True)
+    photo_renditions = models.JSONField(_("Photo renditions"), default=dict, blank=True, editable=False)
     stability = models.FloatField(_("Stability"))
     similarity_boost = models.FloatField(_("Similarity boost"))
     style = models.FloatField(_("Style"), default=0)
@@ -52,13 +57,37 @@ class Agent(models.Model):
         "Video avatar"), on_delete=models.SET_NULL, null=True, blank=True)
     order = models.PositiveIntegerField(
         _("Order"), default=1, validators=[MinValueValidator(1)])
+    context_budget = models.PositiveIntegerField(
+        _("Context budget (tokens)"), default=8000, validators=[MinValueValidator(1000)])
 
     class Meta:
         ordering = ['order']
 
+    @cached_property
+    def user_prompt(self) -> PromptTemplate:
+        """Parsed `user_template`, Agents from `main.registry.agent_registry` keep it for the lifetime of the process."""
+        return PromptTemplate(self.user_template)
+
 
 class AgentImageExample(models.Model):
     agent = models.ForeignKey(Agent, verbose_name=_(
         "Agent"), on_delete=models.CASCADE, related_name="examples")
     file = models.FileField(
         _("Image"), upload_to='jlab/agents/images', max_length=255)
+    renditions = models.JSONField(_("Renditions"), default=dict, blank=True, editable=False)  # see main.renditions
+
+
+class RateLimitBucket(models.Model):
+    """State of a token bucket shared by all workers (see main.ratelimit.DatabaseBucketBackend)."""
+    name = models.CharField(_("Name"), max_length=255, primary_key=True)
+    level = models.FloatField(_("Level"))
+    updated = models.FloatField(_("Updated (UNIX time)"))
+
+
+class MediaBlob(models.Model):
+    """A file stored once by the hash of its content and the number of saves referencing it (see custom.custom_storage)."""
+    digest = models.CharField(_("SHA-256"), max_length=64, primary_key=True)
+    name = models.CharField(_("Name"), max_length=255, unique=True)
+    size = models.PositiveBigIntegerField(_("Size"))
+    refcount = models.PositiveIntegerField(_("References"), default=1)
+    created = models.DateTimeField(_("Created"), auto_now_add=True)
@@ -0,0 +1,33 @@
+from string import Formatter
+from typing import Any, List, Mapping, Optional, Tuple
+
+_formatter = Formatter()
+
+
+class PromptTemplate:
+    """
+        A prompt template (`str.format` syntax) parsed once.
+        `.render(params)` returns the same as `template.format_map(params)` without parsing the template again.
+    """
+    template: str
+    _parts: List[Tuple[str, Optional[str], Optional[str], Optional[str]]]
+
+    def __init__(self, template: str) -> None:
+        self.template = template
+        self._parts = list(_formatter.parse(template))
+
+    def render(self, params: Mapping[str, Any]) -> str:
+        rendered = []
+        for literal, field, spec, conversion in self._parts:
+            rendered.append(literal)
+            if field is None:
+                continue
+            value, _ = _formatter.get_field(field, (), params)
+            value = _formatter.convert_field(value, conversion)
+            if spec and "{" in spec:
+                spec = _formatter.vformat(spec, (), params)
+            rendered.append(format(value, spec or ""))
+        return "".join(rendered)
+
+    def __str__(self) -> str:
+        return self.template
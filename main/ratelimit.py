@@ -0,0 +1,181 @@
+"""
+    Token-bucket rate limiter for OpenAI requests, shared by all worker processes.
+
+    Every backend (`main.backends.Backend.bucket`) has two buckets: requests per minute and tokens per minute.
+    A request waits in a bounded admission queue until both buckets have room, or fails with `RateLimitExceeded`
+    (the streams answer with `BaseGenerationAPI.HIGH_DEMAND`) if the queue is full or the wait would be too long.
+"""
+import asyncio
+import fcntl
+import json
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, Optional, Tuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+from main.metrics import LLM_ADMISSION_WAIT, LLM_RATE_LIMITED
+
+# bucket name -> (amount, capacity, refill rate per second)
+Demands = Dict[str, Tuple[float, float, float]]
+# bucket name -> (level, updated)
+States = Dict[str, Tuple[float, float]]
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class BucketBackend(ABC):
+    """Storage of the buckets. `.take` must be atomic across all processes sharing the limits."""
+
+    @staticmethod
+    def _take(states: States, demands: Demands, now: float) -> float:
+        """Refills the buckets and takes the demanded amounts from all of them, or from none. Returns seconds to wait (0 if taken)."""
+        wait = 0.0
+        for name, (amount, capacity, rate) in demands.items():
+            level, updated = states.get(name, (capacity, now))
+            level = min(capacity, level + max(now - updated, 0) * rate)
+            states[name] = (level, now)
+            amount = min(amount, capacity)  # a request larger than the bucket waits for a full bucket
+            if level < amount:
+                wait = max(wait, (amount - level) / rate)
+        if not wait:
+            for name, (amount, capacity, _) in demands.items():
+                level, _ = states[name]
+                states[name] = (level - min(amount, capacity), now)
+        return wait
+
+    @abstractmethod
+    def take(self, demands: Demands) -> float:
+        """Returns 0 if the demanded amounts were taken, otherwise seconds until they are available."""
+
+
+class DatabaseBucketBackend(BucketBackend):
+    """Buckets in the `main.RateLimitBucket` table, rows are locked with `SELECT ... FOR UPDATE`."""
+
+    def take(self, demands: Demands) -> float:
+        from main.models import RateLimitBucket  # pylint: disable=import-outside-toplevel
+        now = time.time()
+        with transaction.atomic():
+            RateLimitBucket.objects.bulk_create([
+                RateLimitBucket(name=name, level=capacity, updated=now)
+                for name, (_, capacity, _) in demands.items()
+            ], ignore_conflicts=True)
+            buckets = {
+                bucket.name: bucket
+                for bucket in RateLimitBucket.objects.select_for_update().filter(name__in=demands).order_by("name")
+            }
+            states = {name: (bucket.level, bucket.updated) for name, bucket in buckets.items()}
+            wait = self._take(states, demands, now)
+            for name, bucket in buckets.items():
+                bucket.level, bucket.updated = states[name]
+            RateLimitBucket.objects.bulk_update(buckets.values(), ["level", "updated"])
+        return wait
+
+
+class FileBucketBackend(BucketBackend):
+    """Buckets in a JSON file guarded by `flock`, for processes of one machine (development and tests)."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def take(self, demands: Demands) -> float:
+        with open(self.path, "a+", encoding="utf-8") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            file.seek(0)
+            content = file.read()
+            states = {name: tuple(state) for name, state in json.loads(content).items()} if content else {}
+            wait = self._take(states, demands, time.time())  # type: ignore
+            file.seek(0)
+            file.truncate()
+            json.dump(states, file)
+            file.flush()
+            fcntl.flock(file, fcntl.LOCK_UN)
+        return wait
+
+
+class RateLimiter:
+    def __init__(self, backend: Optional[BucketBackend], requests_per_minute: float, tokens_per_minute: float,
+                 max_wait: float, max_queue: int) -> None:
+        self.backend = backend
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.queued = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls) -> "RateLimiter":
+        config = settings.LLM_RATE_LIMIT
+        backend = import_string(config["BACKEND"])(**config.get("OPTIONS", {})) if config.get("BACKEND") else None
+        return cls(
+            backend,
+            requests_per_minute=config["REQUESTS_PER_MINUTE"],
+            tokens_per_minute=config["TOKENS_PER_MINUTE"],
+            max_wait=config["MAX_WAIT"],
+            max_queue=config["MAX_QUEUE"],
+        )
+
+    def _demands(self, bucket: str, tokens: int) -> Demands:
+        return {
+            f"{bucket}:requests": (1, self.requests_per_minute, self.requests_per_minute / 60),
+            f"{bucket}:tokens": (tokens, self.tokens_per_minute, self.tokens_per_minute / 60),
+        }
+
+    def _enqueue(self, bucket: str) -> None:
+        with self._lock:
+            if self.queued >= self.max_queue:
+                LLM_RATE_LIMITED.labels(bucket, "queue_full").inc()
+                raise RateLimitExceeded("The admission queue is full.")
+            self.queued += 1
+
+    def _dequeue(self) -> None:
+        with self._lock:
+            self.queued -= 1
+
+    def _delay(self, bucket: str, wait: float, started: float) -> float:
+        """Jittered delay before the next try, raises if the request would wait longer than `.max_wait`."""
+        if time.monotonic() + wait - started > self.max_wait:
+            LLM_RATE_LIMITED.labels(bucket, "timeout").inc()
+            raise RateLimitExceeded(f"The rate limit of {bucket} is exhausted.")
+        return wait * random.uniform(1, 1.2)
+
+    def acquire(self, bucket: str, tokens: int) -> None:
+        """Blocks until the request is admitted."""
+        if self.backend is None:
+            return
+        started = time.monotonic()
+        self._enqueue(bucket)
+        try:
+            while wait := self.backend.take(self._demands(bucket, tokens)):
+                time.sleep(self._delay(bucket, wait, started))
+        finally:
+            self._dequeue()
+        LLM_ADMISSION_WAIT.labels(bucket).observe(time.monotonic() - started)
+
+    async def aacquire(self, bucket: str, tokens: int) -> None:
+        """Async counterpart of `.acquire`."""
+        if self.backend is None:
+            return
+        started = time.monotonic()
+        self._enqueue(bucket)
+        try:
+            while wait := await sync_to_async(self.backend.take)(self._demands(bucket, tokens)):
+                await asyncio.sleep(self._delay(bucket, wait, started))
+        finally:
+            self._dequeue()
+        LLM_ADMISSION_WAIT.labels(bucket).observe(time.monotonic() - started)
+
+
+def backoff(retry: int) -> float:
+    """Exponential backoff with full jitter for the `retry`-th retry (0-based)."""
+    return random.uniform(0, min(settings.LLM_RATE_LIMIT["BACKOFF_CAP"], settings.LLM_RATE_LIMIT["BACKOFF_BASE"] * 2 ** retry))
+
+
+limiter = RateLimiter.from_settings()
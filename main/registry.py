@@ -0,0 +1,76 @@
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.request import Request
+from main.models import Agent
+from main.serializers import AgentSerializer
+
+VERSION_KEY = "agent-registry-version"
+
+
+class AgentRegistry:
+    """
+        Per-process snapshot of all Agents (with avatars, examples and parsed templates) and of the serialized
+        `AgentViewSet.list` payloads, so the hot paths do not query Agents.
+
+        Agents change only in the admin: saving or deleting an Agent, an example or an avatar bumps a version
+        in the shared cache (`main.signals`). Every process compares its snapshot with the version at most
+        every `settings.AGENT_REGISTRY["CHECK_INTERVAL"]` seconds and reloads it when it changed.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._version: Optional[str] = None
+        self._checked_at = float("-inf")
+        self._agents: Dict[int, Agent] = {}
+        self._payloads: Dict[Tuple[str, str], List[dict]] = {}
+
+    @property
+    def _cache(self):
+        return caches[settings.AGENT_REGISTRY["CACHE"]]
+
+    def _refresh(self) -> None:
+        if time.monotonic() - self._checked_at < settings.AGENT_REGISTRY["CHECK_INTERVAL"]:
+            return
+        with self._lock:
+            now = time.monotonic()
+            if now - self._checked_at < settings.AGENT_REGISTRY["CHECK_INTERVAL"]:
+                return
+            version = self._cache.get_or_set(VERSION_KEY, lambda: uuid.uuid4().hex, None)
+            if version != self._version:
+                agents = Agent.objects.select_related("avatar").prefetch_related("examples")
+                # Readers keep using the previous dictionaries until the new ones are assigned
+                self._agents = {agent.pk: agent for agent in agents}
+                self._payloads = {}
+                self._version = version
+            self._checked_at = now
+
+    def get(self, pk: int, agent_type: Optional[str] = None) -> Optional[Agent]:
+        """Returns the Agent (optionally, only of `agent_type`) or `None`. The instance is shared, do not modify it."""
+        self._refresh()
+        agent = self._agents.get(pk)
+        if agent is None or (agent_type is not None and agent.type != agent_type):
+            return None
+        return agent
+
+    def list_payload(self, agent_type: str, request: Request) -> List[dict]:
+        """`AgentSerializer` data of the Agents of `agent_type`. File URLs are absolute, so payloads are kept per host."""
+        self._refresh()
+        key = (agent_type, request.build_absolute_uri("/"))
+        payloads = self._payloads
+        if key not in payloads:
+            agents = [agent for agent in self._agents.values() if agent.type == agent_type]
+            payloads[key] = AgentSerializer(agents, many=True, context={"request": request}).data  # type: ignore
+        return payloads[key]
+
+    def invalidate(self) -> None:
+        """Bumps the shared version, this process reloads on the next access, the others within the check interval."""
+        self._cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+        self._checked_at = float("-inf")
+
+
+agent_registry = AgentRegistry()
@@ -0,0 +1,155 @@
+"""
+    Responsive renditions of images: every width of `settings.IMAGE_RENDITIONS["WIDTHS"]` below the original
+    (and the original width) in every supported format, saved next to the original as `<name>.<width>w.<format>`
+    (content-addressed storages name them by their hash, see `custom.custom_storage`).
+
+    They are built after the image of a model in `FIELDS` was saved (`main.signals`, `jlab.signals`): the files are
+    read and written on `main.jobs.rendition_jobs`, Pillow runs in a process pool (`main.imaging`). The result
+    is stored in the model's renditions JSONField and exposed by serializers with `SrcSetField`.
+"""
+import logging
+import mimetypes
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from typing import Dict, Optional, Tuple, Type
+
+from PIL import Image, UnidentifiedImageError
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage
+from django.db import models, transaction
+from django.db.models import Q
+from rest_framework import serializers
+
+from main.imaging import render, supported_formats
+from main.jobs import JobQueueFull, rendition_jobs
+from main.models import AgentImageExample, VideoAvatar
+from jlab.models import EditorObject, MessageObject
+
+# Model: (image field, renditions field)
+FIELDS: Dict[Type[models.Model], Tuple[str, str]] = {
+    AgentImageExample: ("file", "renditions"),
+    VideoAvatar: ("photo", "photo_renditions"),
+    EditorObject: ("file", "renditions"),
+    MessageObject: ("file", "renditions"),
+}
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ProcessPoolExecutor:
+    global _pool  # pylint: disable=global-statement
+    with _pool_lock:
+        if _pool is None:
+            # Spawned, forking a process with running threads (streams, jobs) may deadlock the child
+            _pool = ProcessPoolExecutor(
+                settings.IMAGE_RENDITIONS["PROCESSES"], mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def image_name(file) -> Optional[str]:
+    """The storage name of the image, `None` without one, for other files (audio, video, SVG) or an external URL."""
+    if not file or "://" in file.name:
+        return None
+    mimetype = mimetypes.guess_type(file.name)[0] or ""
+    return file.name if mimetype.startswith("image/") and mimetype != "image/svg+xml" else None
+
+
+def submit(func, *args) -> None:
+    try:
+        rendition_jobs.submit(func, *args)
+    except JobQueueFull:
+        logging.warning("Renditions: the queue is full, skipped %s%s.", func.__name__, args)
+
+
+def delete_renditions(renditions: dict, storage: Storage) -> None:
+    for item in renditions.get("files", []):
+        try:
+            storage.delete(item["name"])
+        except Exception as e:  # pylint: disable=broad-except
+            logging.warning("Renditions: could not delete %s. Exception = %s", item["name"], e)
+
+
+def build_renditions(model: Type[models.Model], pk: int) -> None:
+    """Builds the renditions of the current image of the row (or removes them, if the image was removed)."""
+    file_field, renditions_field = FIELDS[model]
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None:
+        return
+    file = getattr(instance, file_field)
+    name = image_name(file)
+    old: dict = getattr(instance, renditions_field) or {}
+    if old.get("source") == name:
+        return  # already built, e.g. by a previous attempt
+    renditions: dict = {}
+    if name is not None:
+        with file.open("rb") as source:
+            data = source.read()
+        config = settings.IMAGE_RENDITIONS
+        try:
+            width, height, images = get_pool().submit(
+                render, data, config["WIDTHS"], supported_formats(config["FORMATS"]), config["QUALITY"]).result()
+        except (UnidentifiedImageError, Image.DecompressionBombError) as e:
+            logging.warning("Renditions: %s %s is not a usable image. Exception = %s", model.__name__, pk, e)
+            width, height, images = 0, 0, []
+        stem = os.path.splitext(name)[0]
+        renditions = {"source": name, "width": width, "height": height, "files": []}
+        for fmt, rendition_width, rendition_height, content in images:
+            saved = file.storage.save(f"{stem}.{rendition_width}w.{fmt}", ContentFile(content))
+            renditions["files"].append(
+                {"name": saved, "format": fmt, "width": rendition_width, "height": rendition_height})
+    # Unless the image changed meanwhile (its own job builds its renditions)
+    unchanged = Q(**{file_field: file.name}) if file else Q(**{file_field: ""}) | Q(**{f"{file_field}__isnull": True})
+    if model.objects.filter(unchanged, pk=pk).update(**{renditions_field: renditions}):
+        delete_renditions(old, file.storage)
+        if model in (AgentImageExample, VideoAvatar):
+            # `AgentViewSet.list` is served from the registry (it imports this module through the serializers)
+            from main.registry import agent_registry  # pylint: disable=import-outside-toplevel
+            agent_registry.invalidate()
+    else:
+        delete_renditions(renditions, file.storage)
+
+
+def schedule_renditions(sender: Type[models.Model], instance: models.Model, update_fields=None, **kwargs) -> None:
+    """`post_save` receiver: builds the renditions after the commit if the image changed."""
+    file_field, renditions_field = FIELDS[sender]
+    if update_fields is not None and file_field not in update_fields:
+        return
+    renditions: dict = getattr(instance, renditions_field) or {}
+    if image_name(getattr(instance, file_field)) != renditions.get("source"):
+        transaction.on_commit(partial(submit, build_renditions, sender, instance.pk))
+
+
+def remove_renditions(sender: Type[models.Model], instance: models.Model, **kwargs) -> None:
+    """`post_delete` receiver."""
+    file_field, renditions_field = FIELDS[sender]
+    renditions: dict = getattr(instance, renditions_field) or {}
+    if renditions:
+        storage = getattr(instance, file_field).storage
+        transaction.on_commit(partial(submit, delete_renditions, renditions, storage))
+
+
+class SrcSetField(serializers.Field):
+    """
+        Read-only `srcset` of an image per format, e.g. `{"webp": "<url> 320w, <url> 640w"}`,
+        for `<picture>` sources. Empty until the renditions are built, clients fall back to the original.
+    """
+
+    def __init__(self, file_field: str = "file", renditions_field: str = "renditions", **kwargs) -> None:
+        self.file_field = file_field
+        self.renditions_field = renditions_field
+        super().__init__(source="*", read_only=True, **kwargs)
+
+    def to_representation(self, value) -> Dict[str, str]:
+        renditions: dict = getattr(value, self.renditions_field) or {}
+        file = getattr(value, self.file_field)
+        if not file or renditions.get("source") != file.name:
+            return {}
+        srcset: Dict[str, list] = {}
+        for item in renditions["files"]:
+            srcset.setdefault(item["format"], []).append(f"{file.storage.url(item['name'])} {item['width']}w")
+        return {fmt: ", ".join(sources) for fmt, sources in srcset.items()}
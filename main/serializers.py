@@ -6,6 +6,7 @@ from main.models import (
     AgentTypes,
     VideoAvatar,
 )
+from main.renditions import SrcSetField
 
 
 class StreamRequestSerializer(serializers.Serializer):
@@ -25,9 +26,11 @@ class ImageRequestSerializer(serializers.Serializer):
 
 
 class VideoAvatarSerializer(serializers.ModelSerializer):
+    photo_srcset = SrcSetField("photo", "photo_renditions")
+
     class Meta:
         model = VideoAvatar
-        exclude = ['el_id']
+        exclude = ['el_id', 'photo_renditions']
 
 
 class SynclabWebhookSerializer(serializers.Serializer):
@@ -36,9 +39,11 @@ class SynclabWebhookSerializer(serializers.Serializer):
 
 
 class AgentImageExampleSerializer(serializers.ModelSerializer):
+    srcset = SrcSetField()
+
     class Meta:
         model = AgentImageExample
-        fields = ['file']
+        fields = ['file', 'srcset']
 
 
 class AgentSerializer(serializers.ModelSerializer):
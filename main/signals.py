@@ -0,0 +1,33 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from custom.custom_storage import release_files, release_replaced_files, track_files
+from main.models import (
+    Agent,
+    AgentImageExample,
+    VideoAvatar,
+    VideoAvatarTemplate,
+)
+from main.registry import agent_registry
+from main.renditions import remove_renditions, schedule_renditions
+
+
+@receiver([post_save, post_delete], sender=Agent)
+@receiver([post_save, post_delete], sender=AgentImageExample)
+@receiver([post_save, post_delete], sender=VideoAvatar)
+def invalidate_agent_registry(sender, **kwargs):
+    # After the commit, so other workers do not reload the old rows
+    transaction.on_commit(agent_registry.invalidate)
+
+
+post_save.connect(schedule_renditions, sender=AgentImageExample)
+post_save.connect(schedule_renditions, sender=VideoAvatar)
+post_delete.connect(remove_renditions, sender=AgentImageExample)
+post_delete.connect(remove_renditions, sender=VideoAvatar)
+
+# Content-addressed files are shared, they are deleted with their last reference
+for model in (AgentImageExample, VideoAvatar, VideoAvatarTemplate):
+    post_init.connect(track_files, sender=model)
+    post_save.connect(release_replaced_files, sender=model)
+    post_delete.connect(release_files, sender=model)
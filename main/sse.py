@@ -0,0 +1,64 @@
+import time
+from typing import Callable, List, Optional
+
+from django.conf import settings
+
+
+def text_frame(text: str) -> bytes:
+    """Formats streamed text as an SSE data frame. Newlines are sent as `<br/>`, the client renders them."""
+    text = text.replace("\n", "<br/>")
+    return f'data: {text}\n\n'.encode()
+
+
+def multiline_frame(text: str) -> bytes:
+    """Formats streamed text as an SSE data frame keeping newlines (one `data:` line per line of text)."""
+    lines = "".join(f'data: {line}\n' for line in text.split("\n"))
+    return f'{lines}\n'.encode()
+
+
+class FrameCoalescer:
+    """
+        Coalesces small text chunks of a completion stream into fewer SSE frames.
+
+        The first non-empty chunk is sent immediately (time to first token is not affected),
+        then the buffered text is flushed once `window` seconds passed since the last frame
+        or once it reaches `max_bytes` (counted in characters, which is close enough for text). A window of 0 sends one frame per chunk.
+        The window is checked when the next chunk arrives, so text is held at most
+        `window` plus one inter-token gap.
+    """
+
+    def __init__(self, window: Optional[float] = None, max_bytes: Optional[int] = None,
+                 clock: Optional[Callable[[], float]] = None, formatter: Callable[[str], bytes] = text_frame) -> None:
+        self.formatter = formatter
+        self.window = settings.SSE_COALESCE_WINDOW if window is None else window
+        self.max_bytes = settings.SSE_COALESCE_BYTES if max_bytes is None else max_bytes
+        self.clock = clock or time.monotonic
+        self.frames = 0
+        self._buffer: List[str] = []
+        self._size = 0
+        self._last_flush = 0.0
+
+    def push(self, text: str) -> Optional[bytes]:
+        """Buffers the text, returns a frame if it is time to flush."""
+        if not text:
+            return None
+        self._buffer.append(text)
+        self._size += len(text)
+        if (
+            self.frames == 0
+            or self._size >= self.max_bytes
+            or self.clock() - self._last_flush >= self.window
+        ):
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[bytes]:
+        """Returns the buffered text as a frame (or `None` if there is nothing buffered)."""
+        if not self._buffer:
+            return None
+        frame = self.formatter("".join(self._buffer))
+        self._buffer = []
+        self._size = 0
+        self._last_flush = self.clock()
+        self.frames += 1
+        return frame
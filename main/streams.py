@@ -0,0 +1,406 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
+from asgiref.sync import ThreadSensitiveContext, sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connections
+from django.http import StreamingHttpResponse
+from rest_framework.request import Request
+from main.background import run_in_background
+from main.metrics import SSE_ACTIVE_CONNECTIONS, SSE_ACTIVE_GENERATIONS
+from main.sse import multiline_frame
+
+HEARTBEAT = b': ping\n\n'
+
+
+def close_upstream(stream: Any) -> None:
+    """Closes a completion stream (`openai.Stream` or a generator wrapping one), releasing the upstream connection."""
+    close = getattr(stream, "close", None)
+    if close is not None:
+        close()
+
+
+async def aclose_upstream(stream: Any) -> None:
+    """Async counterpart of `close_upstream` (`openai.AsyncStream` or an async generator wrapping one)."""
+    if hasattr(stream, "aclose"):
+        await stream.aclose()
+    elif hasattr(stream, "close"):
+        await stream.close()
+
+
+def frame_text(frame: bytes) -> str:
+    """Returns the data of a plain SSE data frame ("" for named events and comments)."""
+    lines = frame.decode().split("\n")
+    if any(line.startswith("event:") for line in lines):
+        return ""
+    return "\n".join(line[6:] for line in lines if line.startswith("data: "))
+
+
+def get_last_event_id(request: Request) -> Optional[int]:
+    """Returns the `Last-Event-ID` a reconnecting EventSource sends (or `None`)."""
+    value = request.headers.get("Last-Event-ID")
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def event_stream_response(stream: Union[Iterator[bytes], AsyncIterator[bytes]]) -> StreamingHttpResponse:
+    response = StreamingHttpResponse(
+        stream, content_type="text/event-stream")
+    response['X-Accel-Buffering'] = 'no'  # Disable buffering in nginx
+    # Ensure clients don't cache the data
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+class StreamBuffer:
+    """
+        Replay buffer of one generation's SSE frames.
+
+        The generation (producer) runs independently of the HTTP connection and appends frames,
+        subscribers read them from an event ID, so a client that reconnects with `Last-Event-ID`
+        resumes without a new upstream call. Every frame sent to a subscriber carries an `id:` field,
+        a heartbeat comment is sent when no frame arrived for `settings.SSE_HEARTBEAT_INTERVAL`.
+
+        Once the last subscriber left and nobody reconnected within `settings.SSE_CANCEL_GRACE` seconds,
+        the producer is closed (sync) or cancelled (async), which closes the upstream completion stream.
+        Generations the server started for later (`cancellable=False`, e.g. task plans) always run to the end,
+        and a generation clients in other processes follow (`shared`, see `main.locks.SharedGeneration`)
+        is not cancelled while they do.
+
+        A generation started before anyone asked for it (`unclaimed_ttl`) is cancelled the same way if nobody
+        subscribed within `unclaimed_ttl` seconds, and `on_expire` is called to discard what it saved (also when
+        it finished but nobody subscribed before `StreamRegistry` dropped it). A process that followed it counts
+        as a subscriber.
+
+        Only the last `settings.SSE_REPLAY_FRAMES` frames are kept. The text of evicted frames is kept
+        as a snapshot: a subscriber resuming from an evicted ID receives `event: reset` followed by the snapshot
+        and the retained frames.
+    """
+    key: Hashable
+
+    def __init__(self, key: Hashable, max_frames: Optional[int] = None) -> None:
+        self.key = key
+        self.max_frames = max_frames or settings.SSE_REPLAY_FRAMES
+        self.finished = False
+        self.finished_at: Optional[float] = None
+        self.subscribers = 0
+        self.claimed = False  # somebody subscribed
+        self.cancellable = True
+        self.expired = False
+        self.expires_at: Optional[float] = None
+        self.on_expire: Optional[Callable[[], None]] = None
+        self.shared: Any = None  # `main.locks.SharedGeneration`
+        self._abandoned_at: Optional[float] = None
+        self._frames: Deque[Tuple[int, bytes]] = deque()
+        self._last_id = 0
+        self._evicted_text: List[str] = []
+        self._cond = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._async_source: Optional[AsyncIterator[bytes]] = None
+        self._producer: Any = None
+
+    # Producer
+
+    def append(self, frame: bytes) -> None:
+        with self._cond:
+            self._last_id += 1
+            self._frames.append((self._last_id, frame))
+            if len(self._frames) > self.max_frames:
+                _, evicted = self._frames.popleft()
+                self._evicted_text.append(frame_text(evicted))
+            self._notify()
+
+    def finish(self) -> None:
+        with self._cond:
+            self.finished = True
+            self.finished_at = time.monotonic()
+            self._notify()
+
+    def _notify(self) -> None:
+        """Wakes up all subscribers. Must be called with `._cond` held."""
+        self._cond.notify_all()
+        for loop, future in self._async_waiters:
+            loop.call_soon_threadsafe(lambda f: f.done() or f.set_result(None), future)
+        self._async_waiters = []
+
+    def _gone(self) -> bool:
+        """All subscribers left more than `settings.SSE_CANCEL_GRACE` seconds ago (or nobody came before `.expires_at`)."""
+        if self.subscribers or not self.cancellable:
+            return False
+        if self._abandoned_at is not None:
+            return time.monotonic() - self._abandoned_at >= settings.SSE_CANCEL_GRACE
+        return self.expires_at is not None and time.monotonic() >= self.expires_at
+
+    @property
+    def abandoned(self) -> bool:
+        """
+            `._gone()` and no other process follows the generation. The followers are looked up in the shared cache
+            (call it from a thread), while there are some the check is repeated every `settings.SSE_CANCEL_GRACE`.
+        """
+        if not self._gone():
+            return False
+        if self.shared is None or not self.shared.following():
+            return True
+        with self._cond:
+            if not self.subscribers:
+                self._abandoned_at = time.monotonic()
+        return False
+
+    def _expire(self) -> None:
+        """Discards a generation that was closed before anyone subscribed."""
+        self.expired = True
+        if self.on_expire is not None:
+            self.on_expire()
+
+    def expire_unclaimed(self) -> None:
+        """
+            `._expire()`s the generation if nobody subscribed to it, in this process or, following it (`shared`),
+            in another one. Looks up the shared cache, call it from a thread.
+        """
+        if not self.claimed and not self.expired and (self.shared is None or not self.shared.followed()):
+            self._expire()
+
+    def _cancel_if_abandoned(self, abandoned_at: float) -> None:
+        """Cancels the async producer if nobody subscribed since `abandoned_at` (runs on the event loop)."""
+        if self._abandoned_at != abandoned_at or self.finished or not isinstance(self._producer, asyncio.Task):
+            return
+        if self.shared is None:
+            self._producer.cancel()
+        else:
+            self._producer.get_loop().create_task(self._acancel_if_abandoned(abandoned_at))
+
+    async def _acancel_if_abandoned(self, abandoned_at: float) -> None:
+        if await sync_to_async(self._abandoned_since, thread_sensitive=False)(abandoned_at):
+            self._producer.cancel()
+        elif self._abandoned_at is not None and not self.finished:
+            # Followed by another process, checked again after the grace period
+            self._producer.get_loop().call_later(settings.SSE_CANCEL_GRACE, self._cancel_if_abandoned, self._abandoned_at)
+
+    def _abandoned_since(self, abandoned_at: float) -> bool:
+        try:
+            return self._abandoned_at == abandoned_at and not self.subscribers and not self.shared.following()
+        finally:
+            close_old_connections()
+
+    def start(self, stream: Union[Iterator[bytes], AsyncIterator[bytes]], unclaimed_ttl: Optional[float] = None,
+              on_expire: Optional[Callable[[], None]] = None, cancellable: bool = True, shared: Any = None) -> None:
+        """
+            Starts producing frames from `stream`. Sync streams are consumed by a thread right away,
+            async streams by a task on the event loop of the first async subscriber
+            (so a generation nobody subscribed to yet, `unclaimed_ttl`, must be sync).
+            A generation that is not `cancellable` is not closed when its subscribers leave,
+            one other processes may follow (`shared`) not while they do.
+        """
+        self.cancellable = cancellable
+        self.shared = shared
+        if unclaimed_ttl is not None:
+            self.expires_at = time.monotonic() + unclaimed_ttl
+        self.on_expire = on_expire
+        if hasattr(stream, "__aiter__"):
+            self._async_source = stream  # type: ignore
+            with self._cond:
+                self._notify()  # subscribers attached to a claimed buffer start it
+            return
+        self._producer = threading.Thread(target=self._pump, args=(stream,), daemon=True)
+        self._producer.start()
+
+    def _pump(self, stream: Iterator[bytes]) -> None:
+        SSE_ACTIVE_GENERATIONS.inc()
+        try:
+            for frame in stream:
+                self.append(frame)
+                if self.abandoned:
+                    close_upstream(stream)
+                    self.expire_unclaimed()
+                    break
+        except Exception as e:  # pylint: disable=broad-except
+            logging.exception(e)
+        finally:
+            self.finish()
+            SSE_ACTIVE_GENERATIONS.dec()
+            connections.close_all()
+
+    async def _apump(self, stream: AsyncIterator[bytes]) -> None:
+        SSE_ACTIVE_GENERATIONS.inc()
+        # Its own thread for the ORM calls of the generation (`sync_to_async` is thread-sensitive by default),
+        # otherwise they run on the process' single sync thread, one generation at a time
+        async with ThreadSensitiveContext():
+            try:
+                async for frame in stream:
+                    self.append(frame)
+                    if self._gone() and await sync_to_async(lambda: self.abandoned)():
+                        await aclose_upstream(stream)
+                        await sync_to_async(self.expire_unclaimed)()
+                        break
+            except Exception as e:  # pylint: disable=broad-except
+                logging.exception(e)
+            finally:
+                self.finish()
+                SSE_ACTIVE_GENERATIONS.dec()
+                await sync_to_async(connections.close_all)()  # the thread ends with the generation
+
+    def _start_async_producer(self) -> None:
+        if self._async_source is None or self._producer is not None:
+            return
+        # A fresh context: the generation outlives the request, it must not use the request's thread-sensitive
+        # executor (`_apump` enters its own)
+        self._producer = asyncio.get_running_loop().create_task(
+            self._apump(self._async_source), context=contextvars.Context())
+
+    # Subscribers
+
+    def _subscribe(self) -> None:
+        SSE_ACTIVE_CONNECTIONS.inc()
+        with self._cond:
+            self.subscribers += 1
+            self.claimed = True
+            self._abandoned_at = None
+
+    def _unsubscribe(self) -> None:
+        SSE_ACTIVE_CONNECTIONS.dec()
+        with self._cond:
+            self.subscribers -= 1
+            if self.subscribers or self.finished or not self.cancellable:
+                return
+            self._abandoned_at = abandoned_at = time.monotonic()
+        if isinstance(self._producer, asyncio.Task):
+            # The sync producer checks `.abandoned` after every frame, the async one is also cancelled while awaiting OpenAI
+            loop = self._producer.get_loop()
+            loop.call_soon_threadsafe(loop.call_later, settings.SSE_CANCEL_GRACE, self._cancel_if_abandoned, abandoned_at)
+
+    def _read(self, after: int) -> Tuple[List[bytes], int]:
+        """Returns the frames after the event ID `after` (formatted with their IDs) and the new last ID."""
+        with self._cond:
+            frames = []
+            first_id = self._frames[0][0] if self._frames else self._last_id + 1
+            if self._evicted_text and after < first_id - 1:
+                if after > 0:
+                    frames.append(b'event: reset\ndata: \n\n')
+                frames.append(f'id: {first_id - 1}\n'.encode() + multiline_frame("".join(self._evicted_text)))
+            for event_id, frame in self._frames:
+                if event_id > after:
+                    frames.append(f'id: {event_id}\n'.encode() + frame)
+            return frames, max(after, self._last_id)
+
+    def iter_from(self, last_event_id: int = 0) -> Iterator[bytes]:
+        """Sync subscriber (WSGI). Yields the frames after `last_event_id` as they are produced."""
+        self._subscribe()
+        try:
+            yield f'retry: {settings.SSE_RETRY}\n\n'.encode()
+            after = last_event_id
+            while True:
+                frames, after = self._read(after)
+                yield from frames
+                with self._cond:
+                    if self._last_id > after:
+                        continue
+                    if self.finished:
+                        return
+                    notified = self._cond.wait(timeout=settings.SSE_HEARTBEAT_INTERVAL)
+                if not notified:
+                    yield HEARTBEAT
+        finally:
+            self._unsubscribe()
+
+    async def aiter_from(self, last_event_id: int = 0) -> AsyncIterator[bytes]:
+        """Async subscriber (ASGI). Yields the frames after `last_event_id` as they are produced."""
+        loop = asyncio.get_running_loop()
+        self._subscribe()
+        try:
+            yield f'retry: {settings.SSE_RETRY}\n\n'.encode()
+            after = last_event_id
+            while True:
+                self._start_async_producer()  # also when attached to a claimed buffer before it was started
+                frames, after = self._read(after)
+                for frame in frames:
+                    yield frame
+                with self._cond:
+                    if self._last_id > after:
+                        continue
+                    if self.finished:
+                        return
+                    waiter = loop.create_future()
+                    self._async_waiters.append((loop, waiter))
+                try:
+                    await asyncio.wait_for(waiter, timeout=settings.SSE_HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield HEARTBEAT
+        finally:
+            self._unsubscribe()
+
+    def subscribe(self, last_event_id: int = 0, asgi: bool = False) -> Union[Iterator[bytes], AsyncIterator[bytes]]:
+        return self.aiter_from(last_event_id) if asgi else self.iter_from(last_event_id)
+
+
+class StreamRegistry:
+    """
+        Per-process registry of running (and recently finished) generations.
+        Finished buffers are kept for `settings.SSE_REPLAY_TTL` seconds, so late reconnects can still be replayed.
+        The ones nobody subscribed to are then expired (see `StreamBuffer.on_expire`).
+    """
+
+    def __init__(self) -> None:
+        self._buffers: Dict[Hashable, StreamBuffer] = {}
+        self._lock = threading.Lock()
+
+    def _purge(self) -> None:
+        now = time.monotonic()
+        for key, buffer in list(self._buffers.items()):
+            if buffer.finished and now - buffer.finished_at > settings.SSE_REPLAY_TTL:  # type: ignore
+                del self._buffers[key]
+                if not buffer.claimed and not buffer.expired and buffer.on_expire is not None:
+                    run_in_background(buffer.expire_unclaimed)  # not while holding the registry's lock
+
+    def get(self, key: Hashable) -> Optional[StreamBuffer]:
+        with self._lock:
+            self._purge()
+            return self._buffers.get(key)
+
+    def claim(self, key: Hashable, replay: bool = False) -> Tuple[StreamBuffer, bool]:
+        """
+            Single-flight: returns the running buffer of `key` (or a finished one, if `replay` or nobody
+            subscribed to it yet) and `False`,
+            otherwise registers a new buffer and returns it with `True`. The caller of a new buffer must `.start` it
+            (or `.finish` it, if building the stream failed). Subscribers may attach before it is started.
+        """
+        with self._lock:
+            self._purge()
+            buffer = self._buffers.get(key)
+            if buffer is not None and not buffer.expired and (replay or not buffer.finished or not buffer.claimed):
+                return buffer, False
+            buffer = self._buffers[key] = StreamBuffer(key)
+            return buffer, True
+
+    def start(self, key: Hashable, stream: Union[Iterator[bytes], AsyncIterator[bytes]],
+              cancellable: bool = True) -> StreamBuffer:
+        """
+            Registers a new buffer for `key` (replacing the previous one) and starts producing it from `stream`.
+            Generations nobody waits for yet (started by the server) should not be `cancellable`.
+        """
+        buffer = StreamBuffer(key)
+        with self._lock:
+            self._purge()
+            self._buffers[key] = buffer
+        buffer.start(stream, cancellable=cancellable)
+        return buffer
+
+
+streams = StreamRegistry()
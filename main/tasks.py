@@ -1,26 +1,31 @@
-# import logging
-# import requests
-# from tempfile import TemporaryFile
+import logging
+from functools import partial
+from tempfile import TemporaryFile
+from typing import Optional
+
+import openai
+import requests
+from django.conf import settings
+from django.core.files import File
 # from urllib.request import urlopen
-# from django.conf import settings
-# from django.core.files import File
 # from django.utils import timezone
 # from main.models import (
 #     VideoAvatar,
 #     VideoAvatarTemplate,
 # )
-# from jlab.models import (
-#     MessageObject,
-#     MessageObjectStatuses,
-#     MessageObjectTypes,
-#     TaskMessage,
-# )
+from jlab.models import (
+    MessageObject,
+    MessageObjectStatuses,
+    # MessageObjectTypes,
+    TaskMessage,
+)
 # # from account.models import UserOnboarding
-# from main.utils import generate_image
-# from main.api import StreamAgentAPI
+from main.api import StreamAgentAPI
+from main.jobs import image_jobs
+from main.utils import generate_image
 # from ai.celery import app
 
-# DUMMY_IMAGE_URL = "https://d7pqxnw01lpes.cloudfront.net/media/jlab_examples/example_4.webp"
+DUMMY_IMAGE_URL = "https://d7pqxnw01lpes.cloudfront.net/media/jlab_examples/example_4.webp"
 # DUMMY_VIDEO_URL = "https://d7pqxnw01lpes.cloudfront.net/media/jlab/avatars/video/video_310.mp4"
 # SYNERGIZER_STRENGTH = 1
 # if settings.DEBUG:
@@ -29,6 +34,78 @@
 #     WEBHOOK_URL = "https://api.jobescape.me/ai_v2/synclab/"
 
 
+def set_status(msg_obj_id: int, status: str) -> None:
+    MessageObject.objects.filter(id=msg_obj_id).update(status=status)
+
+
+def save_image(ai_msg_obj: MessageObject, url: str, extension: str) -> None:
+    """Streams the image at `url` into the MessageObject's file (the media storage) and marks it IMAGE_READY."""
+    with requests.get(url, stream=True, timeout=settings.REQUESTS_TIMEOUT) as response:
+        response.raise_for_status()
+        with TemporaryFile("w+b") as tmp_file:
+            for chunk in response.iter_content(64 * 1024):
+                tmp_file.write(chunk)
+            filename = f"stage_image_{ai_msg_obj.pk}.{extension}" if settings.DEBUG else f"image_{ai_msg_obj.pk}.{extension}"
+            ai_msg_obj.file.save(filename, File(tmp_file), save=False)
+    ai_msg_obj.status = MessageObjectStatuses.IMAGE_READY
+    ai_msg_obj.save(update_fields=["file", "status"])
+
+
+def dummy_generate_image_task(msg_obj_id: int) -> None:
+    ai_msg_obj = MessageObject.objects.filter(id=msg_obj_id).first()
+    if ai_msg_obj is not None:
+        save_image(ai_msg_obj, DUMMY_IMAGE_URL, "webp")
+
+
+def generate_image_task(user_msg_id: int, msg_obj_id: int) -> None:
+    """
+        Generates the image answering the user's TaskMessage with DALL-E and saves it to the Agent's MessageObject.
+        Runs on `main.jobs.image_jobs` (see `schedule_image_task`): raising an exception retries it.
+    """
+    exc_msg = "Generate image task: Aborting because "
+    try:
+        ai_msg_obj = MessageObject.objects.select_related("message__agent").get(id=msg_obj_id)
+        user_message = TaskMessage.objects.prefetch_related("objs").get(id=user_msg_id)
+    except MessageObject.DoesNotExist:
+        logging.warning("%s related MessageObject does not exist! id=%d", exc_msg, msg_obj_id)
+        return
+    except TaskMessage.DoesNotExist:
+        logging.warning("%s user's TaskMessage does not exist! id=%d", exc_msg, user_msg_id)
+        set_status(msg_obj_id, MessageObjectStatuses.ERROR)
+        return
+    if ai_msg_obj.file:
+        logging.warning("%s related MessageObject already has a file! id=%d", exc_msg, msg_obj_id)
+        return
+    set_status(msg_obj_id, MessageObjectStatuses.AWAITING)
+    ai_message = ai_msg_obj.message
+    prompt = StreamAgentAPI(ai_message).get_message_text_content(user_message)
+    try:
+        images = generate_image(prompt, 1, "hd", agent_id=ai_message.agent_id)  # type: ignore
+    except openai.BadRequestError as exc:
+        # E.g. the prompt violates the content policy, a retry would fail the same way
+        logging.warning("%s openai rejected the prompt! id=%d; exception=%s", exc_msg, user_msg_id, str(exc))
+        set_status(msg_obj_id, MessageObjectStatuses.ERROR)
+        return
+    assert images[0].url, "OpenAI returned no image URL."
+    save_image(ai_msg_obj, images[0].url, "jpeg")
+
+
+def schedule_image_task(msg_obj_id: int, user_msg_id: Optional[int] = None, delay: float = 0) -> None:
+    """
+        Queues the generation of an image MessageObject (AWAITING) on `main.jobs.image_jobs`: the answer
+        to the user's TaskMessage `user_msg_id`, or the dummy image (onboarding) without it.
+        A failed attempt sets RETRY, the final failure ERROR. Raises `main.jobs.JobQueueFull`.
+    """
+    callbacks = {
+        "on_retry": partial(set_status, msg_obj_id, MessageObjectStatuses.RETRY),
+        "on_failure": partial(set_status, msg_obj_id, MessageObjectStatuses.ERROR),
+    }
+    if user_msg_id is None:
+        image_jobs.submit(dummy_generate_image_task, msg_obj_id, delay=delay, **callbacks)
+    else:
+        image_jobs.submit(generate_image_task, user_msg_id, msg_obj_id, delay=delay, **callbacks)
+
+
 # @app.task(ignore_result=True)
 # def dummy_generate_video_task(msg_obj_id: int) -> bool:
 #     try:
@@ -45,22 +122,6 @@
 #     return True
 
 
-# @app.task(ignore_result=True)
-# def dummy_generate_image_task(msg_obj_id: int) -> bool:
-#     try:
-#         ai_msg_obj = MessageObject.objects.get(id=msg_obj_id)
-#     except:  # pylint: disable=W0702
-#         return False
-#     with TemporaryFile("w+b") as tmp_file:
-#         with urlopen(DUMMY_IMAGE_URL) as response:
-#             tmp_file.write(response.read())
-#         filename = f"stage_image_{ai_msg_obj.pk}.webp" if settings.DEBUG else f"image_{ai_msg_obj.pk}.webp"
-#         ai_msg_obj.file.save(filename, File(tmp_file), save=False)
-#     ai_msg_obj.status = MessageObjectStatuses.IMAGE_READY
-#     ai_msg_obj.save()
-#     return True
-
-
 # @app.task(ignore_result=True)
 # def generate_video_task(user_msg_id: int, msg_obj_id: int, avatar_id: int, retry=True) -> bool:
 #     """
@@ -203,58 +264,6 @@
 #     return True
 
 
-# @app.task(ignore_result=True)
-# def generate_image_task(user_msg_id: int, msg_obj_id: int):
-#     exc_msg = "Generate image task: Aborting because "
-#     error = True
-#     # Fetch instances
-#     try:
-#         ai_msg_obj = MessageObject.objects.select_related(
-#             "message__agent").get(id=msg_obj_id)
-#         ai_message = ai_msg_obj.message
-#         user_message = TaskMessage.objects.prefetch_related(
-#             "objs").get(id=user_msg_id)
-#         # Fetch text content from user's TaskMessage
-#         prompt = StreamAgentAPI(
-#             ai_message).get_message_text_content(user_message)
-#         # Check if there's image already
-#         if ai_msg_obj.file:
-#             logging.warning(
-#                 "%s related MessageObject already has a file! id=%d", exc_msg, user_msg_id)
-#         else:
-#             error = False
-#     except MessageObject.DoesNotExist:
-#         logging.warning(
-#             "%s related MessageObject does not exist! id=%d", exc_msg, msg_obj_id)
-#     except TaskMessage.DoesNotExist:
-#         logging.warning(
-#             "%s user's TaskMessage does not exist! id=%d", exc_msg, user_msg_id)
-#     if error:
-#         MessageObject.objects.filter(id=msg_obj_id).update(
-#             status=MessageObjectStatuses.ERROR)
-#         return False
-#     # Generate image and save
-#     MessageObject.objects.filter(id=msg_obj_id).update(
-#         status=MessageObjectStatuses.AWAITING)
-#     try:
-#         images = generate_image(prompt, 1, "hd")
-#         assert images[0].url
-#     except Exception as exc:
-#         logging.warning(
-#             "%s openai failed to generate image! id=%d; exception=%s", exc_msg, user_msg_id, str(exc))
-#         MessageObject.objects.filter(id=msg_obj_id).update(
-#             status=MessageObjectStatuses.ERROR)
-#         return False
-#     with TemporaryFile("w+b") as tmp_file:
-#         with urlopen(images[0].url) as response:
-#             tmp_file.write(response.read())
-#         filename = f"stage_image_{ai_msg_obj.pk}.jpeg" if settings.DEBUG else f"image_{ai_msg_obj.pk}.jpeg"
-#         ai_msg_obj.file.save(filename, File(tmp_file), save=False)
-#     ai_msg_obj.status = MessageObjectStatuses.IMAGE_READY
-#     ai_msg_obj.save()
-#     return True
-
-
 # @app.task
 # def update_user_onboarding_task(user_id, fields, token):
 #     print(f"inside the update_user_onboarding_task: {token}")
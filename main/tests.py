@@ -1,3 +1,1134 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from openai.types.chat import ChatCompletionChunk
+from openai.types.chat.chat_completion_chunk import Choice, ChoiceDelta
+from openai.types.completion_usage import CompletionUsage
+from PIL import Image
+from prometheus_client import REGISTRY
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from ai.asgi import application as asgi_application
+from custom.custom_storage import BlobFileSystemStorage, MediaStorage
+from main.api import StreamAgentAPI
+from main.backends import Backend, CompletionTelemetry, StartedStream, ahedge, complete, hedge, warm_up
+from main.base_api import BaseGenerationAPI
+from main.cache import CompletionCache, LocMemBackend, is_replay
+from main.context import ChatTurn, ContextWindow
+from main.models import Agent, AgentImageExample, AgentTypes, MediaBlob
+from main.prompts import PromptTemplate
+from main.jobs import JobExecutor, JobQueueFull
+from main.metrics import completion_lengths, record_cancelled_stream, record_completed_stream
+from main.locks import AdvisoryLockBackend, FileLockBackend, SharedGeneration
+from main.registry import AgentRegistry, agent_registry
+from main.renditions import build_renditions, submit
+from main.serializers import AgentImageExampleSerializer
+from main.ratelimit import DatabaseBucketBackend, FileBucketBackend, RateLimiter, RateLimitExceeded
+from main.sse import FrameCoalescer, multiline_frame, text_frame
+from main.streams import StreamBuffer, StreamRegistry
+from main.utils import count_tokens, generate_chat_completion
+from main.views import AgentViewSet, AiViewSet
+from jlab.models import (
+    ChatSummary,
+    MessageObject,
+    MessageObjectStatuses,
+    MessageObjectTypes,
+    Project,
+    ProjectTask,
+    TaskMessage,
+)
+
+
+class StreamAgentAPIQueriesTest(TestCase):
+    """`StreamAgentAPI.pre_generate` must not query per message of the chat."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = Agent.objects.create(
+            type=AgentTypes.TEXT,
+            name="Writer",
+            sys_template="You are a writer.",
+            user_template="{main_field} {quote} {email}",
+        )
+        cls.project = Project.objects.create(user_id="1", user_email="user@example.com")
+
+    def create_chat(self, turns: int) -> ProjectTask:
+        task = ProjectTask.objects.create(project=self.project, title="Chat")
+        for i in range(turns):
+            question = TaskMessage.objects.create(task=task, agent=self.agent, parameters={})
+            MessageObject.objects.create(
+                message=question, content_type=MessageObjectTypes.TEXT, content=f"Question {i}")
+            MessageObject.objects.create(
+                message=question, content_type=MessageObjectTypes.QUOTE, content=f"Quote {i}")
+            answer = TaskMessage.objects.create(task=task, agent=self.agent, is_answer=True)
+            MessageObject.objects.create(
+                message=answer, content_type=MessageObjectTypes.TEXT, content=f"Answer {i}")
+        return task
+
+    def count_pre_generate_queries(self, turns: int) -> int:
+        task = self.create_chat(turns)
+        last_message = TaskMessage.objects.create(task=task, agent=self.agent, parameters={})
+        MessageObject.objects.create(
+            message=last_message, content_type=MessageObjectTypes.TEXT, content="Last question")
+        task = ProjectTask.objects.get(pk=task.pk)
+        ai_message = task.messages.create(is_answer=True, agent=self.agent)
+        api = StreamAgentAPI(ai_message)
+        api.init_messages()
+        with CaptureQueriesContext(connection) as ctx:
+            api.pre_generate(
+                task_messages=StreamAgentAPI.get_task_messages(task, self.agent.type),
+                last_msg_id=last_message.pk,
+            )
+        # system prompt + one message per question/answer + the last question
+        self.assertEqual(len(api.messages), 1 + 2 * turns + 1)
+        return len(ctx.captured_queries)
+
+    def test_query_count_is_flat(self):
+        short_chat = self.count_pre_generate_queries(2)
+        long_chat = self.count_pre_generate_queries(50)
+        self.assertEqual(short_chat, long_chat)
+
+    def test_user_prompt_uses_prefetched_objects(self):
+        task = ProjectTask.objects.get(pk=self.create_chat(1).pk)
+        ai_message = task.messages.create(is_answer=True, agent=self.agent)
+        api = StreamAgentAPI(ai_message)
+        question = StreamAgentAPI.get_task_messages(task, self.agent.type).first()
+        with self.assertNumQueries(1):  # the project, read once for the whole chat
+            self.assertEqual(api.get_message_text_content(question), "Question 0 Quote 0 user@example.com")
+
+    def test_owner_without_full_name(self):
+        agent = Agent.objects.create(type=AgentTypes.TEXT, name="Mailer", user_template="{full_name} <{email}>")
+        task = ProjectTask.objects.create(project=self.project, title="Chat")
+        question = TaskMessage.objects.create(task=task, agent=agent, parameters={})
+        api = StreamAgentAPI(TaskMessage(task=task, is_answer=True, agent=agent))
+        self.assertEqual(api.get_message_text_content(question), f"{api.NOT_DEFINED} <user@example.com>")
+
+
+class AnswerStreamViewTest(TransactionTestCase):
+    """`AiViewSet.stream` returns the event stream before the completion answers, the title follows as an event."""
+
+    def setUp(self):
+        agent_registry.invalidate()
+        self.addCleanup(agent_registry.invalidate)
+        self.agent = Agent.objects.create(
+            type=AgentTypes.TEXT, name="Writer", sys_template="You are a writer.", user_template="{main_field}")
+        self.task = ProjectTask.objects.create(
+            project=Project.objects.create(user_id="1", user_email="user@example.com"), title="Untitled")
+        self.question = TaskMessage.objects.create(task=self.task, agent=self.agent, parameters={})
+        MessageObject.objects.create(message=self.question, content_type=MessageObjectTypes.TEXT, content="Hi")
+
+    @staticmethod
+    def completion(*args, **kwargs):
+        time.sleep(0.5)  # the time to the first token, `StartedStream` waits for it
+        return iter([
+            ChatCompletionChunk(
+                id="chatcmpl-1", choices=[Choice(index=0, delta=ChoiceDelta(content="Hello"), finish_reason=None)],
+                created=0, model="gpt-4o", object="chat.completion.chunk"),
+            ChatCompletionChunk(
+                id="chatcmpl-1", choices=[Choice(index=0, delta=ChoiceDelta(), finish_reason="stop")],
+                created=0, model="gpt-4o", object="chat.completion.chunk"),
+        ])
+
+    def test_title_is_sent_as_an_event(self):
+        request = APIRequestFactory().get(
+            f"/ai/{self.task.pk}/stream/", {"agent_id": self.agent.pk, "message_id": self.question.pk})
+        force_authenticate(request, user={"user_id": "1"}, token={"subscriptions": [{"expires": "2100-01-01 00:00:00"}]})
+        with mock.patch("main.base_api.generate_chat_completion", self.completion), \
+                mock.patch("main.api.create_update_user_onboarding_task"), \
+                mock.patch.object(StreamAgentAPI, "get_title", return_value="Launch plan"):
+            started = time.monotonic()
+            response = AiViewSet.as_view({"get": "stream"})(request, pk=self.task.pk)
+            elapsed = time.monotonic() - started
+            frames = [frame.split(b"\n", 1)[-1] for frame in response.streaming_content]
+        self.assertLess(elapsed, 0.4)
+        self.assertIn(b"event: title\ndata: Launch plan\n\n", frames)
+        self.assertLess(frames.index(b"event: title\ndata: Launch plan\n\n"), frames.index(b"data: Stop\0\n\n"))
+        self.assertIn(b"data: Hello\n\n", frames)
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.title, "Launch plan")
+
+
+class AsgiStreamTest(TransactionTestCase):
+    """`AiViewSet.stream` served by the ASGI handler streams from an async generator over `agenerate_chat_completion`."""
+
+    def setUp(self):
+        agent_registry.invalidate()
+        self.addCleanup(agent_registry.invalidate)
+        self.agent = Agent.objects.create(
+            type=AgentTypes.TEXT, name="Writer", sys_template="You are a writer.", user_template="{main_field}")
+        self.task = ProjectTask.objects.create(
+            project=Project.objects.create(user_id="1", user_email="user@example.com"), title="Chat")
+        self.question = TaskMessage.objects.create(task=self.task, agent=self.agent, parameters={})
+        MessageObject.objects.create(message=self.question, content_type=MessageObjectTypes.TEXT, content="Hi")
+
+    @staticmethod
+    async def completion(*args, **kwargs):
+        async def chunks():
+            for content, finish_reason in [("Hel", None), ("lo", None), (None, "stop")]:
+                await asyncio.sleep(0)
+                yield ChatCompletionChunk(
+                    id="chatcmpl-1", created=0, model="gpt-4o", object="chat.completion.chunk",
+                    choices=[Choice(index=0, delta=ChoiceDelta(content=content), finish_reason=finish_reason)])
+        return chunks()
+
+    async def test_answer_is_streamed_over_asgi(self):
+        user, token = {"user_id": "1", "email": "user@example.com"}, {"subscriptions": [{"expires": "2100-01-01 00:00:00"}]}
+        with mock.patch("main.base_api.agenerate_chat_completion", self.completion), \
+                mock.patch("main.base_api.generate_chat_completion") as sync_completion, \
+                mock.patch("main.api.create_update_user_onboarding_task"), \
+                mock.patch("custom.custom_backend.PrefetchedJWTAuthentication.authenticate", return_value=(user, token)):
+            response = await self.async_client.get(
+                f"/ai/{self.task.pk}/stream/", {"agent_id": self.agent.pk, "message_id": self.question.pk})
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            frames = [frame.split(b"\n", 1)[-1] async for frame in response.streaming_content]
+        sync_completion.assert_not_called()
+        self.assertEqual(frames[-1], b"data: Stop\0\n\n")
+        self.assertEqual(b"".join(frame[6:-2] for frame in frames[:-1] if frame.startswith(b"data: ")), b"Hello")
+        answer = await TaskMessage.objects.filter(task=self.task, is_answer=True).prefetch_related("objs").aget()
+        self.assertEqual([obj.content for obj in answer.objs.all()], ["Hello"])
+
+
+class AsgiApplicationTest(SimpleTestCase):
+    def test_lifespan_warms_up_and_shuts_down_the_jobs(self):
+        messages = [{"type": "lifespan.startup"}, {"type": "lifespan.shutdown"}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message["type"])
+
+        with override_settings(LLM_HTTP={**settings.LLM_HTTP, "WARM_UP": True}), \
+                mock.patch("ai.asgi.awarm_up") as awarm_up, mock.patch("ai.asgi.warm_up") as warm_up, \
+                mock.patch("ai.asgi.image_jobs") as image_jobs, mock.patch("ai.asgi.rendition_jobs") as rendition_jobs:
+            asyncio.run(asgi_application({"type": "lifespan"}, receive, send))
+        self.assertEqual(sent, ["lifespan.startup.complete", "lifespan.shutdown.complete"])
+        awarm_up.assert_awaited_once()
+        warm_up.assert_called_once_with()
+        image_jobs.shutdown.assert_called_once_with(settings.IMAGE_JOBS["SHUTDOWN_TIMEOUT"])
+        rendition_jobs.shutdown.assert_called_once_with(settings.IMAGE_RENDITIONS["JOBS"]["SHUTDOWN_TIMEOUT"])
+
+    @override_settings(LLM_BACKENDS={
+        "default": [{"NAME": "openai", "MODEL": "gpt-4o"}, {"NAME": "openai-hedge", "MODEL": "gpt-4o"}],
+        "chat": [{"NAME": "other", "MODEL": "gpt-4o", "BASE_URL": "https://llm.example.com/v1"}],
+    })
+    def test_warm_up_connects_once_per_endpoint(self):
+        clients = {settings.OPENAI_BASE_URL: mock.MagicMock(), "https://llm.example.com/v1": mock.MagicMock()}
+        unreachable = clients["https://llm.example.com/v1"].with_options.return_value.models.list
+        unreachable.side_effect = httpx.ConnectError("unreachable")
+        with mock.patch("main.backends.get_client", side_effect=lambda api_key, base_url: clients[base_url]), \
+                self.assertLogs(level="WARNING"):
+            warm_up()  # an unreachable endpoint does not fail the worker's start
+        for client in clients.values():
+            client.with_options.assert_called_once_with(timeout=10)
+            client.with_options.return_value.models.list.assert_called_once_with()
+
+
+class AgentRegistryTest(TestCase):
+    def test_agents_are_read_once_per_version(self):
+        agent = Agent.objects.create(type=AgentTypes.TEXT, name="Writer", user_template="{main_field}")
+        registry = AgentRegistry()
+        registry.invalidate()
+        with self.assertNumQueries(3):  # version, agents, examples
+            self.assertEqual(registry.get(agent.pk), agent)
+        with self.assertNumQueries(0):
+            self.assertIsNone(registry.get(agent.pk, AgentTypes.VIDEO))
+            self.assertEqual(registry.get(agent.pk).user_prompt.render({"main_field": "Hi"}), "Hi")
+        with self.captureOnCommitCallbacks(execute=True):
+            agent.name = "Editor"
+            agent.save()
+        registry._checked_at = float("-inf")  # the check interval has passed
+        self.assertEqual(registry.get(agent.pk).name, "Editor")
+
+    def test_list_rejects_unknown_types(self):
+        view = AgentViewSet.as_view({"get": "list"})
+        for agent_type, status in (("image", 200), ("", 200), ("nonsense", 400)):
+            request = APIRequestFactory().get("/agents/", {"type": agent_type})
+            force_authenticate(request, user={"user_id": "1"})
+            self.assertEqual(view(request).status_code, status, agent_type)
+        self.assertNotIn("nonsense", [agent_type for agent_type, _ in agent_registry._payloads])
+
+    def test_prompt_template_matches_format_map(self):
+        template = "{main_field!r} {{literal}} {quote:>6} {email}"
+        params = {"main_field": "text", "quote": "q", "email": "e"}
+        self.assertEqual(PromptTemplate(template).render(params), template.format_map(params))
+
+
+class ContextWindowTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = Agent.objects.create(type=AgentTypes.TEXT, name="Writer", context_budget=1000)
+        project = Project.objects.create(user_id="1", user_email="user@example.com")
+        cls.task = ProjectTask.objects.create(project=project, title="Chat")
+
+    def get_turns(self, count: int):
+        turns = [
+            ChatTurn(message_id=i, role="assistant" if i % 2 else "user", content=f"Turn {i}", tokens=96)
+            for i in range(1, count + 1)
+        ]
+        turns.append(ChatTurn(message_id=count + 1, role="user", content="New request", tokens=100, pinned=True))
+        return turns
+
+    def test_history_is_fitted_into_budget(self):
+        window = ContextWindow(self.agent, self.task)
+        messages = window.fit(self.get_turns(40))
+        # 1000 - 4 (system) - 104 (pinned) leaves room for 8 turns of 100 tokens
+        self.assertEqual(len(messages), 9)
+        self.assertEqual([m["content"] for m in messages[-2:]], ["Turn 40", "New request"])
+        self.assertEqual([turn.message_id for turn in window.overflow], list(range(1, 33)))
+
+    def test_summary_replaces_covered_turns(self):
+        ChatSummary.objects.create(
+            task=self.task, agent_type=self.agent.type, content="Summary", token_count=96, covered_until=32)
+        window = ContextWindow(self.agent, self.task)
+        messages = window.fit(self.get_turns(40))
+        self.assertEqual(messages[0]["role"], "system")
+        self.assertEqual(len(messages), 1 + 7 + 1)
+        self.assertEqual([turn.message_id for turn in window.overflow], [33])
+
+
+class CompletionCacheTest(SimpleTestCase):
+    def get_chunks(self, deltas):
+        return [
+            ChatCompletionChunk(
+                id="chatcmpl-1",
+                choices=[Choice(index=0, delta=ChoiceDelta(content=delta), finish_reason=None)],
+                created=0,
+                model="gpt-4o",
+                object="chat.completion.chunk",
+            )
+            for delta in deltas
+        ] + [
+            ChatCompletionChunk(
+                id="chatcmpl-1",
+                choices=[Choice(index=0, delta=ChoiceDelta(), finish_reason="stop")],
+                created=0,
+                model="gpt-4o",
+                object="chat.completion.chunk",
+            )
+        ]
+
+    def test_lru_eviction_and_ttl(self):
+        backend = LocMemBackend(max_entries=2)
+        backend.set("a", "1", 60)
+        backend.set("b", "2", 60)
+        backend.get("a")
+        backend.set("c", "3", 60)
+        self.assertIsNone(backend.get("b"))
+        self.assertEqual(backend.get("a"), "1")
+        with mock.patch("main.cache.time.monotonic", return_value=10 ** 9):
+            self.assertIsNone(backend.get("c"))
+
+    def test_stream_is_replayed(self):
+        cache = CompletionCache(LocMemBackend(), ttl=60, call_types=["project"])
+        key = cache.make_key("project", "gpt-4o", [{"role": "user", "content": "Hi"}], 0, {"type": "text"})
+        self.assertIsNone(cache.replay(key))
+        recorded = [chunk.choices[0].delta.content for chunk in cache.record(key, self.get_chunks(["Hel", "lo"]))]
+        replayed = [chunk.choices[0].delta.content for chunk in cache.replay(key)]
+        self.assertEqual(replayed, recorded)
+
+    def test_non_deterministic_requests_are_not_cached(self):
+        cache = CompletionCache(LocMemBackend(), ttl=60, call_types=["project"])
+        self.assertIsNone(cache.make_key("project", "gpt-4o", [], 0.7, {"type": "text"}))
+
+    def test_only_opted_in_call_types_are_cached(self):
+        cache = CompletionCache(LocMemBackend(), ttl=60, call_types=["project"])
+        self.assertIsNotNone(cache.make_key("project", "gpt-4o", [], 0, {"type": "text"}))
+        self.assertIsNone(cache.make_key("chat", "gpt-4o", [], 0, {"type": "text"}))
+
+    def test_only_answers_of_the_primary_backend_are_stored(self):
+        cache = CompletionCache(LocMemBackend(), ttl=60, call_types=["project"])
+        backends = [Backend("primary", "gpt-4o", "key"), Backend("hedge", "gpt-4o", "key")]
+        messages = [{"role": "user", "content": "Hi"}]
+        key = cache.make_key("project", "gpt-4o", messages, 0, {"type": "text"})
+        winners = iter(reversed(backends))
+
+        def complete(call_type, prompt_tokens, answered, **kwargs):
+            answered(next(winners))
+            return iter(self.get_chunks(["Hi"]))
+
+        with mock.patch("main.utils.completion_cache", cache), \
+                mock.patch("main.utils.get_backends", return_value=backends), \
+                mock.patch("main.utils.complete", side_effect=complete):
+            list(generate_chat_completion(messages, stream=True, call_type="project"))
+            self.assertIsNone(cache.replay(key))
+            list(generate_chat_completion(messages, stream=True, call_type="project"))
+            self.assertIsNotNone(cache.replay(key))
+
+
+class CountTokensTest(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.multiple("main.utils", _encoding=None, _encoding_failures=0, _encoding_retry_at=0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_unavailable_encoding_is_retried_with_backoff(self):
+        encoding = mock.Mock(**{"encode.return_value": [1, 2]})
+        with mock.patch("main.utils.tiktoken.encoding_for_model", side_effect=[OSError("offline"), encoding]) as load, \
+                self.assertLogs(level="WARNING"):
+            self.assertEqual(count_tokens("12345678"), 3)  # estimated
+            self.assertEqual(count_tokens("12345678"), 3)  # not retried before the backoff
+            self.assertEqual(load.call_count, 1)
+            with mock.patch("main.utils.time.monotonic", return_value=time.monotonic() + 2):
+                self.assertEqual(count_tokens("12345678"), 2)
+            self.assertEqual(count_tokens("12345678"), 2)
+            self.assertEqual(load.call_count, 2)
+
+
+class StreamBufferTest(SimpleTestCase):
+    frames = [b'data: Hel\n\n', b'data: lo\n\n', b'data: Stop\0\n\n']
+
+    def test_resume_from_last_event_id(self):
+        buffer = StreamBuffer("key")
+        buffer.start(iter(self.frames))
+        received = list(buffer.iter_from(0))
+        self.assertEqual(received[1:], [b'id: 1\ndata: Hel\n\n', b'id: 2\ndata: lo\n\n', b'id: 3\ndata: Stop\0\n\n'])
+        self.assertEqual(list(buffer.iter_from(2))[1:], [b'id: 3\ndata: Stop\0\n\n'])
+
+    def test_evicted_frames_are_sent_as_snapshot(self):
+        buffer = StreamBuffer("key", max_frames=1)
+        for frame in self.frames:
+            buffer.append(frame)
+        buffer.finish()
+        self.assertEqual(list(buffer.iter_from(1))[1:], [
+            b'event: reset\ndata: \n\n', b'id: 2\ndata: Hello\n\n', b'id: 3\ndata: Stop\0\n\n'])
+
+    def test_async_subscriber_waits_for_frames(self):
+        async def produce():
+            for frame in self.frames:
+                await asyncio.sleep(0)
+                yield frame
+
+        async def consume():
+            buffer = StreamBuffer("key")
+            buffer.start(produce())
+            return [frame async for frame in buffer.aiter_from(0)]
+
+        self.assertEqual(len(asyncio.run(consume())), 4)
+
+    def test_async_generations_do_not_share_the_sync_thread(self):
+        threads = set()
+
+        def checkpoint():
+            threads.add(threading.get_ident())
+            time.sleep(0.2)
+
+        async def produce():
+            await sync_to_async(checkpoint)()
+            yield b'data: Stop\0\n\n'
+
+        async def read(buffer):
+            return [frame async for frame in buffer.aiter_from(0)]
+
+        async def consume():
+            buffers = [StreamBuffer(key) for key in ("a", "b")]
+            for buffer in buffers:
+                buffer.start(produce())
+            started = time.monotonic()
+            await asyncio.gather(*(read(buffer) for buffer in buffers))
+            return time.monotonic() - started
+
+        self.assertLess(asyncio.run(consume()), 0.35)
+        self.assertEqual(len(threads), 2)
+
+    @override_settings(SSE_CANCEL_GRACE=0)
+    def test_server_started_generation_outlives_its_subscribers(self):
+        def produce():
+            for frame in self.frames:
+                time.sleep(0.02)
+                yield frame
+
+        registry = StreamRegistry()
+        buffer = registry.start("key", produce(), cancellable=False)
+        subscriber = buffer.iter_from(0)
+        next(subscriber)
+        subscriber.close()  # the client left
+        buffer._producer.join(5)
+        self.assertEqual(buffer._last_id, 3)
+        self.assertEqual(list(buffer.iter_from(0))[-1], b'id: 3\ndata: Stop\0\n\n')
+
+
+class SingleFlightTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = Agent.objects.create(
+            type=AgentTypes.TEXT, name="Writer", sys_template="You are a writer.", user_template="{main_field}")
+        task = ProjectTask.objects.create(
+            project=Project.objects.create(user_id="1", user_email="user@example.com"), title="Chat")
+        cls.question = TaskMessage.objects.create(task=task, agent=cls.agent, parameters={})
+
+    def test_identical_requests_share_one_generation(self):
+        registry = StreamRegistry()
+        upstream_calls = []
+
+        def generate():
+            upstream_calls.append(1)
+            yield b'data: Hel\n\n'
+            time.sleep(0.05)
+            yield b'data: lo\n\n'
+            yield b'data: Stop\0\n\n'
+
+        first, created = registry.claim("key")
+        second, attached = registry.claim("key")  # e.g. a double click, before the first one started
+        self.assertTrue(created)
+        self.assertFalse(attached)
+        self.assertIs(first, second)
+        first.start(generate())
+        self.assertEqual(list(first.iter_from(0)), list(second.iter_from(0)))
+        self.assertEqual(len(upstream_calls), 1)
+        self.assertIs(registry.claim("key", replay=True)[0], first)
+        self.assertTrue(registry.claim("key")[1])  # a finished generation is not shared with a new request
+
+    def test_unclaimed_generation_expires(self):
+        registry = StreamRegistry()
+        closed, discarded = [], []
+
+        def generate():
+            try:
+                while True:
+                    yield b'data: token\n\n'
+                    time.sleep(0.01)
+            finally:
+                closed.append(1)
+
+        buffer, _ = registry.claim("key")
+        buffer.start(generate(), unclaimed_ttl=0.05, on_expire=lambda: discarded.append(1))
+        buffer._producer.join(timeout=5)  # pylint: disable=protected-access
+        self.assertEqual((closed, discarded), ([1], [1]))
+        self.assertTrue(registry.claim("key")[1])
+
+    @override_settings(SSE_CANCEL_GRACE=0)
+    def test_generation_followed_by_another_process_is_claimed(self):
+        shared = mock.Mock(following=mock.Mock(return_value=False), followed=mock.Mock(return_value=True))
+        discarded = []
+
+        def generate():
+            while True:
+                yield b'data: token\n\n'
+                time.sleep(0.01)
+
+        buffer = StreamBuffer("key")
+        buffer.start(generate(), unclaimed_ttl=0.05, on_expire=lambda: discarded.append(1), shared=shared)
+        buffer._producer.join(timeout=5)  # pylint: disable=protected-access
+        self.assertTrue(buffer.finished)
+        self.assertEqual(discarded, [])  # the follower streamed the answer
+
+    @override_settings(SSE_REPLAY_TTL=0)
+    def test_unclaimed_finished_generation_expires_when_dropped(self):
+        registry = StreamRegistry()
+        discarded = []
+        for key, shared in (("unclaimed", None), ("followed", mock.Mock(followed=mock.Mock(return_value=True))),
+                            ("claimed", None)):
+            buffer, _ = registry.claim(key)
+            buffer.start(iter([b'data: Stop\0\n\n']), unclaimed_ttl=30, on_expire=lambda k=key: discarded.append(k),
+                         shared=shared)
+            buffer._producer.join(timeout=5)  # pylint: disable=protected-access
+        list(buffer.iter_from(0))
+        with mock.patch("main.streams.run_in_background", side_effect=lambda func: func()):
+            self.assertIsNone(registry.get("unclaimed"))
+        self.assertEqual(discarded, ["unclaimed"])
+
+    def test_finished_generation_waits_for_its_first_subscriber(self):
+        registry = StreamRegistry()
+        buffer, _ = registry.claim("key")
+        buffer.start(iter([b'data: Hello\n\n', b'data: Stop\0\n\n']), unclaimed_ttl=30)
+        buffer._producer.join(timeout=5)  # pylint: disable=protected-access
+        attached, created = registry.claim("key")
+        self.assertFalse(created)
+        self.assertEqual(list(attached.iter_from(0))[1:], [b'id: 1\ndata: Hello\n\n', b'id: 2\ndata: Stop\0\n\n'])
+        self.assertTrue(registry.claim("key")[1])
+
+    def test_file_lock_backend(self):
+        with tempfile.TemporaryDirectory() as directory:
+            backend = FileLockBackend(directory)
+            handle = backend.acquire("stream:1")
+            self.assertIsNotNone(handle)
+            self.assertIsNone(backend.acquire("stream:1"))
+            self.assertTrue(backend.locked("stream:1"))
+            self.assertFalse(backend.locked("stream:2"))
+            backend.release(handle)
+            self.assertFalse(backend.locked("stream:1"))
+
+    def test_advisory_locks_share_one_connection(self):
+        session_locks = set()  # the advisory locks of the Postgres session, which may take its own lock again
+        errors = []
+
+        def execute(sql, params):
+            if errors:
+                raise errors.pop()
+            cursor.fetchone.return_value = (params[0] not in session_locks,) if "try" in sql else (True,)
+            (session_locks.add if "try" in sql else session_locks.discard)(params[0])
+
+        cursor = mock.MagicMock(**{"execute.side_effect": execute})
+        lock_connection = mock.MagicMock(**{"cursor.return_value.__enter__.return_value": cursor})
+        backend = AdvisoryLockBackend()
+        with mock.patch("main.locks.connections.create_connection", return_value=lock_connection) as create:
+            first, second = backend.acquire("stream:1"), backend.acquire("stream:2")
+            self.assertIsNotNone(first)
+            self.assertIsNotNone(second)
+            self.assertIsNone(backend.acquire("stream:1"))
+            backend.release(first)
+            self.assertIsNotNone(backend.acquire("stream:1"))
+            errors.append(OperationalError("server closed the connection"))
+            self.assertIsNotNone(backend.acquire("stream:3"))  # on a new connection
+            backend.release(second)  # released with the closed connection
+        self.assertEqual(create.call_count, 2)
+        self.assertEqual(cursor.execute.call_count, 6)
+
+    @override_settings(STREAM_LOCK={"POLL_INTERVAL": 0})
+    def test_follower_streams_the_saved_answer(self):
+        task = self.question.task
+        previous = TaskMessage.objects.create(task=task, agent=self.agent, is_answer=True, parent=self.question)
+        MessageObject.objects.create(message=previous, content_type=MessageObjectTypes.TEXT, content="Old answer")
+        api = StreamAgentAPI(TaskMessage(task=task, is_answer=True, agent=self.agent, parent=self.question))
+        polls = []
+
+        def is_running():
+            """The other worker saves the first token, a checkpoint and then the answer."""
+            polls.append(1)
+            if len(polls) == 2:
+                answer = TaskMessage.objects.create(task=task, agent=self.agent, is_answer=True, parent=self.question)
+                MessageObject.objects.create(message=answer, content_type=MessageObjectTypes.TEXT, content="Hel",
+                                             status=MessageObjectStatuses.AWAITING)
+            elif len(polls) == 3:
+                MessageObject.objects.filter(status=MessageObjectStatuses.AWAITING).update(content="Hello")
+            elif len(polls) == 4:
+                MessageObject.objects.filter(status=MessageObjectStatuses.AWAITING).update(
+                    content="Hello!", status=MessageObjectStatuses.INITIAL)
+            return True
+
+        self.assertEqual(list(api.follow_stream(is_running)), [
+            b'data: Hel\n\n', b'data: lo\n\n', b'data: !\n\n', b'data: Stop\0\n\n'])
+
+    @override_settings(STREAM_LOCK={"POLL_INTERVAL": 0})
+    def test_follower_does_not_replay_an_older_answer(self):
+        task = self.question.task
+        previous = TaskMessage.objects.create(task=task, agent=self.agent, is_answer=True, parent=self.question)
+        MessageObject.objects.create(message=previous, content_type=MessageObjectTypes.TEXT, content="Old answer")
+        api = StreamAgentAPI(TaskMessage(task=task, is_answer=True, agent=self.agent, parent=self.question))
+        # The other worker failed before it saved anything
+        self.assertEqual(list(api.follow_stream(lambda: False)), [b'data: Stop\0\n\n'])
+
+    @override_settings(STREAM_LOCK={"POLL_INTERVAL": 0, "CACHE": "default", "FOLLOWER_TTL": 5, "STATE_TTL": 60})
+    def test_followers_are_shared_with_the_generating_worker(self):
+        task = self.question.task
+        owner = SharedGeneration("stream:owner")
+        api = StreamAgentAPI(TaskMessage(task=task, is_answer=True, agent=self.agent, parent=self.question))
+        # An answer saved while the follower starts, but after the generation started
+        owner.start(api._newest_answer_id())
+        answer = TaskMessage.objects.create(task=task, agent=self.agent, is_answer=True, parent=self.question)
+        MessageObject.objects.create(message=answer, content_type=MessageObjectTypes.TEXT, content="Hello")
+        self.assertFalse(owner.following())
+        follower = SharedGeneration("stream:owner")
+        self.assertEqual(list(api.follow_stream(lambda: False, follower)), [b'data: Hello\n\n', b'data: Stop\0\n\n'])
+        self.assertTrue(owner.following() and owner.followed())
+        owner.finish()
+        self.assertIsNone(follower.since())
+        owner.start(0)  # the next generation
+        self.assertFalse(owner.following() or owner.followed())
+
+
+class StreamCancellationTest(SimpleTestCase):
+    class API(BaseGenerationAPI):
+        content = None
+
+        def get_system_prompt(self, *args, **kwargs):
+            return ""
+
+        def get_user_prompt(self, *args, **kwargs):
+            return ""
+
+        def post_generate(self, full_content):
+            self.content = full_content
+
+    @override_settings(SSE_CANCEL_GRACE=0, SSE_COALESCE_WINDOW=0)
+    def test_upstream_is_closed_when_client_leaves(self):
+        closed = threading.Event()
+
+        def upstream():
+            try:
+                while True:
+                    time.sleep(0.001)
+                    yield ChatCompletionChunk(
+                        id="chatcmpl-1",
+                        choices=[Choice(index=0, delta=ChoiceDelta(content="a"), finish_reason=None)],
+                        created=0,
+                        model="gpt-4o",
+                        object="chat.completion.chunk",
+                    )
+            finally:
+                closed.set()
+
+        api = self.API()
+        buffer = StreamBuffer("key")
+        buffer.start(api._text_stream(upstream()))
+        subscriber = buffer.iter_from(0)
+        next(subscriber)
+        next(subscriber)
+        subscriber.close()
+        buffer._producer.join(5)
+        self.assertTrue(closed.is_set())
+        self.assertTrue(api.content.startswith("a"))
+
+    @override_settings(SSE_CANCEL_GRACE=0.05)
+    def test_generation_followed_by_another_process_is_not_cancelled(self):
+        shared = mock.Mock(following=mock.Mock(return_value=True))
+
+        def produce():
+            for _ in range(20):
+                time.sleep(0.01)
+                yield b'data: a\n\n'
+
+        buffer = StreamBuffer("key")
+        buffer.start(produce(), shared=shared)
+        subscriber = buffer.iter_from(0)
+        next(subscriber)
+        subscriber.close()  # the client of this process left, one in another process follows
+        buffer._producer.join(5)
+        self.assertEqual(buffer._last_id, 20)
+        self.assertTrue(shared.following.called)
+
+        shared.following.return_value = False
+        buffer = StreamBuffer("key")
+        buffer.start(produce(), shared=shared)
+        subscriber = buffer.iter_from(0)
+        next(subscriber)
+        subscriber.close()
+        buffer._producer.join(5)
+        self.assertLess(buffer._last_id, 20)
+
+    @override_settings(SSE_CANCEL_GRACE=0.05)
+    def test_async_generation_followed_by_another_process_is_not_cancelled(self):
+        shared = mock.Mock(following=mock.Mock(return_value=True))
+
+        async def produce():
+            for _ in range(20):
+                await asyncio.sleep(0.01)
+                yield b'data: a\n\n'
+
+        async def run():
+            buffer = StreamBuffer("key")
+            buffer.start(produce(), shared=shared)
+            subscriber = buffer.aiter_from(0)
+            await anext(subscriber)
+            await anext(subscriber)
+            await subscriber.aclose()
+            await buffer._producer
+            return buffer._last_id
+
+        self.assertEqual(asyncio.run(run()), 20)
+
+
+class FrameCoalescerTest(SimpleTestCase):
+    def test_flush_on_interval(self):
+        now = [0.0]
+        coalescer = FrameCoalescer(window=0.05, max_bytes=100, clock=lambda: now[0])
+        frames = []
+        for at, text in [(0, "a"), (0.01, "b"), (0.02, "c"), (0.06, "d"), (0.07, "e")]:
+            now[0] = at
+            frames.append(coalescer.push(text))
+        self.assertEqual(frames, [b"data: a\n\n", None, None, b"data: bcd\n\n", None])  # the first chunk is not held
+
+    def test_flush_on_size(self):
+        coalescer = FrameCoalescer(window=10, max_bytes=4, clock=lambda: 0)
+        frames = [coalescer.push(text) for text in ["a", "bc", "", "de", "f"]]
+        self.assertEqual(frames, [b"data: a\n\n", None, None, b"data: bcde\n\n", None])
+        self.assertEqual(coalescer.flush(), b"data: f\n\n")
+        self.assertIsNone(coalescer.flush())
+        self.assertEqual(coalescer.frames, 3)
+
+    def test_multiline_frames(self):
+        self.assertEqual(multiline_frame("one\ntwo\n"), b"data: one\ndata: two\ndata: \n\n")
+        self.assertEqual(text_frame("one\ntwo"), b"data: one<br/>two\n\n")
+        coalescer = FrameCoalescer(window=10, max_bytes=100, clock=lambda: 0, formatter=multiline_frame)
+        self.assertEqual(coalescer.push("# Plan\n"), b"data: # Plan\ndata: \n\n")
+        self.assertIsNone(coalescer.push("* Re"))
+        self.assertIsNone(coalescer.push("search\n* Draft"))
+        self.assertEqual(coalescer.flush(), b"data: * Research\ndata: * Draft\n\n")
+
+    @override_settings(SSE_COALESCE_WINDOW=10, SSE_COALESCE_BYTES=100)
+    def test_buffered_text_is_flushed_before_stop(self):
+        def chunk(content=None, finish_reason=None):
+            return ChatCompletionChunk(
+                id="chatcmpl-1",
+                choices=[Choice(index=0, delta=ChoiceDelta(content=content), finish_reason=finish_reason)],
+                created=0,
+                model="gpt-4o",
+                object="chat.completion.chunk",
+            )
+
+        async def aiterate(chunks):
+            for item in chunks:
+                yield item
+
+        async def collect(stream):
+            return [frame async for frame in stream]
+
+        expected = [b"data: Hel\n\n", b"data: lo!\n\n", b"data: Stop\0\n\n"]
+        for chunks in ([chunk("Hel"), chunk("lo"), chunk("!")], [chunk("Hel"), chunk("lo"), chunk("!"), chunk(finish_reason="stop")]):
+            api = StreamCancellationTest.API()
+            self.assertEqual(list(api._text_stream(iter(chunks))), expected)  # at the end of the stream, on `Stop`
+            self.assertEqual(api.content, "Hello!")
+            self.assertEqual(asyncio.run(collect(StreamCancellationTest.API()._atext_stream(aiterate(chunks)))), expected)
+
+
+class HedgeTest(SimpleTestCase):
+    backends = [Backend("primary", "gpt-4o", "key"), Backend("hedge", "gpt-4o", "key")]
+
+    def test_hedge_wins_over_slow_primary(self):
+        discarded = []
+
+        def attempt(backend, admitted):
+            admitted()
+            if backend.name == "primary":
+                time.sleep(0.3)
+            return backend.name
+
+        self.assertEqual(hedge("chat", self.backends, attempt, discarded.append, hedge_after=0.05), "hedge")
+        time.sleep(0.4)
+        self.assertEqual(discarded, ["primary"])
+
+    def test_hedge_timer_starts_after_admission(self):
+        attempted = []
+
+        def attempt(backend, admitted):
+            attempted.append(backend.name)
+            time.sleep(0.2)  # queued by the rate limiter
+            admitted()
+            time.sleep(0.05)
+            return backend.name
+
+        self.assertEqual(hedge("chat", self.backends, attempt, hedge_after=0.1), "primary")
+        self.assertEqual(attempted, ["primary"])
+
+    def test_no_hedge_without_hedge_after(self):
+        attempted = []
+
+        def attempt(backend, admitted):
+            attempted.append(backend.name)
+            admitted()
+            time.sleep(0.2)
+            return backend.name
+
+        self.assertEqual(hedge("chat", self.backends, attempt), "primary")
+        self.assertEqual(attempted, ["primary"])
+
+    def test_fallback_on_error(self):
+        def attempt(backend, admitted):
+            if backend.name == "primary":
+                raise ConnectionError()
+            return backend.name
+
+        self.assertEqual(hedge("chat", self.backends, attempt), "hedge")
+        with self.assertRaises(ConnectionError):
+            hedge("chat", self.backends[:1], attempt)
+
+    def test_attempts_close_stale_connections_of_their_thread(self):
+        with mock.patch("main.backends.close_old_connections") as close:
+            self.assertEqual(hedge("chat", self.backends, lambda backend, admitted: backend.name), "primary")
+        self.assertEqual(close.call_count, 2)  # before and after the attempt
+
+    @override_settings(LLM_HEDGE_AFTER=0.05)
+    def test_sync_loser_stream_is_closed(self):
+        closed = threading.Event()
+
+        class Upstream:
+            def __init__(self, delay):
+                self.delay = delay
+
+            def __iter__(self):
+                return self
+
+            def __next__(self):
+                if closed.wait(self.delay) and self.delay:
+                    raise httpx.ReadError("closed")
+                return CompletionTelemetryTest.chunk("Hi")
+
+            def close(self):
+                if self.delay:
+                    closed.set()
+
+        def create(backend, tokens, telemetry, admitted, cancellation, **kwargs):
+            admitted()
+            return Upstream(10 if backend.name == "primary" else 0)
+
+        started = time.monotonic()
+        with mock.patch("main.backends.get_backends", return_value=self.backends), \
+                mock.patch("main.backends.create", side_effect=create):
+            stream = complete("chat", stream=True)
+        self.assertEqual(stream.first.choices[0].delta.content, "Hi")
+        self.assertTrue(closed.wait(1))  # not after the primary's 10 seconds
+        self.assertLess(time.monotonic() - started, 1)
+
+    def test_async_loser_is_cancelled(self):
+        cancelled = []
+
+        async def attempt(backend, admitted):
+            admitted()
+            try:
+                await asyncio.sleep(0.3 if backend.name == "primary" else 0)
+            except asyncio.CancelledError:
+                cancelled.append(backend.name)
+                raise
+            return backend.name
+
+        async def discard(result):
+            return
+
+        self.assertEqual(asyncio.run(ahedge("chat", self.backends, attempt, discard, hedge_after=0.05)), "hedge")
+        self.assertEqual(cancelled, ["primary"])
+
+    def test_async_hedge_timer_starts_after_admission(self):
+        attempted = []
+
+        async def attempt(backend, admitted):
+            attempted.append(backend.name)
+            await asyncio.sleep(0.2)
+            admitted()
+            await asyncio.sleep(0.05)
+            return backend.name
+
+        async def discard(result):
+            return
+
+        self.assertEqual(asyncio.run(ahedge("chat", self.backends, attempt, discard, hedge_after=0.1)), "primary")
+        self.assertEqual(attempted, ["primary"])
+
+
+class CancelledStreamMetricsTest(SimpleTestCase):
+    @staticmethod
+    def saved() -> float:
+        return REGISTRY.get_sample_value("llm_completion_tokens_saved_total", {"source": "MetricsTest"}) or 0
+
+    def test_tokens_saved_are_counted_in_tokens(self):
+        with mock.patch("main.utils.count_tokens", side_effect=lambda text: len(text.split())):
+            record_completed_stream("MetricsTest", " ".join(["token"] * 10))
+            record_completed_stream("MetricsTest", "a replay", replayed=True)
+            self.assertEqual(completion_lengths["MetricsTest"].value, 10)
+            record_cancelled_stream("MetricsTest", "one two three", replayed=True)
+            self.assertEqual(self.saved(), 0)
+            record_cancelled_stream("MetricsTest", "one two three")
+            self.assertEqual(self.saved(), 7)
+
+    def test_cached_streams_are_replays(self):
+        cache = CompletionCache(LocMemBackend(), ttl=60)
+        chunk = ChatCompletionChunk(
+            id="chatcmpl-1", choices=[Choice(index=0, delta=ChoiceDelta(), finish_reason="stop")],
+            created=0, model="gpt-4o", object="chat.completion.chunk")
+        list(cache.record("key", iter([chunk])))
+        self.assertTrue(is_replay(cache.replay("key")))
+        self.assertEqual(len(list(cache.replay("key"))), 1)
+        self.assertFalse(is_replay(iter([chunk])))
+
+
+class CompletionTelemetryTest(SimpleTestCase):
+    @staticmethod
+    def chunk(content=None, finish_reason=None, usage=None):
+        choices = [] if usage else [Choice(index=0, delta=ChoiceDelta(content=content), finish_reason=finish_reason)]
+        return ChatCompletionChunk(
+            id="chatcmpl-1", choices=choices, created=0, model="gpt-4o", object="chat.completion.chunk", usage=usage)
+
+    def test_usage_chunk_is_measured_and_not_passed_on(self):
+        usage = CompletionUsage(prompt_tokens=12, completion_tokens=2, total_tokens=14)
+        upstream = iter([self.chunk("a"), self.chunk("b"), self.chunk(finish_reason="stop"), self.chunk(usage=usage)])
+        telemetry = CompletionTelemetry("chat", "1", "gpt-4o")
+        with mock.patch.object(telemetry, "finish", wraps=telemetry.finish) as finish:
+            for chunk in StartedStream(upstream, telemetry):
+                if chunk.choices[0].finish_reason:
+                    break  # like the consumers, which stop at the last chunk
+        finish.assert_called_once_with()
+        self.assertEqual(telemetry.usage, usage)
+        self.assertEqual(telemetry.chunks, 4)
+
+
+class JobExecutorTest(SimpleTestCase):
+    def executor(self, **kwargs) -> JobExecutor:
+        options = {"workers": 1, "max_queue": 1, "retries": 2, "backoff_base": 0.01, "backoff_cap": 0.01, **kwargs}
+        return JobExecutor("test_jobs", **options)
+
+    def test_failed_job_is_retried_then_fails(self):
+        attempts, events = [], []
+
+        def job():
+            attempts.append(1)
+            raise ValueError("upstream error")
+
+        executor = self.executor()
+        executor.submit(job, on_retry=lambda: events.append("retry"), on_failure=lambda: events.append("error")).result()
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(events, ["retry", "retry", "error"])
+
+    def test_queue_is_bounded(self):
+        release = threading.Event()
+        executor = self.executor()
+        executor.submit(release.wait)
+        executor.submit(release.wait)
+        with self.assertRaises(JobQueueFull):
+            executor.submit(release.wait)
+        release.set()
+        executor.shutdown(1)
+
+    def test_shutdown_drops_queued_jobs(self):
+        started, release, failed = threading.Event(), threading.Event(), []
+
+        def running():
+            started.set()
+            release.wait()
+
+        executor = self.executor()
+        first = executor.submit(running, on_failure=lambda: failed.append("running"))
+        executor.submit(lambda: None, on_failure=lambda: failed.append("queued"))
+        started.wait(1)
+        threading.Timer(0.05, release.set).start()
+        executor.shutdown(1)
+        self.assertTrue(first.done())
+        self.assertEqual(failed, ["queued"])
+        with self.assertRaises(JobQueueFull):
+            executor.submit(lambda: None)
+
+    def test_delayed_job_does_not_hold_a_worker(self):
+        events = []
+        executor = self.executor()
+        delayed = executor.submit(events.append, "delayed", delay=0.2)
+        executor.submit(events.append, "now").result(0.1)
+        delayed.result(1)
+        self.assertEqual(events, ["now", "delayed"])
+        executor.submit(events.append, "dropped", delay=10, on_failure=lambda: events.append("error"))
+        executor.shutdown(1)
+        self.assertEqual(events, ["now", "delayed", "error"])
+
+
+class RenditionsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.agent = Agent.objects.create(type=AgentTypes.IMAGE, name="Painter")
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(media_root.cleanup)
+        self.enterContext(override_settings(MEDIA_ROOT=media_root.name))
+
+    @staticmethod
+    def png(width: int, height: int) -> ContentFile:
+        buffer = io.BytesIO()
+        Image.new("RGB", (width, height), "teal").save(buffer, "PNG")
+        return ContentFile(buffer.getvalue())
+
+    @staticmethod
+    def scheduled(callbacks) -> list:
+        return [callback.args for callback in callbacks if getattr(callback, "func", None) is submit]
+
+    def test_renditions_are_built_and_exposed_as_srcset(self):
+        example = AgentImageExample(agent=self.agent)
+        with self.captureOnCommitCallbacks() as callbacks:
+            example.file.save("example.png", self.png(1200, 800))
+        self.assertEqual(self.scheduled(callbacks), [(build_renditions, AgentImageExample, example.pk)])
+
+        build_renditions(AgentImageExample, example.pk)
+        example.refresh_from_db()
+        files = example.renditions["files"]
+        self.assertEqual([(item["format"], item["width"]) for item in files],
+                         [("webp", 320), ("webp", 640), ("webp", 1024), ("webp", 1200)])
+        self.assertEqual(files[0]["height"], 213)
+        self.assertTrue(all(example.file.storage.exists(item["name"]) for item in files))
+        srcset = AgentImageExampleSerializer(example).data["srcset"]
+        self.assertEqual(srcset["webp"].count("w, "), 3)
+        self.assertTrue(srcset["webp"].startswith(f"{example.file.storage.url(files[0]['name'])} 320w, "))
+
+        with self.captureOnCommitCallbacks() as callbacks:
+            example.save()
+        self.assertEqual(self.scheduled(callbacks), [])  # unchanged image
+
+    def test_other_files_are_skipped(self):
+        example = AgentImageExample.objects.create(agent=self.agent, file="jlab/agents/images/clip.mp4")
+        build_renditions(AgentImageExample, example.pk)
+        example.refresh_from_db()
+        self.assertEqual(example.renditions, {})
+        self.assertEqual(AgentImageExampleSerializer(example).data["srcset"], {})
+
+
+class MediaBlobTest(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()  # pylint: disable=consider-using-with
+        self.addCleanup(media_root.cleanup)
+        self.storage = BlobFileSystemStorage(location=media_root.name)
+
+    def test_identical_files_are_stored_once(self):
+        first = self.storage.save("jlab/ai_chat/image_1.jpeg", ContentFile(b"same bytes"))
+        with mock.patch.object(FileSystemStorage, "_save") as upload:
+            second = self.storage.save("jlab/ai_chat/image_2.jpeg", ContentFile(b"same bytes"))
+        upload.assert_not_called()
+        self.assertEqual(first, second)
+        self.assertRegex(first, r"^blobs/[0-9a-f]{2}/[0-9a-f]{64}\.jpeg$")
+        self.assertEqual(MediaBlob.objects.get(name=first).refcount, 2)
+
+        other = self.storage.save("jlab/ai_chat/image_3.jpeg", ContentFile(b"other bytes"))
+        self.assertNotEqual(other, first)
+
+        self.storage.delete(first)
+        self.assertTrue(self.storage.exists(first))
+        self.storage.delete(first)
+        self.assertFalse(self.storage.exists(first))
+        self.assertFalse(MediaBlob.objects.filter(name=first).exists())
+        self.assertTrue(self.storage.exists(other))
+
+    def test_deleted_rows_release_their_files(self):
+        agent = Agent.objects.create(type=AgentTypes.IMAGE, name="Painter")
+        with override_settings(MEDIA_ROOT=self.storage.location):
+            examples = [AgentImageExample(agent=agent) for _ in range(2)]
+            for example in examples:
+                example.file.save("example.png", ContentFile(b"not an image"))
+            name = examples[0].file.name
+            self.assertEqual(MediaBlob.objects.get(name=name).refcount, 2)
+            with self.captureOnCommitCallbacks(execute=True):
+                examples[0].delete()
+            self.assertEqual(MediaBlob.objects.get(name=name).refcount, 1)
+            with self.captureOnCommitCallbacks(execute=True):
+                examples[1].delete()
+            self.assertFalse(MediaBlob.objects.filter(name=name).exists())
+            self.assertFalse(os.path.exists(os.path.join(self.storage.location, name)))
+
+    def test_blobs_are_served_with_immutable_cache_headers(self):
+        with override_settings(AWS_STORAGE_BUCKET_NAME="media", AWS_S3_OBJECT_PARAMETERS={"ACL": "private"}):
+            storage = MediaStorage()
+        self.assertEqual(storage.get_object_parameters("media/blobs/ab/" + "ab" * 32 + ".png"),
+                         {"ACL": "private", "CacheControl": "public, max-age=31536000, immutable"})
+        self.assertEqual(storage.get_object_parameters("media/jlab/ai_chat/image_1.jpeg"), {"ACL": "private"})
+
+
+class RateLimiterTest(TestCase):
+    def assert_limits(self, backend):
+        limiter = RateLimiter(backend, requests_per_minute=2, tokens_per_minute=6000, max_wait=0.5, max_queue=10)
+        limiter.acquire("gpt-4o", 1000)
+        limiter.acquire("gpt-4o", 1000)
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire("gpt-4o", 1000)  # the next request is in 30 seconds
+        limiter.acquire("gpt-4o-mini", 6000)
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire("gpt-4o-mini", 1000)  # the tokens are used up
+
+    def test_database_backend(self):
+        self.assert_limits(DatabaseBucketBackend())
+
+    def test_file_backend(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.assert_limits(FileBucketBackend(os.path.join(directory, "buckets.json")))
+
+    def test_full_queue_rejects_immediately(self):
+        limiter = RateLimiter(DatabaseBucketBackend(), requests_per_minute=2, tokens_per_minute=6000, max_wait=0.5, max_queue=0)
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire("gpt-4o", 1)
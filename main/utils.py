@@ -1,36 +1,144 @@
-import httpx
+import logging
+import time
+
 import requests
+import tiktoken
 from requests.exceptions import (
     HTTPError,
     ConnectionError,
     Timeout,
     RequestException,
 )
-from typing import List, Literal
+from typing import List, Literal, Optional
 from django.conf import settings
-from openai import (
-    OpenAI,
-)
 from openai.types.chat import (
     ChatCompletionMessageParam,
 )
 from rest_framework.exceptions import APIException
+from main.backends import CompletionTelemetry, acomplete, complete, get_backends, get_client
+from main.cache import completion_cache
 
-client = OpenAI(api_key=settings.GPT_API_KEY,
-                timeout=httpx.Timeout(timeout=600.0, connect=10.0))
+client = get_client(settings.GPT_API_KEY, settings.OPENAI_BASE_URL)
 
 
-def generate_chat_completion(messages: List[ChatCompletionMessageParam], temperature=0, stream=False, reply_json=False):
-    return client.chat.completions.create(
-        model=settings.GPT_MODEL_ENGINE,
+def generate_chat_completion(messages: List[ChatCompletionMessageParam], temperature=0, stream=False, reply_json=False,
+                             call_type="default", agent_id: Optional[int] = None):
+    """
+        Creates a chat completion on the backends configured for `call_type` (see `main.backends`),
+        the completion's metrics are labelled with `call_type` and `agent_id`.
+        Deterministic requests are answered from `completion_cache` when possible (streams are replayed chunk by chunk).
+        The cache is keyed by the primary backend's model, so only its answers are stored.
+    """
+    response_format = {"type": "json_object" if reply_json else "text"}
+    primary = get_backends(call_type)[0]
+    key = completion_cache.make_key(call_type, primary.model, messages, temperature, response_format)
+    if key and stream:
+        if (cached_stream := completion_cache.replay(key)) is not None:
+            return cached_stream
+    elif key:
+        if (cached := completion_cache.get_completion(key)) is not None:
+            return cached
+    answered = []
+    response = complete(
+        call_type,
+        count_prompt_tokens(messages),
+        messages=messages,
+        temperature=temperature,
+        stream=stream,
+        agent_id=agent_id,
+        answered=answered.append,
+        response_format=response_format
+    )
+    if answered != [primary]:
+        key = None
+    if key and stream:
+        return completion_cache.record(key, response)  # type: ignore
+    if key:
+        completion_cache.set_completion(key, response)  # type: ignore
+    return response
+
+
+async def agenerate_chat_completion(messages: List[ChatCompletionMessageParam], temperature=0, stream=False, reply_json=False,
+                                    call_type="default", agent_id: Optional[int] = None):
+    """Async counterpart of `generate_chat_completion` over `AsyncOpenAI` (for the ASGI streaming views)."""
+    response_format = {"type": "json_object" if reply_json else "text"}
+    primary = get_backends(call_type)[0]
+    key = completion_cache.make_key(call_type, primary.model, messages, temperature, response_format)
+    if key and stream:
+        if (cached_stream := await completion_cache.areplay(key)) is not None:
+            return cached_stream
+    elif key:
+        if (cached := await completion_cache.aget_completion(key)) is not None:
+            return cached
+    answered = []
+    response = await acomplete(
+        call_type,
+        count_prompt_tokens(messages),
         messages=messages,
         temperature=temperature,
         stream=stream,
-        response_format={"type": "json_object" if reply_json else "text"}
+        agent_id=agent_id,
+        answered=answered.append,
+        response_format=response_format
     )
+    if answered != [primary]:
+        key = None
+    if key and stream:
+        return completion_cache.arecord(key, response)  # type: ignore
+    if key:
+        await completion_cache.aset_completion(key, response)  # type: ignore
+    return response
+
 
+ENCODING_RETRY_BASE = 1  # seconds before loading a failed tiktoken encoding is retried, doubled after every failure
+ENCODING_RETRY_CAP = 300
 
-def generate_image(prompt: str, n: int, quality: Literal['standard', 'hd']):
+_encoding: Optional[tiktoken.Encoding] = None
+_encoding_failures = 0
+_encoding_retry_at = 0.0
+
+
+def _get_encoding() -> Optional[tiktoken.Encoding]:
+    """The loaded encoding is kept, failures (e.g. the encoding file could not be downloaded) are retried with backoff."""
+    global _encoding, _encoding_failures, _encoding_retry_at  # pylint: disable=global-statement
+    if _encoding is not None or time.monotonic() < _encoding_retry_at:
+        return _encoding
+    try:
+        try:
+            _encoding = tiktoken.encoding_for_model(settings.GPT_MODEL_ENGINE)
+        except KeyError:
+            _encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:  # pylint: disable=broad-except
+        _encoding_retry_at = time.monotonic() + min(ENCODING_RETRY_CAP, ENCODING_RETRY_BASE * 2 ** _encoding_failures)
+        _encoding_failures += 1
+        logging.warning("count_tokens: tiktoken encoding is unavailable, token counts are estimated. Exception = %s", str(e))
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Returns the number of `settings.GPT_MODEL_ENGINE` tokens in the text (roughly 4 characters per token if tiktoken is unavailable)."""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_prompt_tokens(messages: List[ChatCompletionMessageParam]) -> int:
+    """Estimates the prompt tokens of the messages for the rate limiter (text only, images are not counted)."""
+    tokens = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += count_tokens(content)
+        elif isinstance(content, list):
+            tokens += sum(count_tokens(part.get("text", "")) for part in content if isinstance(part, dict))
+    return tokens
+
+
+def generate_image(prompt: str, n: int, quality: Literal['standard', 'hd'], agent_id: Optional[int] = None):
+    telemetry = CompletionTelemetry("image", "" if agent_id is None else str(agent_id), settings.DALLE_MODEL_ENGINE)
     # try:
     response = client.images.generate(
         model=settings.DALLE_MODEL_ENGINE,
@@ -41,6 +149,7 @@ def generate_image(prompt: str, n: int, quality: Literal['standard', 'hd']):
     # except openai.InvalidRequestError as exc:
     #     logging.error("OpenAI raised InvalidRequestError! Exception = %s", str(exc))
     #     raise BadRequest('Prompt is not acceptable.') from exc
+    telemetry.finish()
     return response.data  # type: ignore
 
 
@@ -1,3 +1,4 @@
+import hmac
 import logging
 from tempfile import TemporaryFile
 from typing import Any
@@ -6,7 +7,7 @@ import requests
 from requests.exceptions import RequestException
 from django.conf import settings
 from django.core.files import File
-from django.http import StreamingHttpResponse
+from django.http import Http404, HttpResponse
 from django.utils import timezone
 from django.utils.dateparse import parse_datetime
 from drf_spectacular.utils import extend_schema
@@ -18,8 +19,11 @@ from rest_framework.response import Response
 from rest_framework.exceptions import APIException
 
 # from account.models import CustomUser
-from main.api import StreamAgentAPI
+from main.api import start_answer_stream
+from main.metrics import render_latest
 from main.models import Agent, AgentTypes
+from main.registry import agent_registry
+from main.streams import event_stream_response, get_last_event_id
 from main.serializers import (
     AgentSerializer,
     AgentTypeSerializer,
@@ -28,17 +32,17 @@ from main.serializers import (
     SynclabWebhookSerializer,
     VideoRequestSerializer,
 )
+from main.jobs import JobQueueFull
+from main.tasks import schedule_image_task
 # from main.tasks import (
-#     dummy_generate_image_task,
 #     dummy_generate_video_task,
-#     generate_image_task,
 #     generate_video_task,
 #     update_user_onboarding_task
 # )
-from custom.custom_exceptions import BadRequest
+from custom.custom_exceptions import BadRequest, ServiceUnavailable
 from custom.custom_permissions import HasUnexpiredSubscription
 from custom.custom_renderers import ServerSentEventRenderer
-from custom.custom_shortcuts import get_object_or_raise
+from custom.custom_shortcuts import get_object_or_raise, is_asgi_request
 from jlab.models import (
     MessageObject,
     MessageObjectStatuses,
@@ -91,39 +95,33 @@ class AiViewSet(viewsets.GenericViewSet):
         """
             Returns a Streaming HTTP Response rendered as Server-sent Event with text tokens.
             The view uses StreamAgentAPI to generate title (for the jlab.ProjectTask) and text response.
+            The title of an "Untitled" task is generated concurrently and sent as a separate `title` event.
+            When served over ASGI the tokens are streamed by an async generator over AsyncOpenAI.
+
+            The generation runs independently of the connection (see `main.streams.StreamBuffer`).
+            Frames carry SSE `id:` fields, a client reconnecting with `Last-Event-ID` resumes the same generation
+            (within the same worker process). A `reset` event means the client must discard the text it has,
+            the full text follows.
+
+            Identical requests (same task, message and agent, e.g. a double click or a second tab) share
+            one generation: within a worker process they attach to the running stream from its first frame,
+            in other processes they follow the answer the generating worker saves (see `main.locks`).
         """
         # TODO (DEV-111): refactor to not use agent ID in request
         task = self.get_object()
         ser = self.get_serializer(data=request.query_params)
         ser.is_valid(raise_exception=True)
         data: Any = ser.data
-        agent: Agent = get_object_or_raise(
-            Agent.objects.filter(type=AgentTypes.TEXT),
-            BadRequest("Invalid agent ID."),
-            pk=data['agent_id']
-        )
-        task_messages = TaskMessage.objects.filter(
-            task=task, agent__type=agent.type).prefetch_related('objs', 'agent', 'task__project')
-        ai_message = task.messages.create(is_answer=True, agent=agent)
-        # UserOnboarding.objects.filter(
-        #     pk=request.user['user_id']).update(first_text=True)
-        try:
-            create_update_user_onboarding_task({
-                "first_text": True
-            }, str(request.auth))  # Use the token from the request.auth
-        except Exception as e:
-            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
-        api = StreamAgentAPI(ai_message)
-        if task.title == "Untitled":
-            task.title = api.get_title(data['message_id'])
-            task.save()
-        stream = api.get_text_stream(task_messages, data['message_id'])
-        response = StreamingHttpResponse(
-            stream, content_type="text/event-stream")
-        response['X-Accel-Buffering'] = 'no'  # Disable buffering in nginx
-        # Ensure clients don't cache the data
-        response['Cache-Control'] = 'no-cache'
-        return response
+        agent = agent_registry.get(data['agent_id'], AgentTypes.TEXT)
+        if agent is None:
+            raise BadRequest("Invalid agent ID.")
+        if not task.messages.filter(pk=data['message_id'], is_answer=False).exists():
+            raise BadRequest("Invalid message ID.")
+        last_event_id = get_last_event_id(request)
+        asgi = is_asgi_request(request)
+        buffer, created = start_answer_stream(
+            task, agent, data['message_id'], str(request.auth), asgi, replay=last_event_id is not None)
+        return event_stream_response(buffer.subscribe(0 if created else last_event_id or 0, asgi))
 
     @extend_schema(responses={201: TaskMessageCreateSerializer})
     @action(['post'], True)
@@ -156,11 +154,9 @@ class AiViewSet(viewsets.GenericViewSet):
         ser = self.get_serializer(data=request.data)
         ser.is_valid(raise_exception=True)
         data = ser.data
-        agent: Agent = get_object_or_raise(
-            Agent.objects.filter(type=AgentTypes.VIDEO),
-            BadRequest("Invalid agent ID."),
-            pk=data['agent_id']
-        )
+        agent = agent_registry.get(data['agent_id'], AgentTypes.VIDEO)
+        if agent is None:
+            raise BadRequest("Invalid agent ID.")
         assert agent.avatar_id, "Agent has no associated Avatar!"  # type: ignore
         user_message = get_object_or_raise(
             TaskMessage.objects.filter(
@@ -202,6 +198,8 @@ class AiViewSet(viewsets.GenericViewSet):
             a MessageObject of type IMAGE.
             The view uses `generate_image_task` to asyncronously generate an image based on
             the provided TaskMessage's text content and the provided Agent's image prompt template.
+            The image is generated by the process' bounded job pool (`main.jobs.image_jobs`), the MessageObject
+            is AWAITING until it is IMAGE_READY (or ERROR). A full pool answers 503.
         """
         # user: CustomUser = request.user
         task = self.get_object()
@@ -218,18 +216,17 @@ class AiViewSet(viewsets.GenericViewSet):
         agent = user_message.agent
         if agent.type != AgentTypes.IMAGE:
             raise BadRequest("Invalid agent type.")
-        ai_message = task.messages.create(is_answer=True, agent=agent)
+        ai_message = task.messages.create(is_answer=True, agent=agent, parent=user_message)
         ai_msg_obj = ai_message.objs.create(
-            content_type=MessageObjectTypes.IMAGE)
-        if data['onboarding']:
-            # dummy_generate_image_task.apply_async(
-            #     args=[ai_msg_obj.pk],
-            #     eta=timezone.now() + timezone.timedelta(seconds=DUMMY_GENERATION_DELAY)
-            # )
-            pass
-        else:
-            # generate_image_task.delay(user_message.pk, ai_msg_obj.pk)
-            pass
+            content_type=MessageObjectTypes.IMAGE, status=MessageObjectStatuses.AWAITING)
+        try:
+            if data['onboarding']:
+                schedule_image_task(ai_msg_obj.pk, delay=DUMMY_GENERATION_DELAY)
+            else:
+                schedule_image_task(ai_msg_obj.pk, user_message.pk)
+        except JobQueueFull as e:
+            ai_message.delete()
+            raise ServiceUnavailable("Too many images are being generated, please try again in a minute.") from e
         try:
             create_update_user_onboarding_task({
                 "first_image": True
@@ -263,7 +260,7 @@ class AiViewSet(viewsets.GenericViewSet):
         tmp_file = TemporaryFile("w+b")
         for chunk in response.iter_content(1024):
             tmp_file.write(chunk)
-        ai_msg_obj.file.delete(save=False)
+        # The replaced file is released when the row is saved (`custom.custom_storage.release_replaced_files`)
         ai_msg_obj.file.save(filename, File(tmp_file), save=False)
         ai_msg_obj.status = MessageObjectStatuses.VIDEO_READY
         ai_msg_obj.save()
@@ -289,5 +286,23 @@ class AgentViewSet(viewsets.GenericViewSet, mixins.ListModelMixin):
         """
             Returns a list of all Agents of the specified AgentType.
             By default, assumes AgentType of TEXT.
+            The payload is served from `agent_registry`.
         """
-        return super().list(request, *args, **kwargs)
+        # Validated, it is a key of the registry's payloads
+        serializer = AgentTypeSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        agent_type = serializer.validated_data["type"] or AgentTypes.TEXT
+        return Response(agent_registry.list_payload(agent_type, request))
+
+
+def metrics(request):
+    """
+        Prometheus metrics endpoint. Requires `Authorization: Bearer <settings.METRICS_TOKEN>`,
+        returns 404 if the token is not configured.
+    """
+    if not settings.METRICS_TOKEN:
+        raise Http404()
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ")
+    if not hmac.compare_digest(token, settings.METRICS_TOKEN):
+        raise Http404()
+    return HttpResponse(render_latest(), content_type="text/plain; version=0.0.4")